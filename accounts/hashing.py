@@ -0,0 +1,135 @@
+"""
+Password hashing off the request threads.
+
+PBKDF2 with Django's default iteration count takes hundreds of
+milliseconds of CPU per hash. When everyone logs in at once, hashing inline
+would occupy every worker thread and core, and WebSocket traffic in the
+same process would stall behind it. ``login_view`` and ``register_view``
+hash in a ``ProcessPoolExecutor`` of ``WORKERS`` spawned processes instead,
+so hashing never uses more than ``WORKERS`` cores.
+
+At most ``QUEUE`` more hashes wait for a free worker. Beyond that, or when
+a result takes longer than ``TIMEOUT`` seconds, ``HashingBusy`` is raised
+at once and the views answer 503 with ``Retry-After``. The client retries
+rather than piling up.
+
+Only the hash runs in the pool. The hasher, salt and stored hash are
+chosen here exactly as ``make_password`` and ``check_password`` would
+choose them, so the workers never touch settings or the database.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import get_hasher, identify_hasher, is_password_usable
+from django.contrib.auth.hashers import make_password as unusable_password
+
+DEFAULTS = {
+    'WORKERS': 2,
+    'QUEUE': 32,
+    'TIMEOUT': 10,
+}
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'ACCOUNTS_HASHING', {})}
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def _encode(hasher, password, salt):
+    return hasher.encode(password, salt)
+
+
+def _verify(hasher, password, encoded):
+    return hasher.verify(password, encoded)
+
+
+class HashingPool:
+    def __init__(self, workers, queue, timeout):
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        # spawn, not fork: the server process has threads and open DB connections
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def run(self, func, *args):
+        """``func(*args)`` in a worker; raises ``HashingBusy`` if the queue is full or the wait too long."""
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy('Too many password hashes queued')
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        # The slot is held until the hash finishes, even if we stop waiting
+        future.add_done_callback(lambda done: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingBusy('Password hashing timed out') from None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            options = config()
+            _pool = HashingPool(options['WORKERS'], options['QUEUE'], options['TIMEOUT'])
+        return _pool
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def make_password(password):
+    """``django.contrib.auth.hashers.make_password`` with the default hasher, hashed in the pool."""
+    if password is None:
+        return unusable_password(None)
+    hasher = get_hasher('default')
+    return pool().run(_encode, hasher, password, hasher.salt())
+
+
+def check_password(password, encoded):
+    """``(correct, must_update)`` as ``django.contrib.auth.hashers.check_password`` decides them."""
+    if password is None or not is_password_usable(encoded):
+        return False, False
+    try:
+        hasher = identify_hasher(encoded)
+    except ValueError:
+        return False, False
+    preferred = get_hasher('default')
+    must_update = hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+    return pool().run(_verify, hasher, password, encoded), must_update
+
+
+def authenticate(username, password):
+    """The active user with these credentials, or None; like ``ModelBackend.authenticate``."""
+    User = get_user_model()
+    user = User._default_manager.filter(**{User.USERNAME_FIELD: username}).first()
+    if user is None:
+        # Hash anyway, so an unknown username takes as long as a wrong password
+        make_password(password)
+        return None
+    correct, must_update = check_password(password, user.password)
+    if not correct or not user.is_active:
+        return None
+    if must_update:
+        user.password = make_password(password)
+        user.save(update_fields=['password'])
+    return user
@@ -1,3 +1,66 @@
-from django.test import TestCase
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from . import hashing
+
+
+class PasswordHashingTests(TransactionTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        hashing.shutdown()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def register(self, username, email, password='correct horse'):
+        return self.client.post('/api/auth/register', {'username': username, 'email': email, 'password': password},
+                                format='json')
+
+    def login(self, username, password):
+        return self.client.post('/api/auth/login', {'username': username, 'password': password}, format='json')
+
+    def test_register_then_login(self):
+        response = self.register('ada', 'ADA@Example.COM')
+        self.assertEqual(response.status_code, 201, response.content)
+        user = User.objects.get(username='ada')
+        self.assertEqual(user.email, 'ADA@example.com')
+        self.assertTrue(user.check_password('correct horse'))
+
+        self.assertEqual(self.login('ada', 'correct horse').status_code, 200)
+        self.assertEqual(self.login('ada', 'wrong').status_code, 400)
+        self.assertEqual(self.login('nobody', 'correct horse').status_code, 400)
+
+    def test_duplicates_are_found_in_one_query(self):
+        User.objects.create(username='ada', email='ada@example.com')
+        for username, email, error in [('ada', 'other@example.com', 'Username already exists'),
+                                       ('other', 'ada@example.com', 'Email already exists'),
+                                       ('ada', 'ada@example.com', 'Username already exists')]:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.register(username, email)
+            self.assertEqual((response.status_code, response.json()['error']), (400, error))
+            self.assertEqual(len(queries), 1)
+
+    def test_outdated_hashes_are_upgraded_on_login(self):
+        User.objects.create(username='old', password=make_password('pw', hasher='pbkdf2_sha1'))
+        self.assertEqual(self.login('old', 'pw').status_code, 200)
+        self.assertTrue(User.objects.get(username='old').password.startswith('pbkdf2_sha256$'))
+
+    @override_settings(ACCOUNTS_HASHING={'WORKERS': 1, 'QUEUE': 0})
+    def test_full_queue_fails_fast(self):
+        hashing.shutdown()
+        self.addCleanup(hashing.shutdown)
+        User.objects.create(username='ada', password=make_password('pw'))
+        pool = hashing.pool()
+        pool.slots.acquire()
+        self.addCleanup(pool.slots.release)
+
+        response = self.login('ada', 'pw')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.register('bob', 'bob@example.com').status_code, 503)
+        self.assertFalse(User.objects.filter(username='bob').exists())
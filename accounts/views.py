@@ -1,6 +1,7 @@
 from django.shortcuts import render
 
 from django.contrib.auth.models import User
+from django.db.models import Q
 from django.contrib.auth import authenticate, login, logout
 
 from rest_framework import status
@@ -11,6 +12,16 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from chat import revocation
+from chat.auth import token_for
+
+from . import hashing
+
+
+def busy_response():
+    return Response({'error': 'Too many sign-ins right now, please retry'},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+
 
 # Create your views here.
 @api_view(['POST'])
@@ -24,17 +35,23 @@ def register_view(request):
         return Response({'error': 'Please provide username, email and password'},
                         status=status.HTTP_400_BAD_REQUEST)
 
-    if User.objects.filter(username=username).exists():
+    taken = list(User.objects.filter(Q(username=username) | Q(email=email)).values_list('username', flat=True)[:2])
+    if username in taken:
         return Response({'error': 'Username already exists'},
                         status=status.HTTP_400_BAD_REQUEST)
 
-    if User.objects.filter(email=email).exists():
+    if taken:
         return Response({'error': 'Email already exists'},
                         status=status.HTTP_400_BAD_REQUEST)
 
-    user = User.objects.create_user(username=username, email=email, password=password)
+    try:
+        user = User(username=User.normalize_username(username), email=User.objects.normalize_email(email),
+                    password=hashing.make_password(password))
+    except hashing.HashingBusy:
+        return busy_response()
+    user.save()
 
-    refresh = RefreshToken.for_user(user)
+    refresh = token_for(user)
     return Response({
         'user_id': user.id,
         'message': 'User created successfully',
@@ -54,12 +71,15 @@ def login_view(request):
         return Response({'error': 'Please provide both username and password'},
                         status=status.HTTP_400_BAD_REQUEST)
     
-    authenticated_user = authenticate(username=username, password=password)
+    try:
+        authenticated_user = hashing.authenticate(username, password)
+    except hashing.HashingBusy:
+        return busy_response()
     if authenticated_user is None:
         return Response({'error': 'Invalid credentials'},
                         status=status.HTTP_400_BAD_REQUEST)
      
-    refresh = RefreshToken.for_user(authenticated_user)
+    refresh = token_for(authenticated_user)
     return Response({
         'user_id': authenticated_user.id,
         'message': 'User created successfully',
@@ -80,7 +100,7 @@ class LogoutView(APIView):
             #     return Response({'error': 'Refresh token is required'}, status=status.HTTP_400_BAD_REQUEST)
 
             token = RefreshToken(refresh_token)
-            token.blacklist()
+            revocation.revoke(token)
             
             return Response({'message': 'User logged out successfully'}, status=status.HTTP_200_OK)
             
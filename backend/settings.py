@@ -58,7 +58,7 @@ AUTHENTICATION_CLASSES = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication'
+        'chat.auth.CachedJWTAuthentication'
     ]
 }
 
@@ -91,6 +91,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'chat.query_inspector.QueryInspectorMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -185,6 +186,31 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'chat.queries': {  # N+1 and slow query reports from chat.query_inspector
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'chat.previews': {  # Failed link preview fetches
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'chat.thumbnails': {  # Images the thumbnail workers could not process
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'chat.layers': {  # Shared channel layer errors behind HybridChannelLayer
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'chat.membership': {  # Membership change events that could not be sent
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
 }
 
@@ -216,11 +242,148 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 ASGI_APPLICATION = 'backend.asgi.application'
 
 # Configure Channel Layers with Redis
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
-        },
+# CHAT_HYBRID_LAYER=1 wraps it in chat.layers.HybridChannelLayer: consumers
+# in the same process get group messages in memory, and Redis carries one
+# copy per group message to each other process. Each process's inbox
+# ('hybrid.*') then takes all of its groups' traffic, hence the larger
+# capacity.
+REDIS_CHANNEL_LAYER = {
+    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+    'CONFIG': {
+        "hosts": [('127.0.0.1', 6379)],
+        'channel_capacity': {'hybrid.*': 10000},
     },
 }
+CHANNEL_LAYERS = {
+    'default': REDIS_CHANNEL_LAYER,
+}
+if os.environ.get('CHAT_HYBRID_LAYER') == '1':
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'chat.layers.HybridChannelLayer',
+        'CONFIG': {'inner': REDIS_CHANNEL_LAYER},
+    }
+
+# Append every inbound WebSocket frame (anonymized) to this JSONL file.
+# Leave unset in normal operation; see chat/recorder.py.
+CHAT_WS_TRACE_PATH = os.environ.get('CHAT_WS_TRACE_PATH')
+
+# Group SQL per HTTP request / WebSocket action and report N+1 patterns and
+# slow queries to the 'chat.queries' logger and /api/chat/debug/query-stats/.
+# Off by default; when off nothing is installed. See chat/query_inspector.py.
+CHAT_QUERY_INSPECTOR = {
+    'ENABLED': os.environ.get('CHAT_QUERY_INSPECTOR') == '1',
+    'N_PLUS_ONE_THRESHOLD': 5,
+    'SLOW_QUERY_MS': 100,
+}
+
+# Link previews (chat/previews.py): seconds a stored preview stays fresh
+# (successful and failed fetches), how long past that a stale one is still
+# served while it is revalidated in the background, in-memory LRU size, and
+# concurrent fetches allowed per host. Links in new chat messages are
+# unfurled in the background, UNFURL_CONCURRENCY at a time with at most
+# UNFURL_QUEUE pending (chat/unfurl.py). Only public addresses are fetched,
+# on every redirect hop too; ALLOWED_NETWORKS lists CIDRs exempt from that.
+CHAT_LINK_PREVIEW = {
+    'TIMEOUT': 5.0,
+    'CACHE_SIZE': 2048,
+    'CACHE_TTL': 60 * 60,
+    'NEGATIVE_TTL': 5 * 60,
+    'STALE_WHILE_REVALIDATE': 7 * 24 * 60 * 60,
+    'PER_HOST_LIMIT': 4,
+    'UNFURL_CONCURRENCY': 8,
+    'UNFURL_QUEUE': 256,
+    'ALLOWED_NETWORKS': [],
+}
+
+# Chunked uploads (chat/uploads.py): largest file and chunk accepted, read
+# size when streaming a chunk to disk, and idle seconds before
+# purge_upload_sessions removes an unfinished upload.
+CHAT_UPLOADS = {
+    'MAX_FILE_SIZE': 4 * 1024 * 1024 * 1024,
+    'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+    'BLOCK_SIZE': 64 * 1024,
+    'SESSION_TTL': 24 * 60 * 60,
+}
+
+# Attachment downloads (chat/downloads.py): bytes read per chunk, and an
+# optional front-proxy offload ('x-accel-redirect' for nginx, with an
+# internal location OFFLOAD_PREFIX aliased to MEDIA_ROOT, or 'x-sendfile').
+CHAT_DOWNLOADS = {
+    'CHUNK_SIZE': 256 * 1024,
+    'OFFLOAD': os.environ.get('CHAT_DOWNLOAD_OFFLOAD') or None,
+    'OFFLOAD_PREFIX': '/protected-media/',
+}
+
+# Image attachments (chat/thumbnails.py): thumbnails fitting each of SIZES
+# are made by WORKERS spawned processes after upload. Needs Pillow; without
+# it attachments simply have no thumbnails.
+CHAT_THUMBNAILS = {
+    'SIZES': (160, 480, 1280),
+    'QUALITY': 80,
+    'WORKERS': 2,
+}
+
+# Storage quotas in bytes (chat/storage.py); None means unlimited. Users are
+# charged for what they upload, teams for attachments in their channels.
+CHAT_STORAGE = {
+    'USER_QUOTA': None,
+    'TEAM_QUOTA': None,
+}
+
+# Authentication caches (chat/auth.py): validated tokens and their users are
+# kept for up to these many seconds, in LRUs of these sizes, by the WebSocket
+# middleware and the REST API. Saving or deleting a user drops it at once in
+# the same process; other workers see the change within USER_CACHE_TTL.
+# STATELESS builds request users from the token's claims with no query at
+# all; a deactivated user then keeps access until the token expires.
+CHAT_AUTH = {
+    'USER_CACHE_SIZE': 10000,
+    'USER_CACHE_TTL': 60,
+    'TOKEN_CACHE_SIZE': 10000,
+    'TOKEN_CACHE_TTL': 5 * 60,
+    'STATELESS': os.environ.get('CHAT_AUTH_STATELESS') == '1',
+}
+
+# Revoked sessions (chat/revocation.py): kept per process as an exact set,
+# or as a Bloom filter of BLOOM_CAPACITY entries confirmed against the
+# blacklist table. Each process picks up revocations made elsewhere within
+# SYNC_INTERVAL seconds, re-reading the last SYNC_OVERLAP seconds of the
+# table each time for rows committed late. Run purge_expired_tokens from cron.
+CHAT_REVOCATION = {
+    'MODE': 'set',
+    'SYNC_INTERVAL': 5,
+    'SYNC_OVERLAP': 60,
+    'BLOOM_CAPACITY': 100000,
+    'BLOOM_ERROR_RATE': 0.001,
+}
+
+# Password hashing for login and register (accounts/hashing.py): WORKERS
+# spawned processes hash; at most QUEUE more requests wait, and a request
+# waiting longer than TIMEOUT seconds gets 503 with Retry-After instead.
+ACCOUNTS_HASHING = {
+    'WORKERS': 2,
+    'QUEUE': 32,
+    'TIMEOUT': 10,
+}
+
+# Broadcast routing (chat/fanout.py). 'channel' joins every socket to a group
+# per team and channel. 'user' joins only user_{id} and sends each broadcast
+# to the members' user groups, BATCH_SIZE at a time, looked up in a
+# membership index of INDEX_SIZE entries. Connecting then costs the same for
+# any number of channels, and membership changes apply without reconnecting.
+# Removals apply at once, since sockets filter on their current channels.
+# Workers with no affected user connected refresh the index within INDEX_TTL.
+CHAT_FANOUT = {
+    'MODE': os.environ.get('CHAT_FANOUT_MODE', 'channel'),
+    'INDEX_SIZE': 10000,
+    'INDEX_TTL': 5,
+    'BATCH_SIZE': 100,
+}
+
+# WebSocket connections that send subscribe/unsubscribe get full events only
+# for the channels they subscribed to, and for the others at most one
+# channel_activity summary every SUMMARY_INTERVAL seconds
+# (chat/subscriptions.py).
+CHAT_SUBSCRIPTIONS = {
+    'SUMMARY_INTERVAL': 2.0,
+}
@@ -0,0 +1,38 @@
+"""
+Self-contained settings profile for benchmarks and local test runs.
+
+Uses SQLite and the in-memory channel layer so the chat stack can be
+exercised without PostgreSQL or Redis:
+
+    python manage.py migrate --settings=backend.settings_bench
+    python manage.py chat_bench --settings=backend.settings_bench
+"""
+
+from .settings import *  # noqa: F401,F403
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'bench.sqlite3',
+        'OPTIONS': {
+            'timeout': 20,
+        },
+    }
+}
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            'capacity': 1000,
+        },
+    },
+}
+
+# Preview tests and benchmarks fetch from servers on this machine
+CHAT_LINK_PREVIEW = {
+    **CHAT_LINK_PREVIEW,  # noqa: F405
+    'ALLOWED_NETWORKS': ['127.0.0.0/8', '::1/128'],
+}
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from . import auth, blobs, fanout, membership, storage  # noqa: F401  (connect their signal receivers)
+        from . import query_inspector
+        if query_inspector.enabled():
+            query_inspector.install()
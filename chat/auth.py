@@ -0,0 +1,221 @@
+"""
+Cached JWT authentication for the WebSocket middleware and the REST API.
+
+Every handshake and every API request used to verify the token's signature
+and load its user with a query. When clients reconnect all at once, that is
+thousands of identical lookups. Both results are now kept in process-local
+TTL+LRU caches (``chat.cache.TTLCache``):
+
+- Validated tokens, keyed by the whole encoded token. The jti alone is not
+  safe as a key, because a forged token can copy another token's jti. An
+  entry never outlives the token's own ``exp``.
+- Users, keyed by ``SIMPLE_JWT['USER_ID_FIELD']``. The ``post_save`` and
+  ``post_delete`` receivers below drop a user when it changes, and again
+  when the transaction commits. That second drop covers a concurrent lookup
+  that read the old row. Other workers, and changes that bypass signals
+  (``QuerySet.update``), catch up within ``USER_CACHE_TTL``.
+
+Callers get a copy of the cached user, so per-request changes do not leak
+into other requests. The checks ``JWTAuthentication`` makes (active user,
+revoked-token claim) are applied on every request, cached or not. Set a
+cache size to 0 to disable it.
+
+With ``STATELESS`` on, a token that carries a ``username`` claim (see
+``token_for``) skips the user lookup altogether. The user is a
+``ClaimsUser`` built from the claims, and the rest of its row is loaded on
+first use. The token is then the only proof: a deactivated or renamed user
+keeps working until the token expires. Tokens without the claim, issued
+before it existed, take the cached path.
+
+Revoked sessions (``chat.revocation``) are rejected in every mode, before
+the user is resolved.
+"""
+import copy
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from . import revocation
+from .cache import TTLCache
+from .models import ClaimsUser
+
+DEFAULTS = {
+    'USER_CACHE_SIZE': 10000,
+    'USER_CACHE_TTL': 60,
+    'TOKEN_CACHE_SIZE': 10000,
+    'TOKEN_CACHE_TTL': 5 * 60,
+    # Trust the claims of tokens from token_for() instead of loading the user
+    'STATELESS': False,
+}
+
+USERNAME_CLAIM = 'username'
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_AUTH', {})}
+
+
+_caches = None
+
+
+def caches():
+    """``(users, tokens)``, built from the current settings on first use."""
+    global _caches
+    if _caches is None:
+        options = config()
+        _caches = (TTLCache(options['USER_CACHE_SIZE'], options['USER_CACHE_TTL']),
+                   TTLCache(options['TOKEN_CACHE_SIZE'], options['TOKEN_CACHE_TTL']))
+    return _caches
+
+
+def clear():
+    global _caches
+    _caches = None
+
+
+@receiver(setting_changed)
+def settings_changed(sender, setting, **kwargs):
+    if setting in ('CHAT_AUTH', 'SIMPLE_JWT'):
+        clear()
+
+
+def validate_token(raw_token):
+    """The validated token object for ``raw_token``; raises ``InvalidToken``."""
+    if isinstance(raw_token, bytes):
+        raw_token = raw_token.decode('latin-1')
+    tokens = caches()[1]
+    token = tokens.get(raw_token)
+    if token is None:
+        # Tries each of AUTH_TOKEN_CLASSES and raises InvalidToken
+        token = JWTAuthentication().get_validated_token(raw_token)
+        lifetime = token.get('exp', 0) - time.time()
+        if lifetime > 0:
+            tokens.set(raw_token, token, ttl=min(lifetime, tokens.ttl))
+    return token
+
+
+def get_user(user_id):
+    """A copy of the user with ``USER_ID_FIELD`` ``user_id``, or None."""
+    users = caches()[0]
+    # Tokens carry the id as a string
+    user_id = str(user_id)
+    user = users.get(user_id)
+    if user is None:
+        User = get_user_model()
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+        if user is None:
+            return None
+        users.set(user_id, user)
+    return copy.copy(user)
+
+
+async def aget_user(user_id):
+    """``get_user`` without a thread hop when the user is cached."""
+    user = caches()[0].get(str(user_id))
+    if user is not None:
+        return copy.copy(user)
+    return await database_sync_to_async(get_user)(user_id)
+
+
+def token_user_id(token):
+    try:
+        return token[api_settings.USER_ID_CLAIM]
+    except KeyError as e:
+        raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+
+def check_user(user, token):
+    """Raise ``AuthenticationFailed`` as ``JWTAuthentication.get_user`` would."""
+    if user is None:
+        raise AuthenticationFailed(_("User not found"), code="user_not_found")
+    if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+        raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+    if (api_settings.CHECK_REVOKE_TOKEN
+            and token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password)):
+        raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+    return user
+
+
+def token_for(user):
+    """A refresh token for ``user``; its access tokens carry the claims ``STATELESS`` and revocation need."""
+    refresh = RefreshToken.for_user(user)
+    refresh[USERNAME_CLAIM] = user.get_username()
+    refresh[revocation.SESSION_CLAIM] = refresh[api_settings.JTI_CLAIM]
+    return refresh
+
+
+def claims_user(token):
+    """A ``ClaimsUser`` for ``token`` in ``STATELESS`` mode, else None."""
+    if USERNAME_CLAIM not in token or not config()['STATELESS']:
+        return None
+    return ClaimsUser.from_claims(token_user_id(token), token[USERNAME_CLAIM])
+
+
+def revoked():
+    return AuthenticationFailed(_("Token has been revoked"), code="token_revoked")
+
+
+def user_for_token(token):
+    if revocation.is_revoked(token):
+        raise revoked()
+    return claims_user(token) or check_user(get_user(token_user_id(token)), token)
+
+
+async def auser_for_token(token):
+    if await revocation.ais_revoked(token):
+        raise revoked()
+    return claims_user(token) or check_user(await aget_user(token_user_id(token)), token)
+
+
+async def authenticate_token(raw_token):
+    """The user ``raw_token`` belongs to; raises ``AuthenticationFailed``."""
+    return await auser_for_token(validate_token(raw_token))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """``JWTAuthentication`` backed by the token and user caches."""
+
+    def get_validated_token(self, raw_token):
+        return validate_token(raw_token)
+
+    def get_user(self, validated_token):
+        return user_for_token(validated_token)
+
+    async def aauthenticate(self, request):
+        """``authenticate`` for async views; only a cache miss touches the database."""
+        header = self.get_header(request)
+        raw_token = self.get_raw_token(header) if header is not None else None
+        if raw_token is None:
+            return None
+        token = validate_token(raw_token)
+        return await auser_for_token(token), token
+
+
+def forget_user(user):
+    key = str(getattr(user, api_settings.USER_ID_FIELD))
+    caches()[0].pop(key)
+    transaction.on_commit(lambda: caches()[0].pop(key))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_save, sender=ClaimsUser)
+def user_saved(sender, instance, **kwargs):
+    forget_user(instance)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=ClaimsUser)
+def user_deleted(sender, instance, **kwargs):
+    forget_user(instance)
@@ -0,0 +1,759 @@
+"""
+Offline load generation for the chat WebSocket stack.
+
+Everything here runs in-process: clients are ``WebsocketCommunicator``
+instances talking to the same ASGI application ``backend.asgi`` serves,
+so the numbers cover JWT auth, ``ChatConsumer`` dispatch, the ORM and the
+configured channel layer. Pair it with ``backend.settings_bench`` to run
+without Redis or PostgreSQL.
+
+Other scenarios measure single components in isolation, such as the link
+preview parsers and attachment download responses.
+"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import authenticate
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIHandler
+from django.http import FileResponse
+from django.test import RequestFactory, override_settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts import hashing
+
+from . import auth, downloads, fanout
+from .middleware import JwtAuthMiddleware
+from .models import Channel, FileAttachment, Message, Team
+from .routing import websocket_urlpatterns
+from .utils import extract_link_preview, parse_link_preview
+
+ACTION_TYPES = ('channel_message', 'reaction', 'edit', 'history')
+
+DEFAULT_MIX = {'channel_message': 70, 'reaction': 15, 'edit': 10, 'history': 5}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values`` (``pct`` in 0-100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(samples):
+    """Summarise latency samples given in seconds as milliseconds."""
+    if not samples:
+        return {'count': 0, 'p50_ms': None, 'p99_ms': None, 'mean_ms': None, 'max_ms': None}
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
+
+
+def parse_mix(value):
+    """Parse ``channel_message=70,reaction=15`` into a weight dict."""
+    if not value:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ACTION_TYPES:
+            raise ValueError(f"Unknown action type in mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class QueryCounter:
+    """Counts SQL statements on every database connection while installed.
+
+    Connections are thread-local: the wrapper is attached to the calling
+    thread's connections on entry, to any connection opened later, and
+    ``attach_current_thread`` covers threads whose connection is already
+    open (such as the executor behind ``database_sync_to_async``).
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def _attach(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        self._attach(connection)
+
+    def attach_current_thread(self):
+        for connection in connections.all():
+            self._attach(connection)
+
+    def detach_current_thread(self):
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    def __enter__(self):
+        self.attach_current_thread()
+        connection_created.connect(self._on_connection_created)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self._on_connection_created)
+        self.detach_current_thread()
+
+
+@dataclass
+class BenchDataset:
+    prefix: str
+    teams: list
+    users: list
+    channels: list
+    # channel id -> list of member user ids
+    channel_members: dict
+    # user id -> id of the single team the user belongs to
+    user_teams: dict = field(default_factory=dict)
+    # (channel id, user id) -> ids of seeded messages that user sent there
+    authored: dict = field(default_factory=dict)
+    # channel id -> ids of all seeded messages
+    history: dict = field(default_factory=dict)
+
+    def channels_for(self, user_id):
+        return [cid for cid, members in self.channel_members.items() if user_id in members]
+
+    def teardown(self):
+        Team.objects.filter(id__in=[team.id for team in self.teams]).delete()
+        User.objects.filter(id__in=[user.id for user in self.users]).delete()
+
+
+def seed_dataset(users=20, teams=2, channels=4, history=0, prefix=None):
+    """Create ``users`` users spread over ``teams`` teams and ``channels`` channels.
+
+    Each user belongs to exactly one team (``UserPresence`` allows a single
+    row per user) and every channel contains all members of its team, like
+    channels created through ``create_channel``. ``history`` messages are
+    pre-seeded per channel, authored round-robin by the channel members.
+    """
+    prefix = prefix or f"bench-{uuid.uuid4().hex[:8]}"
+    teams = max(1, teams)
+    channels = max(teams, channels)
+
+    created_users = User.objects.bulk_create([
+        User(username=f"{prefix}-u{i}", email=f"{prefix}-u{i}@bench.invalid", password='!')
+        for i in range(users)
+    ])
+    created_teams = [Team.objects.create(name=f"{prefix}-t{i}") for i in range(teams)]
+
+    team_members = {team.id: [] for team in created_teams}
+    for i, user in enumerate(created_users):
+        team_members[created_teams[i % teams].id].append(user.id)
+    Team.members.through.objects.bulk_create([
+        Team.members.through(team_id=team_id, user_id=user_id)
+        for team_id, user_ids in team_members.items()
+        for user_id in user_ids
+    ])
+
+    created_channels = Channel.objects.bulk_create([
+        Channel(name=f"{prefix}-c{i}", team=created_teams[i % teams])
+        for i in range(channels)
+    ])
+    channel_members = {channel.id: list(team_members[channel.team_id]) for channel in created_channels}
+    Channel.members.through.objects.bulk_create([
+        Channel.members.through(channel_id=channel_id, user_id=user_id)
+        for channel_id, user_ids in channel_members.items()
+        for user_id in user_ids
+    ])
+
+    dataset = BenchDataset(
+        prefix=prefix,
+        teams=created_teams,
+        users=created_users,
+        channels=created_channels,
+        channel_members=channel_members,
+        user_teams={user_id: team_id for team_id, user_ids in team_members.items() for user_id in user_ids},
+    )
+
+    if history:
+        pending = []
+        for channel in created_channels:
+            members = channel_members[channel.id]
+            if not members:
+                continue
+            for i in range(history):
+                pending.append(Message(
+                    channel=channel,
+                    sender_id=members[i % len(members)],
+                    content=f"{prefix} seed {i}",
+                ))
+        for message in Message.objects.bulk_create(pending, batch_size=500):
+            dataset.history.setdefault(message.channel_id, []).append(message.id)
+            dataset.authored.setdefault((message.channel_id, message.sender_id), []).append(message.id)
+
+    return dataset
+
+
+def build_application():
+    """The websocket half of ``backend.asgi.application``."""
+    return JwtAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+
+class LoadClient:
+    """One simulated user connection.
+
+    A reader task drains the socket and resolves futures registered by
+    ``request()``; replies are matched on a key derived from the payload
+    so concurrent broadcasts from other clients do not confuse it.
+    """
+
+    def __init__(self, application, user, dataset, stats):
+        self.user = user
+        self.dataset = dataset
+        self.stats = stats
+        self.channel_ids = dataset.channels_for(user.id)
+        token = str(AccessToken.for_user(user))
+        self.communicator = WebsocketCommunicator(application, f"/ws/chat/?token={token}")
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.reader = None
+        self.counter = 0
+
+    async def connect(self, timeout=30):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        if not connected:
+            raise RuntimeError(f"Connection refused for {self.user.username}")
+        self.reader = asyncio.ensure_future(self._read())
+        # The consumer broadcasts our own presence once it has joined its
+        # groups, which is the earliest point fan-out can reach us.
+        await asyncio.wait_for(self.ready.wait(), timeout)
+
+    async def close(self):
+        if self.reader:
+            self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+        await self.communicator.disconnect()
+
+    async def _read(self):
+        while True:
+            payload = await self.communicator.receive_json_from(timeout=3600)
+            received_at = time.perf_counter()
+            key = self._reply_key(payload)
+            if key is None:
+                continue
+            if key[0] == 'message':
+                sent_at = self.stats.sent_at.get(key[1])
+                if sent_at is not None:
+                    self.stats.delivery.append(received_at - sent_at)
+            future = self.pending.pop(key, None)
+            if future and not future.done():
+                future.set_result(received_at)
+
+    def _reply_key(self, payload):
+        kind = payload.get('type')
+        if kind == 'user_presence':
+            if payload.get('user_id') == self.user.id and payload.get('status') == 'online':
+                self.ready.set()
+            return None
+        if kind in ('channels', 'direct'):
+            return ('message', payload.get('content'))
+        if kind == 'reaction_update':
+            return ('reaction', payload.get('message_id'), payload.get('reaction'))
+        if kind == 'message_edited':
+            return ('edit', payload.get('message_id'), payload.get('content'))
+        if kind == 'channel_messages':
+            return ('history', payload.get('channel_id'))
+        return None
+
+    def _next_token(self):
+        self.counter += 1
+        return f"{self.user.id}-{self.counter}-{uuid.uuid4().hex[:6]}"
+
+    def build_action(self, action, rng):
+        """Return ``(frame, reply_key)`` for ``action`` or ``None`` if not possible."""
+        if not self.channel_ids:
+            return None
+        channel_id = rng.choice(self.channel_ids)
+        token = self._next_token()
+        if action == 'channel_message':
+            content = f"bench {token}"
+            frame = {'message_type': 'channel_message', 'channel': channel_id, 'content': content}
+            return frame, ('message', content)
+        if action == 'reaction':
+            history = self.dataset.history.get(channel_id)
+            if not history:
+                return None
+            message_id = rng.choice(history)
+            frame = {'message_type': 'reaction', 'message_id': message_id, 'reaction': token}
+            return frame, ('reaction', message_id, token)
+        if action == 'edit':
+            authored = self.dataset.authored.get((channel_id, self.user.id))
+            if not authored:
+                return None
+            message_id = rng.choice(authored)
+            content = f"edited {token}"
+            frame = {'message_type': 'edit_message', 'message_id': message_id, 'content': content}
+            return frame, ('edit', message_id, content)
+        if action == 'history':
+            frame = {'message_type': 'get_channel_messages', 'channel_id': channel_id}
+            return frame, ('history', channel_id)
+        raise ValueError(f"Unknown action: {action}")
+
+    async def request(self, frame, key, timeout):
+        """Send ``frame`` and wait for the matching reply; returns the round trip in seconds."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        sent_at = time.perf_counter()
+        if key[0] == 'message':
+            self.stats.sent_at[key[1]] = sent_at
+        await self.communicator.send_json_to(frame)
+        try:
+            received_at = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(key, None)
+        return received_at - sent_at
+
+
+class LoadStats:
+    def __init__(self):
+        self.sent_at = {}
+        self.delivery = []
+        self.round_trip = {action: [] for action in ACTION_TYPES}
+        self.completed = {action: 0 for action in ACTION_TYPES}
+        self.errors = {action: 0 for action in ACTION_TYPES}
+        self.skipped = 0
+
+
+async def _connect_all(application, dataset, stats, timeout):
+    clients = [LoadClient(application, user, dataset, stats) for user in dataset.users]
+    connect_times = []
+    for client in clients:
+        started = time.perf_counter()
+        await client.connect(timeout=timeout)
+        connect_times.append(time.perf_counter() - started)
+    return clients, connect_times
+
+
+async def _calibrate(clients, mix, samples, timeout, counter):
+    """Run each action type serially and count the queries it costs."""
+    rng = random.Random(0)
+    queries = {}
+    for action in mix:
+        done = 0
+        before = counter.count
+        for client in clients:
+            if done >= samples:
+                break
+            for _ in range(samples - done):
+                built = client.build_action(action, rng)
+                if built is None:
+                    break
+                await client.request(*built, timeout=timeout)
+                done += 1
+        if done:
+            queries[action] = round((counter.count - before) / done, 2)
+    return queries
+
+
+async def _drive(client, mix, actions, timeout, rng):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    stats = client.stats
+    for _ in range(actions):
+        action = rng.choices(names, weights)[0]
+        built = client.build_action(action, rng)
+        if built is None:
+            stats.skipped += 1
+            continue
+        try:
+            stats.round_trip[action].append(await client.request(*built, timeout=timeout))
+            stats.completed[action] += 1
+        except asyncio.TimeoutError:
+            stats.errors[action] += 1
+
+
+async def run_load(dataset, mix, actions_per_user=20, calibration=10, timeout=10, seed=0):
+    """Connect every dataset user, calibrate query costs, then drive the mix concurrently."""
+    application = build_application()
+    stats = LoadStats()
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    clients, connect_times = await _connect_all(application, dataset, stats, timeout)
+    connected, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    try:
+        with QueryCounter() as counter:
+            await database_sync_to_async(counter.attach_current_thread)()
+            queries = await _calibrate(clients, mix, calibration, timeout, counter)
+            stats.sent_at.clear()
+            stats.delivery.clear()
+
+            rng = random.Random(seed)
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                _drive(client, mix, actions_per_user, timeout, random.Random(rng.random()))
+                for client in clients
+            ])
+            elapsed = time.perf_counter() - started
+            total_queries = counter.count
+            await database_sync_to_async(counter.detach_current_thread)()
+    finally:
+        for client in clients:
+            await client.close()
+
+    completed = sum(stats.completed.values())
+    return {
+        'connections': {
+            'count': len(clients),
+            'connect': summarize(connect_times),
+            'memory_per_connection_bytes': int((connected - baseline) / max(1, len(clients))),
+        },
+        'throughput': {
+            'elapsed_s': round(elapsed, 3),
+            'actions': completed,
+            'errors': sum(stats.errors.values()),
+            'skipped': stats.skipped,
+            'msgs_per_sec': round(completed / elapsed, 2) if elapsed else None,
+            'deliveries': len(stats.delivery),
+            'deliveries_per_sec': round(len(stats.delivery) / elapsed, 2) if elapsed else None,
+        },
+        'latency': {
+            'delivery': summarize(stats.delivery),
+            'round_trip': {action: summarize(samples) for action, samples in stats.round_trip.items() if action in mix},
+        },
+        'queries_per_action': queries,
+        'queries_total': total_queries,
+        'errors_by_action': {action: count for action, count in stats.errors.items() if action in mix},
+    }
+
+
+def ws_scenario(options):
+    """Fan-out benchmark: N users over T teams and C channels driving a traffic mix."""
+    dataset = seed_dataset(
+        users=options['users'],
+        teams=options['teams'],
+        channels=options['channels'],
+        history=options['history'],
+    )
+    connections.close_all()
+    try:
+        result = asyncio.run(run_load(
+            dataset,
+            parse_mix(options['mix']),
+            actions_per_user=options['actions'],
+            calibration=options['calibration'],
+            timeout=options['timeout'],
+            seed=options['seed'],
+        ))
+    finally:
+        dataset.teardown()
+    return result
+
+
+def fixture_page(size_kb):
+    """An HTML page of about ``size_kb`` KiB: a typical head, then a long body."""
+    head = (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        '<title>Benchmark fixture page</title>'
+        '<meta name="description" content="A large page used to benchmark link previews">'
+        '<meta property="og:image" content="/static/cover.png">'
+        '<meta property="og:site_name" content="Bench">'
+        + '<link rel="stylesheet" href="/static/site.css">' * 20
+        + '</head><body>'
+    )
+    paragraph = '<div class="post"><p>' + 'Lorem ipsum dolor sit amet, consectetur. ' * 20 + '</p></div>\n'
+    count = max(0, size_kb * 1024 - len(head)) // len(paragraph)
+    return (head + paragraph * count + '</body></html>').encode('utf-8')
+
+
+def measure(func, repeat):
+    """Median wall time and peak traced allocation of ``func()`` over ``repeat`` runs."""
+    timings = []
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    timings.sort()
+    return result, {
+        'median_ms': round(timings[len(timings) // 2] * 1000, 3),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def preview_scenario(options):
+    """Full-body BeautifulSoup parsing vs streaming head-only parsing of large pages."""
+    url = 'https://bench.example/page'
+    chunk_size = 64 * 1024
+    results = {}
+    for size_kb in options['page_sizes']:
+        body = fixture_page(size_kb)
+
+        def chunks():
+            for offset in range(0, len(body), chunk_size):
+                yield body[offset:offset + chunk_size]
+
+        # The previous fetcher decoded response.text and parsed all of it.
+        full, full_stats = measure(lambda: parse_link_preview(url, body.decode('utf-8')), options['repeat'])
+        head, head_stats = measure(lambda: extract_link_preview(url, chunks()), options['repeat'])
+        results[f"{size_kb}KiB"] = {
+            'bytes': len(body),
+            'beautifulsoup_full_body': full_stats,
+            'streaming_head_only': head_stats,
+            'speedup': round(full_stats['median_ms'] / head_stats['median_ms'], 1) if head_stats['median_ms'] else None,
+            'same_preview': full == head,
+        }
+    return results
+
+
+def stream_response(response):
+    """Send ``response`` through Django's ASGI handler; returns (first-byte s, total s, bytes)."""
+    sent = {'bytes': 0, 'first': None}
+
+    async def send(message):
+        if message['type'] == 'http.response.body' and message.get('body'):
+            if sent['first'] is None:
+                sent['first'] = time.perf_counter()
+            sent['bytes'] += len(message['body'])
+
+    async def run():
+        started = time.perf_counter()
+        await ASGIHandler().send_response(response, send)
+        return sent['first'] - started, time.perf_counter() - started, sent['bytes']
+
+    return asyncio.run(run())
+
+
+def download_scenario(options):
+    """FileResponse vs the async, chunked download response, sent through the ASGI handler."""
+    factory = RequestFactory()
+    results = {}
+    with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+        for size_kb in options['file_sizes']:
+            name = f"bench-{size_kb}.bin"
+            with open(os.path.join(media_root, name), 'wb') as f:
+                f.write(os.urandom(size_kb * 1024))
+            attachment = FileAttachment(file=name, original_filename=name, content_type='application/octet-stream',
+                                        size=size_kb * 1024)
+            paths = {
+                # The previous download_file view
+                'file_response': lambda: FileResponse(open(attachment.file.path, 'rb'),
+                                                      content_type=attachment.content_type),
+                'async_chunked': lambda: downloads.attachment_response(factory.get('/'), attachment),
+            }
+            report = {'bytes': size_kb * 1024}
+            for label, build in paths.items():
+                (first_byte, total, sent), stats = measure(lambda: stream_response(build()), options['repeat'])
+                if sent != size_kb * 1024:
+                    raise ValueError(f"{label} sent {sent} of {size_kb * 1024} bytes")
+                report[label] = {
+                    **stats,
+                    'first_byte_ms': round(first_byte * 1000, 3),
+                    'mib_per_s': round(sent / 1024 / 1024 / total, 1) if total else None,
+                }
+            ranged = factory.get('/', HTTP_RANGE=f"bytes={size_kb * 512}-")
+            (_, _, sent), stats = measure(lambda: stream_response(downloads.attachment_response(ranged, attachment)),
+                                          options['repeat'])
+            report['async_chunked_second_half'] = {**stats, 'bytes_sent': sent}
+            results[f"{size_kb}KiB"] = report
+    return results
+
+
+async def _handshakes(application, tokens, reconnects, counter):
+    """Connect and disconnect each token ``reconnects`` times; returns (latencies, queries)."""
+    samples = []
+    before = counter.count
+    for _ in range(reconnects):
+        for token in tokens:
+            communicator = WebsocketCommunicator(application, f"/ws/chat/?token={token}")
+            started = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=30)
+            samples.append(time.perf_counter() - started)
+            if not connected:
+                raise RuntimeError("Handshake refused")
+            await communicator.disconnect()
+    return samples, counter.count - before
+
+
+def handshake_scenario(options):
+    """WebSocket handshakes in a reconnect storm: no auth caches, caches, and claims-only users."""
+    dataset = seed_dataset(users=options['users'], teams=options['teams'], channels=options['channels'])
+    tokens = [str(auth.token_for(user).access_token) for user in dataset.users]
+    connections.close_all()
+
+    async def accept(scope, receive, send):
+        # Stands in for the consumer, to time authentication alone
+        await receive()
+        await send({'type': 'websocket.accept'})
+        await receive()
+
+    variants = {
+        'uncached': {'USER_CACHE_SIZE': 0, 'TOKEN_CACHE_SIZE': 0},
+        'cached': {},
+        'stateless': {'STATELESS': True},
+    }
+    results = {}
+    try:
+        for label, cache_options in variants.items():
+            with override_settings(CHAT_AUTH={**auth.DEFAULTS, **cache_options}):
+                report = {}
+                for target, application in (('auth_only', JwtAuthMiddleware(accept)),
+                                            ('full_connect', build_application())):
+                    auth.clear()
+
+                    async def run():
+                        with QueryCounter() as counter:
+                            await database_sync_to_async(counter.attach_current_thread)()
+                            try:
+                                return await _handshakes(application, tokens, options['reconnects'], counter)
+                            finally:
+                                await database_sync_to_async(counter.detach_current_thread)()
+
+                    samples, queries = asyncio.run(run())
+                    report[target] = {**summarize(samples),
+                                      'queries_per_handshake': round(queries / len(samples), 2)}
+                results[label] = report
+    finally:
+        dataset.teardown()
+    return results
+
+
+def _timed_login(login, username, password):
+    started = time.perf_counter()
+    try:
+        return login(username, password) is not None, time.perf_counter() - started
+    except hashing.HashingBusy:
+        return None, time.perf_counter() - started
+    finally:
+        connections.close_all()
+
+
+async def _login_burst(login, usernames, password, concurrency, probe, rounds):
+    """Run the logins on ``concurrency`` threads while ``probe`` round-trips chat messages."""
+    rng = random.Random(0)
+    baseline = [await probe.request(*probe.build_action('channel_message', rng), timeout=30) for _ in range(rounds)]
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(concurrency) as threads:
+        started = time.perf_counter()
+        burst = asyncio.gather(*[loop.run_in_executor(threads, _timed_login, login, username, password)
+                                 for username in usernames])
+        during = []
+        while not burst.done():
+            during.append(await probe.request(*probe.build_action('channel_message', rng), timeout=30))
+        outcomes = await burst
+        elapsed = time.perf_counter() - started
+
+    succeeded = [latency for ok, latency in outcomes if ok]
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'logins_per_sec': round(len(succeeded) / elapsed, 2),
+        'failed': sum(ok is False for ok, _ in outcomes),
+        'rejected_busy': sum(ok is None for ok, _ in outcomes),
+        'login_latency': summarize(succeeded),
+        'chat_round_trip_idle': summarize(baseline),
+        'chat_round_trip_during_logins': summarize(during),
+    }
+
+
+def login_scenario(options):
+    """A burst of logins: Django's inline hashing vs the hashing pool, with chat traffic alongside."""
+    dataset = seed_dataset(users=options['users'], teams=options['teams'], channels=options['channels'])
+    password = 'bench-password'
+    User.objects.filter(id__in=[user.id for user in dataset.users]).update(password=make_password(password))
+    usernames = [dataset.users[i % len(dataset.users)].username for i in range(options['logins'])]
+    connections.close_all()
+
+    variants = {
+        'inline': lambda username, password: authenticate(username=username, password=password),
+        'pool': hashing.authenticate,
+    }
+    results = {}
+    try:
+        # Start the workers outside the timed runs
+        hashing.make_password(password)
+        for label, login in variants.items():
+            async def run():
+                probe = LoadClient(build_application(), dataset.users[0], dataset, LoadStats())
+                await probe.connect()
+                try:
+                    return await _login_burst(login, usernames, password, options['concurrency'], probe,
+                                              options['calibration'])
+                finally:
+                    await probe.close()
+
+            results[label] = asyncio.run(run())
+    finally:
+        hashing.shutdown()
+        dataset.teardown()
+    results['pool_workers'] = hashing.config()['WORKERS']
+    return results
+
+
+def fanout_scenario(options):
+    """Channel groups vs user routing (``chat.fanout``) as each user's channel count grows."""
+    results = {}
+    for count in options['channel_counts']:
+        dataset = seed_dataset(users=options['users'], teams=1, channels=count, history=options['history'])
+        connections.close_all()
+        report = {}
+        try:
+            for mode in ('channel', 'user'):
+                with override_settings(CHAT_FANOUT={**fanout.DEFAULTS, 'MODE': mode}):
+                    result = asyncio.run(run_load(
+                        dataset,
+                        {'channel_message': 1},
+                        actions_per_user=options['actions'],
+                        calibration=options['calibration'],
+                        timeout=options['timeout'],
+                        seed=options['seed'],
+                    ))
+                report[mode] = {
+                    'connect': result['connections']['connect'],
+                    'memory_per_connection_bytes': result['connections']['memory_per_connection_bytes'],
+                    'deliveries_per_sec': result['throughput']['deliveries_per_sec'],
+                    'delivery': result['latency']['delivery'],
+                    'queries_per_message': result['queries_per_action'].get('channel_message'),
+                }
+        finally:
+            dataset.teardown()
+        results[f"{count}_channels"] = report
+    return results
+
+
+SCENARIOS = {
+    'ws': ws_scenario,
+    'preview': preview_scenario,
+    'download': download_scenario,
+    'handshake': handshake_scenario,
+    'login': login_scenario,
+    'fanout': fanout_scenario,
+}
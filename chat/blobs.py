@@ -0,0 +1,146 @@
+"""
+Content-addressed attachment storage.
+
+Every file is stored once, under the SHA-256 of its content, at
+``blobs/ab/cd/<sha256>``. The two levels of sharding keep any one directory
+to a few hundred entries. Each ``FileAttachment`` points at its
+``StoredBlob``, and ``StoredBlob.refs`` counts them. Uploading a file that
+is already stored adds a reference and discards the new copy. Deleting the
+last attachment deletes the blob, its file and its thumbnails, unless the
+same content was uploaded again in the meantime.
+
+The hash is computed while the upload is written to a temporary file next
+to the blob directory, and the file is then renamed into place, so storing
+reads and writes each byte once. Attachments from before this scheme have
+no blob. ``dedup_attachments`` hashes them, moves their files into the blob
+layout and merges duplicates.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import storage
+from .models import FileAttachment, StoredBlob, thumb_name
+
+BLOB_DIR = 'blobs'
+TEMP_DIR = os.path.join(BLOB_DIR, 'tmp')
+
+
+def blob_name(digest):
+    """Storage name of the blob with this SHA-256, sharded as ``blobs/ab/cd/<digest>``."""
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest)
+
+
+def temp_path():
+    path = default_storage.path(os.path.join(TEMP_DIR, uuid.uuid4().hex))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def write_temp(chunks):
+    """Write ``chunks`` to a temporary file, hashing as it goes; returns ``(path, sha256, size)``."""
+    path = temp_path()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'xb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+    except BaseException:
+        _remove(path)
+        raise
+    return path, digest.hexdigest(), size
+
+
+def file_sha256(path, block_size=64 * 1024):
+    """SHA-256 of the file at ``path``, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def place(path, digest):
+    """Move the file at ``path`` into the blob layout, unless that content is already stored."""
+    final = default_storage.path(blob_name(digest))
+    if os.path.exists(final):
+        _remove(path)
+    else:
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        os.replace(path, final)
+
+
+def acquire(digest, size):
+    """Add a reference to the blob with this SHA-256, creating its row if needed."""
+    while True:
+        blob, _ = StoredBlob.objects.get_or_create(sha256=digest, defaults={'size': size})
+        # Waits on the row lock of a concurrent removal; if that removal
+        # deleted the row, create it again.
+        if StoredBlob.objects.filter(pk=blob.pk).update(refs=F('refs') + 1):
+            return blob
+
+
+def adopt(path, digest, size, **fields):
+    """Create a ``FileAttachment`` for the already-hashed file at ``path``, which is moved or dropped."""
+    try:
+        with transaction.atomic():
+            blob = acquire(digest, size)
+            attachment = FileAttachment.objects.create(file=blob_name(digest), blob=blob, size=size, **fields)
+            storage.add_user_bytes(attachment.uploaded_by_id, size)
+    except BaseException:
+        _remove(path)
+        raise
+    # Placed after the reference is committed: a removal of the same blob
+    # either saw the reference and kept the file, or deleted the row and
+    # the file before ``acquire`` could create it again.
+    place(path, digest)
+    return attachment
+
+
+def store(chunks, **fields):
+    """Store an uploaded file given as an iterable of byte chunks; returns its ``FileAttachment``."""
+    path, digest, size = write_temp(chunks)
+    return adopt(path, digest, size, **fields)
+
+
+def release(blob_id):
+    """Drop one reference; once the last one is committed, the blob and its file are deleted."""
+    with transaction.atomic():
+        StoredBlob.objects.filter(pk=blob_id, refs__gt=0).update(refs=F('refs') - 1)
+        digest = StoredBlob.objects.filter(pk=blob_id, refs=0).values_list('sha256', flat=True).first()
+    if digest is not None:
+        transaction.on_commit(lambda: remove(blob_id, digest))
+
+
+def remove(blob_id, digest):
+    """Delete the blob row, its file and thumbnails if it still has no references."""
+    with transaction.atomic():
+        # The file goes while the row is locked by this delete, so an upload
+        # of the same content waits in ``acquire`` and places a new copy.
+        if not StoredBlob.objects.filter(pk=blob_id, refs=0).delete()[0]:
+            return
+        _remove(default_storage.path(blob_name(digest)))
+        shutil.rmtree(os.path.dirname(default_storage.path(thumb_name(digest, 0))), ignore_errors=True)
+
+
+@receiver(post_delete, sender=FileAttachment)
+def release_blob(sender, instance, **kwargs):
+    if instance.blob_id is not None:
+        release(instance.blob_id)
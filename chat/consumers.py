@@ -6,10 +6,21 @@ from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
 from .models import FileAttachment, Team, Channel, Message, DirectMessageChannel, UserPresence
 from asgiref.sync import async_to_sync
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from .recorder import get_recorder
+from . import query_inspector
+from . import storage
+from . import unfurl
+from . import fanout
+from . import membership
+from . import subscriptions
 # from asgiref.sync import sync_to_async
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
+    trace = None
+    summary_task = None
+
     async def connect(self):
         self.user = self.scope["user"]
         print(f"User connecting: {self.user}")
@@ -22,73 +33,90 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         print("Connection accepted!")
         await self.accept()
 
-        self.teams = await self.get_user_teams()
-        self.channels = await self.get_user_channels()
+        self.trace = get_recorder()
+        if self.trace:
+            self.trace_id = self.trace.new_connection_id()
+            self.trace.write(self.trace_id, self.user.id, 'connect')
+
+        self.subscriptions = subscriptions.Subscriptions()
+
+        # With user routing only user_{id} is joined; broadcasts find the
+        # user through chat.fanout instead of team and channel groups
+        self.user_routing = fanout.user_routing()
+        # Ids of the user's teams and channels, kept current by membership_changed
+        self.teams = set(await self.get_user_team_ids())
+        self.channels = set(await self.get_user_channel_ids())
 
         print(f"User teams: {self.teams}")
         print(f"User channels: {self.channels}")
 
-        if self.is_team_member():
-            await self.channel_layer.group_add(f"user_{self.user.id}", self.channel_name)
-            print(f"User {self.user.id} added to group user_{self.user.id}")
+        # Joined even without a team, so the user hears about joining one
+        await self.channel_layer.group_add(f"user_{self.user.id}", self.channel_name)
+        print(f"User {self.user.id} added to group user_{self.user.id}")
 
-            for team in self.teams:
-                print(f"Adding user to team_{team.id}")
-                await self.channel_layer.group_add(f"team_{team.id}", self.channel_name)
+        if not self.user_routing:
+            for team_id in self.teams:
+                print(f"Adding user to team_{team_id}")
+                await self.channel_layer.group_add(f"team_{team_id}", self.channel_name)
+
+            for channel_id in self.channels:
+                print(f"Adding user to channel_{channel_id}")
+                await self.channel_layer.group_add(f"channel_{channel_id}", self.channel_name)
+
+        for team_id in self.teams:
+            await self.set_user_online(team_id)
 
-            for channel in self.channels:
-                print(f"Adding user to channel_{channel.id}")
-                await self.channel_layer.group_add(f"channel_{channel.id}", self.channel_name)
-        
-        for team in self.teams:
-            await self.set_user_online(team.id)
-        
         # Broadcast to all users in the team that this user is now online
-        for team in self.teams:
-            await self.channel_layer.group_send(
-                f"team_{team.id}",
-                {
-                    "type": "user_presence_update",
-                    "user_id": self.user.id,
-                    "status": "online"
-                }
-            )
+        await self.announce_presence(self.teams, "online")
 
     async def disconnect(self, close_code):
         if not hasattr(self, 'user') or self.user.is_anonymous:
             return
 
-        for team in self.teams:
-            await self.set_user_offline(team.id)
+        if self.trace:
+            self.trace.write(self.trace_id, self.user.id, 'disconnect')
 
-        for team in self.teams:
-            await self.channel_layer.group_send(
-                f"team_{team.id}",
-                {
-                    "type": "user_presence_update",
-                    "user_id": self.user.id,
-                    "status": "offline"
-                }
-            )
-        
+        if self.summary_task:
+            self.summary_task.cancel()
+
+        for team_id in self.teams:
+            await self.set_user_offline(team_id)
+
+        await self.announce_presence(self.teams, "offline")
 
         # Leave personal group
         await self.channel_layer.group_discard(f"user_{self.user.id}", self.channel_name)
 
+        if self.user_routing:
+            return
+
         # Leave team groups
-        user_teams = await self.get_user_teams()
-        for team in user_teams:
-            await self.channel_layer.group_discard(f"team_{team.id}", self.channel_name)
+        for team_id in self.teams:
+            await self.channel_layer.group_discard(f"team_{team_id}", self.channel_name)
 
         # Leave channel groups
-        user_channels = await self.get_user_channels()
-        for channel in user_channels:
-            await self.channel_layer.group_discard(f"channel_{channel.id}", self.channel_name)
+        for channel_id in self.channels:
+            await self.channel_layer.group_discard(f"channel_{channel_id}", self.channel_name)
+
+    async def announce_presence(self, team_ids, status):
+        """Tell the members of ``team_ids`` that this user is ``status``."""
+        for team_id in team_ids:
+            await fanout.send_to_team(
+                self.channel_layer, team_id,
+                {
+                    "type": "user_presence_update",
+                    "user_id": self.user.id,
+                    "status": status
+                }
+            )
 
 
     async def receive_json(self, content):
         print(f"Received message: {content}")
 
+        if self.trace:
+            self.trace.write(self.trace_id, self.user.id, 'frame', content)
+
         message_type = content.get('message_type', None)  
 
         if message_type == None :
@@ -111,13 +139,20 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             'reaction': self.handle_reaction,
             'pin_message': self.handle_pin_message,
             'unpin_message': self.handle_unpin_message,
+            'get_pinned_messages': self.handle_get_pinned_messages,
             'get_user_presences': self.handle_user_presence_update,
             'edit_message': self.handle_edit_message,
+            'subscribe': self.handle_subscribe,
+            'unsubscribe': self.handle_unsubscribe,
         }
 
         handler = handlers.get(message_type)
         if handler:
-            await handler(content)
+            if query_inspector.enabled():
+                with query_inspector.inspect(f"ws {message_type}"):
+                    await handler(content)
+            else:
+                await handler(content)
         else:
             print(f"Unknown message type: {message_type}")
 
@@ -136,7 +171,6 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         team_id = content.get('team_id')
         reply_to = content.get('reply_to')
         channel_id = content.get('channel_id')
-        link_preview = content.get('link_preview')
         file_ids = content.get('fileIds', [])  # Get file IDs if present
 
         print("Getting direct message: ", content)
@@ -150,7 +184,11 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             return
 
         # Save the message to the DM channel with file attachments
-        message = await self.save_dm_channel_message(channel_id, message_text, link_preview, reply_to, file_ids)
+        try:
+            message = await self.save_dm_channel_message(channel_id, message_text, reply_to, file_ids)
+        except storage.QuotaExceeded as e:
+            await self.send_json({"type": "error", "error": str(e), "channel_id": channel_id})
+            return
         if message:
             # Get file attachments information
             attachments = []
@@ -158,8 +196,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 # Fetch file information using a database sync to async function
                 attachments = await self.get_file_attachments_info(file_ids)
             
-            await self.channel_layer.group_send(
-                f"channel_{channel_id}",
+            await fanout.send_to_channel(
+                self.channel_layer, channel_id,
                 {   
                     "type": "chat.message",
                     "message": {
@@ -174,12 +212,13 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                         "team_id": team_id,
                         "channel_id": channel_id,
                         "recipient_id": recipient_id,
-                        "link_preview": link_preview,
+                        "link_preview": message.preview_dict(),
                         "attachments": attachments  # Include file attachments
                     }
                 }
             )
             print("Sent DM through channel")
+            self.unfurl_later(message, channel_id)
 
     async def handle_add_team_member(self, content):
         team_id = content.get('team_id')
@@ -188,8 +227,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         if await self.validate_team_membership(team_id):
             success = await self.add_team_member(team_id, user_id)
             if success:
-                await self.channel_layer.group_send(
-                    f"team_{team_id}",
+                await fanout.send_to_team(
+                    self.channel_layer, team_id,
                     {
                         "type": "member_added",
                         "data": {
@@ -199,6 +238,36 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                     }
                 )
     
+    async def membership_changed(self, event):
+        """Join and leave groups after membership changes; see chat/membership.py"""
+        teams_added = set(event['teams_added']) - self.teams
+        teams_removed = set(event['teams_removed']) & self.teams
+        self.teams = (self.teams | teams_added) - teams_removed
+        self.channels = (self.channels | set(event['channels_added'])) - set(event['channels_removed'])
+
+        if not self.user_routing:
+            for team_id in event['teams_added']:
+                await self.channel_layer.group_add(f"team_{team_id}", self.channel_name)
+            for channel_id in event['channels_added']:
+                await self.channel_layer.group_add(f"channel_{channel_id}", self.channel_name)
+            for team_id in event['teams_removed']:
+                await self.channel_layer.group_discard(f"team_{team_id}", self.channel_name)
+            for channel_id in event['channels_removed']:
+                await self.channel_layer.group_discard(f"channel_{channel_id}", self.channel_name)
+        else:
+            # This process may have cached the old members
+            fanout.forget_members(event['channels_added'] + event['channels_removed'],
+                                  event['teams_added'] + event['teams_removed'])
+
+        # Presence follows the teams the user now belongs to
+        await self.announce_presence(teams_removed, "offline")
+        await self.announce_presence(teams_added, "online")
+
+        await self.send_json({
+            "type": "membership_changed",
+            **{kind: event[kind] for kind in membership.KINDS}
+        })
+
     async def member_added(self, event):
         """Handler for broadcasting chat messages to clients."""
         print(f"Received message event: {event}")
@@ -231,8 +300,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             if deleted:
                 print("Message deletion confirmed")
                 print(f"Sending message deletion to channel_{channel_id}")
-                await self.channel_layer.group_send(
-                    f"channel_{channel_id}",
+                await fanout.send_to_channel(
+                    self.channel_layer, channel_id,
                     {
                         "type": "message_deleted",
                         "data": {
@@ -306,7 +375,6 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         channel_id = content.get('channel')
         message_text = content.get('content')
         reply_to = content.get('reply_to')
-        link_preview = content.get('link_preview')
         file_ids = content.get('fileIds', [])  # Get file IDs if present
 
         if not all([channel_id, message_text]):
@@ -320,7 +388,11 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             print("User does not have permission to send messages in this channel.")
             return
 
-        message = await self.save_channel_message(channel_id, message_text, link_preview, reply_to, False, file_ids)
+        try:
+            message = await self.save_channel_message(channel_id, message_text, reply_to, False, file_ids)
+        except storage.QuotaExceeded as e:
+            await self.send_json({"type": "error", "error": str(e), "channel_id": channel_id})
+            return
         print(f"Message saved: {message}")
 
         if message:
@@ -335,8 +407,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             
             print(f"Chck attachments : ", attachments)
 
-            await self.channel_layer.group_send(
-                f"channel_{channel_id}",
+            await fanout.send_to_channel(
+                self.channel_layer, channel_id,
                 {
                     "type": "chat.message",
                     "message": {
@@ -349,12 +421,13 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                         "replied_message": message.reply_to.content if message.reply_to else None,
                         "team_id": team_id,
                         "channel_id": channel_id,
-                        "link_preview": link_preview,
+                        "link_preview": message.preview_dict(),
                         "attachments": attachments  # Include file attachments
                     }
                 }
             )
             print("Message sent to channel group")
+            self.unfurl_later(message, channel_id)
     
     async def handle_forward_message(self, content):
         print(f"Handling channel message: {content}")
@@ -382,8 +455,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 team_id = await self.get_team_id_for_channel(channel_id)
                 print(f"Broadcasting message to channel_{channel_id}")
 
-                await self.channel_layer.group_send(
-                    f"channel_{channel_id}",
+                await fanout.send_to_channel(
+                    self.channel_layer, channel_id,
                     {
                         "type": "chat.message",
                         "message": {
@@ -409,8 +482,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         if await self.validate_team_membership(team_id):
             channel = await self.create_channel(team_id, channel_name)
             if channel:
-                await self.channel_layer.group_send(
-                    f"team_{team_id}",
+                await fanout.send_to_team(
+                    self.channel_layer, team_id,
                     {
                         "type": "channel_created",
                         "channel": {
@@ -433,8 +506,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         notification_type = content.get('notification_type')
         
         if await self.validate_team_membership(team_id):
-            await self.channel_layer.group_send(
-                f"team_{team_id}",
+            await fanout.send_to_team(
+                self.channel_layer, team_id,
                 {
                     "type": "team_notification",
                     "notification": {
@@ -471,8 +544,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             # Get the updated message data to broadcast
             message_data = await self.get_edited_message_data(message_id)
             if message_data:
-                await self.channel_layer.group_send(
-                    f"channel_{channel_id}",
+                await fanout.send_to_channel(
+                    self.channel_layer, channel_id,
                     {
                         "type": "message_edited",
                         "data": {
@@ -541,7 +614,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     async def message_edited(self, event):
         """Handler for message edit events"""
         print(f"Received message edit event: {event}")
-        await self.send_json(event['data'])
+        if self.wants(event['data']['channel_id']):
+            await self.send_json(event['data'])
 
     async def handle_reaction(self, content):
         """Handle reaction updates and broadcast to relevant users"""
@@ -565,14 +639,12 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         # Save the updated reactions in the database
         await self.update_message_reactions(message_id, message_data['reactions'])
 
-        # All messages are now in channels
-        group_name = f"channel_{message_data['channel_id']}"
-
-        # Broadcast the reaction update
-        await self.channel_layer.group_send(
-            group_name,
+        # Broadcast the reaction update; all messages are now in channels
+        await fanout.send_to_channel(
+            self.channel_layer, message_data['channel_id'],
             {
                 "type": "broadcast_reaction",
+                "channel_id": message_data['channel_id'],
                 "message_id": message_id,
                 "reactions": message_data['reactions'],
                 "user_id": user_id,
@@ -613,6 +685,8 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
     async def broadcast_reaction(self, event):
         """Send reaction update to connected clients"""
+        if not self.wants(event.get('channel_id')):
+            return
         await self.send_json({
             "type": "reaction_update",
             "message_id": event["message_id"],
@@ -625,23 +699,23 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     async def handle_pin_message(self, content):
         message_id = content.get('message_id')
         channel_id = await self.get_channel_for_message(message_id)
-        # messages = await self.get_channel_messages(channel_id)
 
         if not message_id or not channel_id:
             return
 
         try:
-            pinned = await self.pin_message(message_id, channel_id)
-            if pinned:
-                await self.channel_layer.group_send(
-                    f"channel_{channel_id}",
+            pinned_messages = await self.pin_message(message_id, channel_id)
+            if pinned_messages is not None:
+                await fanout.send_to_channel(
+                    self.channel_layer, channel_id,
                     {
                         "type": "message_pinned",
                         "data": {
                             "type": "message_pinned",
                             "message_id": message_id,
                             "channel_id": channel_id,
-                            # "messages" : messages
+                            "pinned_by": self.user.username,
+                            "pinned_messages": pinned_messages
                         }
                     }
                 )
@@ -651,63 +725,81 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     async def handle_unpin_message(self, content):
         message_id = content.get('message_id')
         channel_id = await self.get_channel_for_message(message_id)
-        # messages = await self.get_channel_messages(channel_id)
 
         if not message_id or not channel_id:
             return
 
         try:
-            unpinned = await self.unpin_message(message_id)
-            if unpinned:
-                await self.channel_layer.group_send(
-                    f"channel_{channel_id}",
+            pinned_messages = await self.unpin_message(message_id, channel_id)
+            if pinned_messages is not None:
+                await fanout.send_to_channel(
+                    self.channel_layer, channel_id,
                     {
                         "type": "message_unpinned",
                         "data": {
                             "type": "message_unpinned",
                             "message_id": message_id,
                             "channel_id": channel_id,
-                            # "messages" : messages
+                            "pinned_messages": pinned_messages
                         }
                     }
                 )
         except Exception as e:
             print(f"Error in handle_unpin_message: {e}")
 
+    async def handle_get_pinned_messages(self, content):
+        channel_id = content.get('channel_id')
+        if await self.validate_channel_access(channel_id):
+            pinned_messages = await self.get_pinned_messages(channel_id)
+            await self.send_json({
+                "type": "pinned_messages",
+                "channel_id": channel_id,
+                "pinned_messages": pinned_messages
+            })
+
     @database_sync_to_async
     def pin_message(self, message_id, channel_id):
-        try:
-            Message.objects.filter(channel_id=channel_id, is_pinned=True).update(is_pinned=False)
-            message = Message.objects.get(id=message_id)
-            message.is_pinned = True
-            message.save()
-            return True
-        except Message.DoesNotExist:
-            return False
+        """Pin in one UPDATE; returns the channel's pins, or None if nothing changed."""
+        updated = (
+            Message.objects.filter(id=message_id, channel_id=channel_id, channel__members=self.user)
+            .exclude(is_pinned=True)
+            .update(is_pinned=True, pinned_at=timezone.now(), pinned_by=self.user)
+        )
+        if not updated:
+            return None
+        return [message.to_pin_dict() for message in Message.pinned_in(channel_id)]
 
     @database_sync_to_async
-    def unpin_message(self, message_id):
-        try:
-            message = Message.objects.get(id=message_id)
-            message.is_pinned = False
-            message.save()
-            return True
-        except Message.DoesNotExist:
-            return False
+    def unpin_message(self, message_id, channel_id):
+        """Unpin in one UPDATE; returns the channel's pins, or None if nothing changed."""
+        updated = (
+            Message.objects.filter(id=message_id, channel_id=channel_id, channel__members=self.user,
+                                   is_pinned=True)
+            .update(is_pinned=False, pinned_at=None, pinned_by=None)
+        )
+        if not updated:
+            return None
+        return [message.to_pin_dict() for message in Message.pinned_in(channel_id)]
+
+    @database_sync_to_async
+    def get_pinned_messages(self, channel_id):
+        return [message.to_pin_dict() for message in Message.pinned_in(channel_id)]
 
     async def message_pinned(self, event):
-        await self.send_json(event['data'])
+        if self.wants(event['data']['channel_id']):
+            await self.send_json(event['data'])
 
     async def message_unpinned(self, event):
-        await self.send_json(event['data'])
+        if self.wants(event['data']['channel_id']):
+            await self.send_json(event['data'])
 
     @database_sync_to_async
-    def get_user_teams(self):
-        return list(Team.objects.filter(members=self.user))
+    def get_user_team_ids(self):
+        return list(Team.objects.filter(members=self.user).values_list('id', flat=True))
 
     @database_sync_to_async
-    def get_user_channels(self):
-        return list(Channel.objects.filter(team__members=self.user, members=self.user))
+    def get_user_channel_ids(self):
+        return list(Channel.objects.filter(team__members=self.user, members=self.user).values_list('id', flat=True))
 
     @database_sync_to_async
     def validate_channel_access(self, channel_id):
@@ -746,27 +838,27 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             return None
 
     @database_sync_to_async
-    def save_channel_message(self, channel_id, message_text, link_preview, reply_to=None, is_forwarded=False, file_ids=None):
+    def save_channel_message(self, channel_id, message_text, reply_to=None, is_forwarded=False, file_ids=None):
         try:
             channel = Channel.objects.get(id=channel_id, members=self.user)
             message = Message.objects.get(id=reply_to) if reply_to else None
 
             print("Check file ids : ", file_ids)
             
-            # Create the message without files initially
-            new_message = Message.objects.create(
-                sender=self.user,
-                channel=channel,
-                content=message_text,
-                reply_to=message,
-                is_forwarded=is_forwarded,
-                link_preview=link_preview
-            )
-            
-            # Now set the files using the appropriate method
-            for file_id in file_ids:
-                file = FileAttachment.objects.get(id=file_id)
-                new_message.files.add(file)
+            # A message whose files would exceed the team quota is not saved
+            with transaction.atomic():
+                new_message = Message.objects.create(
+                    sender=self.user,
+                    channel=channel,
+                    content=message_text,
+                    reply_to=message,
+                    is_forwarded=is_forwarded,
+                    preview=unfurl.stored_preview_for(message_text)
+                )
+
+                # Now set the files, counting them against the team's storage
+                if file_ids:
+                    storage.attach(new_message, file_ids, channel.team_id)
             
             print("Saving message : ", new_message.files.all())
             return new_message
@@ -775,47 +867,82 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
 
     @database_sync_to_async
-    def save_dm_channel_message(self, channel_id, message_text, link_preview, reply_to=None, file_ids=None):
+    def save_dm_channel_message(self, channel_id, message_text, reply_to=None, file_ids=None):
         try:
             channel = Channel.objects.get(id=channel_id, members=self.user, is_direct_message=True)
             message = Message.objects.get(id=reply_to) if reply_to else None
             
-            # Create the message without files initially
-            new_message = Message.objects.create(
-                sender=self.user,
-                channel=channel,
-                content=message_text,
-                reply_to=message,
-                link_preview=link_preview
-            )
-            
-            # Now set the files using the appropriate method
-            for file_id in file_ids:
-                file = FileAttachment.objects.get(id=file_id)
-                new_message.files.add(file)
+            # A message whose files would exceed the team quota is not saved
+            with transaction.atomic():
+                new_message = Message.objects.create(
+                    sender=self.user,
+                    channel=channel,
+                    content=message_text,
+                    reply_to=message,
+                    preview=unfurl.stored_preview_for(message_text)
+                )
+
+                # Now set the files, counting them against the team's storage
+                if file_ids:
+                    storage.attach(new_message, file_ids, channel.team_id)
             
             return new_message
         except Channel.DoesNotExist:
             return None
         
+    def unfurl_later(self, message, channel_id):
+        """Fetch the preview of a message's first link after it has been delivered"""
+        if message.preview_id is None:
+            url = unfurl.first_url(message.content)
+            if url:
+                unfurl.schedule(message.id, channel_id, url)
+
+    def member_of(self, channel_id):
+        """False for a channel the user is no longer in.
+
+        With user routing, another worker's membership index can still list a
+        removed user for up to ``INDEX_TTL`` seconds (chat/fanout.py). The
+        socket's own channel set, kept current by ``membership_changed``,
+        decides. With channel groups the socket has already left the group.
+        """
+        if not self.user_routing:
+            return True
+        try:
+            return int(channel_id) in self.channels
+        except (TypeError, ValueError):
+            return False
+
+    def wants(self, channel_id):
+        """True if full events of ``channel_id`` go to this socket."""
+        return self.member_of(channel_id) and self.subscriptions.wants(channel_id)
+
+    async def link_preview_ready(self, event):
+        if self.wants(event['data']['channel_id']):
+            await self.send_json(event['data'])
+
     async def chat_message(self, event):
         """Handler for broadcasting chat messages to clients."""
         print(f"Received message event: {event}")
-        
+
+        message = event["message"]
+        if not self.member_of(message['channel_id']):
+            return
+        if not self.subscriptions.wants(message['channel_id']):
+            # Not being viewed: counted in the next channel_activity summary
+            self.subscriptions.record(message, own=message.get('sender') == self.user.username)
+            if self.summary_task is None:
+                self.summary_task = asyncio.ensure_future(self.send_activity_later())
+            return
+
         # Send message to WebSocket
         print(f"Sending message: {event['message']} with type {type(event['message'])}")
         await self.send_json(event["message"])
 
-    @database_sync_to_async
-    def is_team_member(self):
-        # Check if user is a member of any team
-        return Team.objects.filter(members=self.user).exists()
-
     @database_sync_to_async
     def create_channel(self, team_id, channel_name):
         team = Team.objects.get(id=team_id)
         channel = Channel.objects.create(team=team, name=channel_name)
-        channel.members.set(team.members.all())
+        membership.fill_from_team(channel)
         return channel
 
     @database_sync_to_async
@@ -823,49 +950,39 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         try:
             team = Team.objects.get(id=team_id)
             user = User.objects.get(id=user_id)
-            team.members.add(user)
-            # Add user to all team channels (except DM channels)
-            for channel in team.channels.filter(is_direct_message=False):
-                channel.members.add(user)
+            # Adds the user to all team channels too (except DM channels)
+            membership.add_team_members(team, [user.id])
             return True
         except (Team.DoesNotExist, User.DoesNotExist):
             return False
     
     @database_sync_to_async
     def get_channel_messages(self, channel_id):
-        messages = Message.objects.filter(channel_id=channel_id).order_by('created_at')
+        messages = (
+            Message.objects.filter(channel_id=channel_id)
+            .select_related('sender', 'reply_to', 'preview')
+            .prefetch_related(Prefetch('files', queryset=FileAttachment.objects.select_related('blob')))
+            .order_by('created_at')
+        )
         message_list = []
         
         for msg in messages:
-            # Get file attachments for this message
-            attachments = []
-            try:
-                # Use the 'files' field from the Message model
-                file_attachments = msg.files.all()
-                print("Check attachments in getting them : ", msg.content, " ", file_attachments)
-                for attachment in file_attachments:
-                    attachments.append({
-                        'id': attachment.id,
-                        'filename': attachment.original_filename,
-                        'url': attachment.file.url,
-                        'content_type': attachment.content_type,
-                        'size': attachment.size
-                    })
-            except Exception as e:
-                print(f"Error getting attachments for message {msg.id}: {e}")
+            # Get file attachments for this message (prefetched above)
+            attachments = [attachment.to_dict() for attachment in msg.files.all()]
             
             message_list.append({
                 "id": msg.id,
                 "content": msg.content,
                 "sender": msg.sender.username,
-                "sender_id": msg.sender.id,
+                "sender_id": msg.sender_id,
                 "timestamp": str(msg.created_at),
-                "reply_to": msg.reply_to.id if msg.reply_to else None,
+                "reply_to": msg.reply_to_id,
                 "is_forwarded": msg.is_forwarded,
                 "is_pinned": msg.is_pinned,
+                "pinned_at": msg.pinned_at.isoformat() if msg.pinned_at else None,
                 "replied_message": msg.reply_to.content if msg.reply_to else None,
                 "reactions": msg.reactions or {},
-                "link_preview": msg.link_preview,
+                "link_preview": msg.preview_dict(),
                 "is_edited": msg.is_edited,
                 "edited_at": msg.edited_at.isoformat() if msg.edited_at else None,
                 "attachments": attachments  # Add the attachments
@@ -901,22 +1018,20 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     @database_sync_to_async
     def get_interacted_users(self, team_id):
         # Find users that have DM channels with the current user in this team
-        team = Team.objects.get(id=team_id)
-        
         # Get all DirectMessageChannel objects where this user is involved
         dm_channels = DirectMessageChannel.objects.filter(
             Q(user1=self.user) | Q(user2=self.user),
-            channel__team=team
-        )
+            channel__team_id=team_id
+        ).select_related('user1', 'user2')
         
         interacted_users = []
         for dm in dm_channels:
             # Add the other user in the DM channel
-            other_user = dm.user1 if dm.user2.id == self.user.id else dm.user2
+            other_user = dm.user1 if dm.user2_id == self.user.id else dm.user2
             interacted_users.append({
                 "id": other_user.id,
                 "username": other_user.username,
-                "channel_id": dm.channel.id
+                "channel_id": dm.channel_id
             })
             
         return interacted_users
@@ -927,7 +1042,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             print(f"Attempting to delete message {message_id}")
             message = Message.objects.get(id=message_id, sender=self.user)
             print("Message found, proceeding with deletion")
-            message.delete()
+            storage.delete_message(message)
             print("Message deleted successfully")
             return True
         except Message.DoesNotExist:
@@ -938,8 +1053,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     def get_channel_for_message(self, message_id):
         try:
             print(f"Retrieving channel for message {message_id}")
-            message = Message.objects.get(id=message_id)
-            channel_id = message.channel.id if message.channel else None
+            channel_id = Message.objects.values_list('channel_id', flat=True).get(id=message_id)
             print(f"Retrieved channel ID: {channel_id}")
             return channel_id
         except Message.DoesNotExist:
@@ -949,7 +1063,41 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     async def message_deleted(self, event):
         """Handler for message deletion events"""
         print(f"Received message deletion event: {event}")
-        await self.send_json(event['data'])
+        if self.wants(event['data']['channel_id']):
+            await self.send_json(event['data'])
+
+    async def handle_subscribe(self, content):
+        """Send full events for these channels; see chat/subscriptions.py"""
+        channel_ids = await self.get_accessible_channel_ids(subscriptions.channel_ids(content))
+        self.subscriptions.subscribe(channel_ids)
+        await self.send_subscriptions()
+
+    async def handle_unsubscribe(self, content):
+        self.subscriptions.unsubscribe(subscriptions.channel_ids(content))
+        await self.send_subscriptions()
+
+    async def send_subscriptions(self):
+        await self.send_json({
+            "type": "subscriptions",
+            "channel_ids": sorted(self.subscriptions.viewed)
+        })
+
+    async def send_activity_later(self):
+        """Send the activity in channels not being viewed, coalesced over SUMMARY_INTERVAL"""
+        await asyncio.sleep(subscriptions.config()['SUMMARY_INTERVAL'])
+        self.summary_task = None
+        channels = self.subscriptions.drain()
+        if channels:
+            await self.send_json({
+                "type": "channel_activity",
+                "channels": channels
+            })
+
+    @database_sync_to_async
+    def get_accessible_channel_ids(self, channel_ids):
+        if not channel_ids:
+            return []
+        return list(Channel.objects.filter(id__in=channel_ids, members=self.user).values_list('id', flat=True))
 
     @database_sync_to_async
     def set_user_online(self, team_id):
@@ -999,17 +1147,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
     
     @database_sync_to_async
     def get_file_attachments_info(self, file_ids):
-        attachments = []
-        for file_id in file_ids:
-            try:
-                attachment = FileAttachment.objects.get(id=file_id)
-                attachments.append({
-                    'id': attachment.id,
-                    'filename': attachment.original_filename,
-                    'url': attachment.file.url,
-                    'content_type': attachment.content_type,
-                    'size': attachment.size
-                })
-            except FileAttachment.DoesNotExist:
-                pass
-        return attachments
\ No newline at end of file
+        # One query for all ids; keep the order the client sent them in
+        found = {str(pk): attachment
+                 for pk, attachment in FileAttachment.objects.select_related('blob').in_bulk(file_ids).items()}
+        return [found[str(file_id)].to_dict() for file_id in file_ids if str(file_id) in found]
\ No newline at end of file
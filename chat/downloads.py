@@ -0,0 +1,153 @@
+"""
+Attachment downloads.
+
+``attachment_response`` answers a download with:
+
+- A strong ``ETag`` (the content hash for content-addressed files) and a
+  ``Last-Modified``, so ``If-None-Match`` / ``If-Modified-Since`` get a 304
+  and clients do not download unchanged files again.
+- ``Accept-Ranges: bytes`` and a single ``Range`` (honouring ``If-Range``),
+  so interrupted downloads resume and video can seek. Multi-range requests
+  get the whole file, as RFC 9110 allows.
+- A body from an async iterator that reads ``CHUNK_SIZE`` bytes per
+  ``os.pread`` in the default executor, so memory stays at one chunk.
+  Django's ASGI handler cannot stream the sync file iterator of
+  ``FileResponse``. It reads the whole file into a list first, so the
+  first byte waits for the last one to be read.
+
+With ``OFFLOAD`` set to ``'x-accel-redirect'`` (nginx) or ``'x-sendfile'``
+(Apache, lighttpd), the body is left empty and the front proxy sends the
+file itself, zero-copy, handling ranges as well.
+"""
+import asyncio
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+DEFAULTS = {
+    'CHUNK_SIZE': 256 * 1024,
+    # None, 'x-accel-redirect' or 'x-sendfile'
+    'OFFLOAD': None,
+    # x-accel-redirect: internal nginx location that maps onto MEDIA_ROOT
+    'OFFLOAD_PREFIX': '/protected-media/',
+}
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_DOWNLOADS', {})}
+
+
+def etag_for(attachment, stat):
+    """Strong validator: the content hash, or size and mtime for files stored before hashing."""
+    if attachment.blob_id is not None:
+        return f'"{os.path.basename(attachment.file.name)}"'
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """``(start, end)`` inclusive for a single byte range, None to send the whole file.
+
+    Raises ``ValueError`` when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match((header or '').replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-N: the last N bytes
+        length = int(last)
+        if not length or not size:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+
+def if_range_matches(request, etag, last_modified):
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    if value.startswith('"'):
+        return value == etag
+    date = parse_http_date_safe(value)
+    return date is not None and date >= last_modified
+
+
+async def file_chunks(path, start, length, chunk_size):
+    """Yield ``length`` bytes of the file at ``path`` from ``start``, one executor call per chunk."""
+    loop = asyncio.get_running_loop()
+    fd = await loop.run_in_executor(None, os.open, path, os.O_RDONLY)
+    try:
+        position, end = start, start + length
+        while position < end:
+            chunk = await loop.run_in_executor(None, os.pread, fd, min(chunk_size, end - position), position)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+    finally:
+        os.close(fd)
+
+
+def attachment_response(request, attachment, stat=None):
+    """Download response for ``attachment``; ``stat`` is ``os.stat`` of its file if already known."""
+    options = config()
+    path = default_storage.path(attachment.file.name)
+    stat = stat or os.stat(path)
+    size = stat.st_size
+    etag = etag_for(attachment, stat)
+    last_modified = int(stat.st_mtime)
+
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        # 304 Not Modified (or 412): repeat the validators, send no body
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    headers['Accept-Ranges'] = 'bytes'
+    headers['Content-Disposition'] = content_disposition_header(True, attachment.original_filename)
+
+    offload = options['OFFLOAD']
+    if offload:
+        response = HttpResponse(content_type=attachment.content_type, headers=headers)
+        if offload == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = quote(options['OFFLOAD_PREFIX'] + attachment.file.name)
+        else:
+            response['X-Sendfile'] = path
+        return response
+
+    start, end, status = 0, size - 1, 200
+    if request.headers.get('Range') and if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(request.headers['Range'], size)
+        except ValueError:
+            return HttpResponse(status=416, headers={'Content-Range': f'bytes */{size}'})
+        if byte_range is not None:
+            (start, end), status = byte_range, 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    length = end - start + 1
+
+    headers['Content-Length'] = str(length)
+    if request.method == 'HEAD':
+        return HttpResponse(status=status, content_type=attachment.content_type, headers=headers)
+    return StreamingHttpResponse(
+        file_chunks(path, start, length, options['CHUNK_SIZE']),
+        status=status, content_type=attachment.content_type, headers=headers,
+    )
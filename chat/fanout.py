@@ -0,0 +1,205 @@
+"""
+Routing of channel and team broadcasts to connected users.
+
+In the default ``channel`` mode each WebSocket joins ``user_{id}``, one
+``team_{id}`` group per team and one ``channel_{id}`` group per channel, and
+a broadcast is a single ``group_send``. A user in 1,000 channels costs 1,000
+group entries in the channel layer per socket, every connect and disconnect
+pays for all of them, and a membership change only applies once the socket
+reconnects.
+
+In ``user`` mode a socket joins ``user_{id}`` alone, so connecting costs
+the same whatever the user belongs to. ``send_to_channel`` and
+``send_to_team`` look the recipients up in a ``MembershipIndex`` and send
+one copy to each recipient's user group, ``BATCH_SIZE`` sends at a time.
+Membership changes apply from the next broadcast, without touching
+sockets. The ``m2m_changed`` receivers below drop the affected entries in
+this process at once, and again when the transaction commits; code that
+writes the through tables directly calls ``forget_channels`` /
+``forget_teams`` itself. Other workers drop them when one of their sockets
+receives the ``membership.changed`` event for the change
+(``chat.membership``). A worker with no affected user connected may use
+its cached members for up to ``INDEX_TTL`` seconds. A removal still takes
+effect at once: each ``ChatConsumer`` keeps its user's current channel set
+from those events and drops events for channels outside it. A user added
+meanwhile is told by ``membership_changed`` and loads the channel's
+history.
+
+Recipients are the same in both modes: a channel reaches its members who
+are also members of its team, as ``ChatConsumer.get_user_channel_ids`` does.
+"""
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+
+from .cache import TTLCache
+from .models import Channel, Team
+
+DEFAULTS = {
+    # 'channel' or 'user'
+    'MODE': 'channel',
+    'INDEX_SIZE': 10000,
+    'INDEX_TTL': 5,
+    'BATCH_SIZE': 100,
+}
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_FANOUT', {})}
+
+
+def user_routing():
+    return config()['MODE'] == 'user'
+
+
+def user_group(user_id):
+    return f"user_{user_id}"
+
+
+class MembershipIndex:
+    """Member user ids of channels and teams, cached per process."""
+
+    def __init__(self, size, ttl):
+        self.channels = TTLCache(size, ttl)
+        self.teams = TTLCache(size, ttl)
+
+    def channel_members(self, channel_id):
+        channel_id = int(channel_id)
+        members = self.channels.get(channel_id)
+        if members is None:
+            members = frozenset(Channel.members.through.objects
+                                .filter(channel_id=channel_id, user__teams__channels=channel_id)
+                                .values_list('user_id', flat=True))
+            self.channels.set(channel_id, members)
+        return members
+
+    def team_members(self, team_id):
+        team_id = int(team_id)
+        members = self.teams.get(team_id)
+        if members is None:
+            members = frozenset(Team.members.through.objects.filter(team_id=team_id)
+                                .values_list('user_id', flat=True))
+            self.teams.set(team_id, members)
+        return members
+
+    async def achannel_members(self, channel_id):
+        """``channel_members`` without a thread hop when the channel is cached."""
+        members = self.channels.get(int(channel_id))
+        if members is None:
+            members = await database_sync_to_async(self.channel_members)(channel_id)
+        return members
+
+    async def ateam_members(self, team_id):
+        members = self.teams.get(int(team_id))
+        if members is None:
+            members = await database_sync_to_async(self.team_members)(team_id)
+        return members
+
+
+_index = None
+
+
+def index():
+    global _index
+    if _index is None:
+        options = config()
+        _index = MembershipIndex(options['INDEX_SIZE'], options['INDEX_TTL'])
+    return _index
+
+
+@receiver(setting_changed)
+def settings_changed(sender, setting, **kwargs):
+    global _index
+    if setting == 'CHAT_FANOUT':
+        _index = None
+
+
+async def send_to_users(layer, user_ids, message):
+    """``group_send`` ``message`` to each user's group, ``BATCH_SIZE`` at a time."""
+    batch_size = max(1, config()['BATCH_SIZE'])
+    user_ids = sorted(user_ids)
+    for start in range(0, len(user_ids), batch_size):
+        await asyncio.gather(*(layer.group_send(user_group(user_id), message)
+                               for user_id in user_ids[start:start + batch_size]))
+
+
+async def send_to_channel(layer, channel_id, message):
+    """Broadcast ``message`` to the members of channel ``channel_id``."""
+    if not user_routing():
+        return await layer.group_send(f"channel_{channel_id}", message)
+    await send_to_users(layer, await index().achannel_members(channel_id), message)
+
+
+async def send_to_team(layer, team_id, message):
+    """Broadcast ``message`` to the members of team ``team_id``."""
+    if not user_routing():
+        return await layer.group_send(f"team_{team_id}", message)
+    await send_to_users(layer, await index().ateam_members(team_id), message)
+
+
+def _forget(cache, ids):
+    if ids is None:
+        cache.clear()
+    else:
+        for key in ids:
+            cache.pop(int(key))
+
+
+def forget_channels(ids=None):
+    """Drop these channels (all if None) from the index, now and on commit."""
+    ids = None if ids is None else list(ids)
+    _forget(index().channels, ids)
+    transaction.on_commit(lambda: _forget(index().channels, ids))
+
+
+def forget_teams(ids=None):
+    """Drop these teams (all if None) from the index, now and on commit.
+
+    Channel recipients depend on team membership too, so every channel is
+    dropped as well.
+    """
+    ids = None if ids is None else list(ids)
+    _forget(index().teams, ids)
+    forget_channels()
+    transaction.on_commit(lambda: _forget(index().teams, ids))
+
+
+def forget_members(channel_ids=(), team_ids=()):
+    """Drop these channels and teams from this process's index, for a change made elsewhere."""
+    _forget(index().channels, list(channel_ids))
+    _forget(index().teams, list(team_ids))
+    if team_ids:
+        index().channels.clear()
+
+
+def _changed_ids(instance, reverse, pk_set):
+    # Forward (channel.members.add(user)): the one instance changed.
+    # Reverse (user.channels.add(channel)): the pk_set changed, or, on clear, any.
+    return pk_set if reverse else [instance.pk]
+
+
+@receiver(m2m_changed, sender=Channel.members.through)
+def channel_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        forget_channels(_changed_ids(instance, reverse, pk_set))
+
+
+@receiver(m2m_changed, sender=Team.members.through)
+def team_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        forget_teams(_changed_ids(instance, reverse, pk_set))
+
+
+@receiver(post_delete, sender=Channel)
+def channel_deleted(sender, instance, **kwargs):
+    forget_channels([instance.pk])
+
+
+@receiver(post_delete, sender=Team)
+def team_deleted(sender, instance, **kwargs):
+    forget_teams([instance.pk])
@@ -0,0 +1,117 @@
+"""
+Image decoding for attachment thumbnails.
+
+This module runs inside ``chat.thumbnails``' worker processes. It must not
+import Django, because the workers are spawned and never set Django up.
+Pillow is optional: without it ``AVAILABLE`` is False and no thumbnails are
+made.
+"""
+import math
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = ImageOps = None
+
+AVAILABLE = Image is not None
+
+# EXIF orientations that rotate the image by 90 or 270 degrees
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+EXIF_ORIENTATION = 0x0112
+
+BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def _base83(value, length):
+    return ''.join(BASE83[value // 83 ** (length - i - 1) % 83] for i in range(length))
+
+
+def _srgb_to_linear(value):
+    value /= 255
+    return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(value):
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value, exponent):
+    return math.copysign(abs(value) ** exponent, value)
+
+
+def blurhash(image, x_components=4, y_components=3):
+    """BlurHash (https://blurha.sh) of a small RGB image: a ~30 character placeholder."""
+    width, height = image.size
+    pixels = [tuple(_srgb_to_linear(channel) for channel in pixel) for pixel in image.convert('RGB').getdata()]
+    factors = []
+    for j in range(y_components):
+        cos_y = [math.cos(math.pi * j * y / height) for y in range(height)]
+        for i in range(x_components):
+            cos_x = [math.cos(math.pi * i * x / width) for x in range(width)]
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                for x in range(width):
+                    basis = normalisation * cos_x[x] * cos_y[y]
+                    pr, pg, pb = pixels[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = 1 / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83(x_components - 1 + (y_components - 1) * 9, 1)
+    if ac:
+        quantised_max = max(0, min(82, int(math.floor(max(abs(c) for f in ac for c in f) * 166 - 0.5))))
+        maximum = (quantised_max + 1) / 166
+    else:
+        quantised_max, maximum = 0, 1
+    result += _base83(quantised_max, 1)
+    result += _base83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (max(0, min(18, int(math.floor(_sign_pow(c / maximum, 0.5) * 9 + 9.5)))) for c in factor)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def render(path, output_dir, sizes, quality=80):
+    """Write WebP thumbnails of the image at ``path`` into ``output_dir``.
+
+    Each thumbnail fits within ``size`` x ``size`` and is written as
+    ``<size>.webp``. Sizes not smaller than the image are skipped. Returns the
+    image's displayed ``width`` and ``height``, its BlurHash ``placeholder``
+    and the ``thumbnails`` sizes written.
+    """
+    with Image.open(path) as image:
+        width, height = image.size
+        orientation = image.getexif().get(EXIF_ORIENTATION)
+        if orientation in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+
+        os.makedirs(output_dir, exist_ok=True)
+        written = []
+        # Largest first, each from the previous one. thumbnail() lets JPEG
+        # decode at a reduced scale, so large photos are never fully decoded.
+        thumb = image
+        for size in sorted(sizes, reverse=True):
+            if size >= max(width, height):
+                continue
+            thumb.thumbnail((size, size), Image.Resampling.LANCZOS)
+            upright = ImageOps.exif_transpose(thumb)
+            if upright.mode not in ('RGB', 'RGBA'):
+                upright = upright.convert('RGBA' if 'A' in upright.getbands() else 'RGB')
+            target = os.path.join(output_dir, f"{size}.webp")
+            upright.save(target + '.tmp', 'WEBP', quality=quality)
+            os.replace(target + '.tmp', target)
+            written.append(size)
+
+        thumb.thumbnail((32, 32), Image.Resampling.BILINEAR)
+        placeholder = blurhash(ImageOps.exif_transpose(thumb))
+
+    return {'width': width, 'height': height, 'placeholder': placeholder, 'thumbnails': sorted(written)}
@@ -0,0 +1,260 @@
+"""
+A channel layer that delivers to consumers in the same process in memory.
+
+With ``RedisChannelLayer`` alone, every ``group_send`` goes to Redis and
+back once per member, even when all of ``channel_{id}``'s members are
+connected to the sending process, which is the usual case for small teams.
+``HybridChannelLayer`` wraps the shared layer (the ``inner`` config):
+
+- Consumer channels and group memberships are registered locally. A group
+  message goes straight onto the local members' queues.
+- In the shared layer, each group holds one inbox channel per process that
+  has local members, instead of one entry per socket. A group message is
+  published there once. Each other process's inbox pump hands it to its
+  own local members, and the sending process ignores its own copy.
+- ``send`` to a channel of this process stays in memory. Other names go
+  to the shared layer. Each consumer's ``receive`` also waits on the
+  shared layer, so direct messages from other processes arrive.
+- A channel added to a group from another loop, such as
+  ``async_to_sync(layer.group_add)`` in a sync view, is a member of the
+  shared group itself. It gets the published envelopes, which ``receive``
+  unwraps.
+
+Ordering per group and sender is kept. Local queues are FIFO, and each
+inbox is a single shared-layer channel read by one pump. If the shared
+layer fails, local members still get the message and the error is logged.
+Other processes miss that message, as they would have without the
+wrapper.
+
+State is kept per event loop, because asyncio queues cannot be shared
+between loops. A short-lived ``async_to_sync`` loop in a sync view has no
+local consumers and simply publishes.
+"""
+import asyncio
+import copy
+import logging
+import time
+import uuid
+import weakref
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('chat.layers')
+
+FANOUT = 'hybrid.fanout'
+
+
+class _LoopState:
+    """Local channels, groups and the inbox pump owned by one event loop."""
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        # channel name -> asyncio.Queue
+        self.queues = {}
+        # group -> set of local channel names
+        self.groups = {}
+        # group -> time its inbox was last added in the shared layer
+        self.registered = {}
+        # channel name -> pending shared-layer receive
+        self.remote = {}
+        self.inbox = None
+        self.pump = None
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, inner=None, group_expiry=86400, expiry=60, capacity=100, channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        if isinstance(inner, dict):
+            inner = import_string(inner['BACKEND'])(**inner.get('CONFIG', {}))
+        self.inner = inner
+        self.group_expiry = group_expiry
+        self._states = weakref.WeakKeyDictionary()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._states.get(loop)
+        if state is None:
+            state = self._states[loop] = _LoopState()
+        return state
+
+    def _queue(self, state, channel):
+        queue = state.queues.get(channel)
+        if queue is None:
+            queue = state.queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        channel = await self.inner.new_channel(prefix)
+        self._queue(self._state(), channel)
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        queue = self._state().queues.get(channel)
+        if queue is None:
+            return await self.inner.send(channel, message)
+        try:
+            queue.put_nowait(copy.deepcopy(message))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        state = self._state()
+        queue = self._queue(state, channel)
+        if not queue.empty():
+            return queue.get_nowait()
+        remote = state.remote.get(channel)
+        if remote is None:
+            remote = state.remote[channel] = asyncio.ensure_future(self.inner.receive(channel))
+        local = asyncio.ensure_future(queue.get())
+        try:
+            await asyncio.wait([local, remote], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # The consumer is gone: stop listening and leave its groups
+            local.cancel()
+            remote.cancel()
+            self._forget(state, channel)
+            raise
+        if local.done():
+            # A pending remote receive is kept for the next call rather than
+            # cancelled, so a message it is about to return is not lost
+            return local.result()
+        local.cancel()
+        del state.remote[channel]
+        message = remote.result()
+        if message.get('type') == FANOUT:
+            # The channel was added to the group in the shared layer directly
+            # (group_add from another loop), so the envelope reached it as is
+            return message['message']
+        return message
+
+    def _forget(self, state, channel):
+        state.queues.pop(channel, None)
+        state.remote.pop(channel, None)
+        for group in [group for group, members in state.groups.items() if channel in members]:
+            state.groups[group].discard(channel)
+            if not state.groups[group]:
+                del state.groups[group]
+                asyncio.ensure_future(self._unregister(state, group))
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        state = self._state()
+        if channel not in state.queues:
+            # Not one of ours (e.g. added from a sync view): the shared layer
+            # routes it, and its own receive() unwraps the envelopes
+            return await self.inner.group_add(group, channel)
+        state.groups.setdefault(group, set()).add(channel)
+        registered = state.registered.get(group)
+        if registered is None or time.time() - registered > self.group_expiry / 2:
+            await self._register(state, group)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        state = self._state()
+        members = state.groups.get(group)
+        if channel not in state.queues or members is None:
+            return await self.inner.group_discard(group, channel)
+        members.discard(channel)
+        if not members:
+            del state.groups[group]
+            await self._unregister(state, group)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        state = self._state()
+        self._deliver(state, group, message)
+        try:
+            await self.inner.group_send(group, {'type': FANOUT, 'origin': state.origin, 'group': group,
+                                                'message': message})
+        except Exception:
+            logger.exception("Publishing to group %s failed; delivered to local members only", group)
+
+    def _deliver(self, state, group, message):
+        for channel in state.groups.get(group, ()):
+            try:
+                state.queues[channel].put_nowait(copy.deepcopy(message))
+            except asyncio.QueueFull:
+                # Like the shared layers: a full channel misses group messages
+                pass
+
+    # Inbox
+
+    async def _register(self, state, group):
+        try:
+            if state.inbox is None:
+                state.inbox = await self.inner.new_channel('hybrid.')
+            await self.inner.group_add(group, state.inbox)
+        except Exception:
+            logger.exception("Joining group %s in the shared layer failed; serving local members only", group)
+            return
+        state.registered[group] = time.time()
+        if state.pump is None or state.pump.done():
+            state.pump = asyncio.ensure_future(self._pump(state))
+
+    async def _unregister(self, state, group):
+        if state.groups.get(group) or state.registered.pop(group, None) is None:
+            return
+        try:
+            await self.inner.group_discard(group, state.inbox)
+        except Exception:
+            logger.exception("Leaving group %s in the shared layer failed", group)
+
+    async def _pump(self, state):
+        """Hand group messages published by other processes to local members."""
+        pending = None
+        # Checked on every pass, so a busy inbox does not hold the refresh back
+        interval = self.group_expiry / 4
+        refresh_at = time.time() + interval
+        try:
+            while True:
+                if time.time() >= refresh_at:
+                    await self._refresh(state)
+                    refresh_at = time.time() + interval
+                if pending is None:
+                    pending = asyncio.ensure_future(self.inner.receive(state.inbox))
+                done, _ = await asyncio.wait([pending], timeout=max(0, refresh_at - time.time()))
+                if not done:
+                    continue
+                received, pending = pending, None
+                try:
+                    envelope = received.result()
+                except Exception:
+                    logger.exception("Receiving from the shared layer failed")
+                    await asyncio.sleep(1)
+                    continue
+                if envelope.get('type') == FANOUT and envelope['origin'] != state.origin:
+                    self._deliver(state, envelope['group'], envelope['message'])
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def _refresh(self, state):
+        # The shared layer expires group entries after group_expiry
+        for group, registered in list(state.registered.items()):
+            if time.time() - registered > self.group_expiry / 2 and state.groups.get(group):
+                await self._register(state, group)
+
+    # Flush extension
+
+    async def flush(self):
+        self._states = weakref.WeakKeyDictionary()
+        if hasattr(self.inner, 'flush'):
+            await self.inner.flush()
+
+    async def close(self):
+        if hasattr(self.inner, 'close'):
+            await self.inner.close()
@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+from contextlib import redirect_stdout
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import SCENARIOS
+
+# Options that shape each scenario, echoed in the report
+CONFIG_KEYS = {
+    'ws': ('users', 'teams', 'channels', 'history', 'actions', 'calibration', 'mix', 'seed'),
+    'preview': ('page_sizes', 'repeat'),
+    'download': ('file_sizes', 'repeat'),
+    'handshake': ('users', 'teams', 'channels', 'reconnects'),
+    'login': ('users', 'teams', 'channels', 'logins', 'concurrency', 'calibration'),
+    'fanout': ('users', 'channel_counts', 'history', 'actions', 'calibration', 'seed'),
+}
+
+
+def size_list(value):
+    return [int(size) for size in value.split(',') if size.strip()]
+
+
+class Command(BaseCommand):
+    help = "Run an offline chat benchmark scenario and print the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', nargs='?', default='ws', choices=sorted(SCENARIOS))
+        parser.add_argument('--users', type=int, default=20, help='Simulated users (one connection each).')
+        parser.add_argument('--teams', type=int, default=2)
+        parser.add_argument('--channels', type=int, default=4)
+        parser.add_argument('--history', type=int, default=20, help='Seeded messages per channel.')
+        parser.add_argument('--actions', type=int, default=20, help='Actions per user in the timed phase.')
+        parser.add_argument('--calibration', type=int, default=10,
+                            help='Serial actions per type used to measure queries per action '
+                                 '(login: chat round trips measured before the burst).')
+        parser.add_argument('--mix', default='',
+                            help='Weighted action mix, e.g. "channel_message=70,reaction=15,edit=10,history=5".')
+        parser.add_argument('--timeout', type=float, default=10.0)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--page-sizes', type=size_list, default=[64, 1024, 8192],
+                            help='preview: comma-separated fixture page sizes in KiB.')
+        parser.add_argument('--file-sizes', type=size_list, default=[1024, 16384, 131072],
+                            help='download: comma-separated attachment sizes in KiB.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='preview, download: runs per variant and size.')
+        parser.add_argument('--reconnects', type=int, default=5,
+                            help='handshake: times each user reconnects.')
+        parser.add_argument('--channel-counts', type=size_list, default=[10, 100, 1000],
+                            help='fanout: comma-separated channel counts (every user is in every channel).')
+        parser.add_argument('--logins', type=int, default=40, help='login: logins in the burst.')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='login: request threads logging in at once.')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+        parser.add_argument('--no-migrate', action='store_true',
+                            help='Skip applying migrations to an SQLite benchmark database.')
+        parser.add_argument('--verbose-app', action='store_true',
+                            help='Keep application prints instead of discarding them during the run.')
+
+    def handle(self, *args, **options):
+        engine = settings.DATABASES['default']['ENGINE']
+        if engine.endswith('sqlite3') and not options['no_migrate']:
+            call_command('migrate', verbosity=0, interactive=False)
+
+        scenario = SCENARIOS[options['scenario']]
+        try:
+            if options['verbose_app']:
+                result = scenario(options)
+            else:
+                # The consumers print on every frame; keep that out of the report.
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    result = scenario(options)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        report = {
+            'scenario': options['scenario'],
+            'python': sys.version.split()[0],
+            'database': engine,
+            'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+            'config': {key: options[key] for key in CONFIG_KEYS[options['scenario']]},
+            'result': result,
+        }
+        output = json.dumps(report, indent=2, default=str)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
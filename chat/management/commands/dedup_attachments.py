@@ -0,0 +1,58 @@
+import os
+import shutil
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat import blobs
+from chat.models import FileAttachment
+
+
+class Command(BaseCommand):
+    help = ("Move attachments uploaded before content-addressed storage into the blob layout, "
+            "hashing them and merging duplicates. Safe to interrupt and rerun.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Attachments read per query.')
+        parser.add_argument('--limit', type=int, help='Stop after this many attachments.')
+
+    def handle(self, *args, **options):
+        hashed = merged = freed = missing = 0
+        last_id = 0
+        while options['limit'] is None or hashed + missing < options['limit']:
+            batch_size = options['batch_size']
+            if options['limit'] is not None:
+                batch_size = min(batch_size, options['limit'] - hashed - missing)
+            batch = list(FileAttachment.objects.filter(blob__isnull=True, id__gt=last_id)
+                         .order_by('id').values_list('id', 'file')[:batch_size])
+            if not batch:
+                break
+            for pk, name in batch:
+                last_id = pk
+                path = default_storage.path(name)
+                if not os.path.exists(path):
+                    missing += 1
+                    continue
+                size = os.path.getsize(path)
+                digest = blobs.file_sha256(path)
+                with transaction.atomic():
+                    if not FileAttachment.objects.filter(pk=pk, blob__isnull=True).update(file=blobs.blob_name(digest)):
+                        continue
+                    blob = blobs.acquire(digest, size)
+                    FileAttachment.objects.filter(pk=pk).update(blob=blob)
+                hashed += 1
+                final = default_storage.path(blobs.blob_name(digest))
+                if os.path.exists(final):
+                    merged += 1
+                    freed += size
+                if FileAttachment.objects.filter(file=name).exists():
+                    # Another legacy row still names this file; leave it for that row
+                    if not os.path.exists(final):
+                        os.makedirs(os.path.dirname(final), exist_ok=True)
+                        shutil.copyfile(path, final)
+                else:
+                    blobs.place(path, digest)
+
+        self.stdout.write(f"Hashed {hashed} attachment(s): {merged} duplicate(s) merged, {freed} bytes freed, "
+                          f"{missing} missing file(s).")
@@ -0,0 +1,158 @@
+import json
+import re
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from chat.benchmarks import seed_dataset
+from chat.models import Channel, DirectMessageChannel, Message, Team, TeamInvitation, UserPresence
+
+# PostgreSQL: "Seq Scan on chat_message"; SQLite: "SCAN chat_message" (a
+# "SCAN ... USING INDEX" walks an index and is not a table scan).
+SEQ_SCAN_PATTERNS = [
+    re.compile(r"Seq Scan on (\w+)"),
+    re.compile(r"\bSCAN (\w+)(?! USING)\s*$", re.MULTILINE),
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+def hot_queries(ds):
+    """The app's hot lookups, written as the views and consumers write them."""
+    now = timezone.now()
+    channel = ds['channel']
+    team = ds['team']
+    user = ds['user']
+    dm = ds['dm']
+    return [
+        ('channel_history', 'ChatConsumer.get_channel_messages',
+         Message.objects.filter(channel_id=channel.id).order_by('created_at')),
+        ('pinned_messages', 'Message.pinned_in',
+         Message.pinned_in(channel.id)),
+        ('team_presences', 'ChatConsumer.get_team_presences',
+         UserPresence.objects.filter(team_id=team.id).select_related('user')),
+        ('dm_channel_lookup', 'ChannelViewSet.create_or_get_dm_channel',
+         DirectMessageChannel.objects.filter(user1=dm.user1_id, user2=dm.user2_id, channel__team=team)),
+        ('dm_partners', 'ChatConsumer.get_interacted_users',
+         DirectMessageChannel.objects.filter(Q(user1=user) | Q(user2=user), channel__team_id=team.id)),
+        ('invitation_by_code', 'TeamViewSet.join_via_invitation',
+         TeamInvitation.objects.filter(invite_code=ds['invite_code'], is_active=True, expires_at__gt=now)),
+        ('team_invitations', 'TeamViewSet.invitations',
+         TeamInvitation.objects.filter(team=team, is_active=True, expires_at__gt=now)),
+        ('user_teams', 'ChatConsumer.get_user_teams',
+         Team.objects.filter(members=user)),
+        ('user_channels', 'ChatConsumer.get_user_channels',
+         Channel.objects.filter(team__members=user, members=user)),
+        ('channel_access', 'ChatConsumer.validate_channel_access',
+         Channel.objects.filter(id=channel.id, members=user)),
+    ]
+
+
+def seq_scans(plan):
+    tables = []
+    for pattern in SEQ_SCAN_PATTERNS:
+        tables.extend(pattern.findall(plan))
+    return sorted(set(tables))
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the app's hot queries on a seeded dataset and flag sequential scans."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--teams', type=int, default=10)
+        parser.add_argument('--channels', type=int, default=50)
+        parser.add_argument('--history', type=int, default=200, help='Seeded messages per channel.')
+        parser.add_argument('--allow-seqscan', action='store_true',
+                            help='On PostgreSQL, let the planner pick sequential scans (by default they are '
+                                 'disabled so that any remaining one means no usable index).')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+        parser.add_argument('--fail-on-seqscan', action='store_true',
+                            help='Exit with an error if any query plans a sequential scan.')
+
+    def handle(self, *args, **options):
+        report = []
+        # Seed, explain and roll everything back so the audit leaves no rows behind.
+        try:
+            with transaction.atomic():
+                ds = self.seed(options)
+                if connection.vendor == 'postgresql':
+                    with connection.cursor() as cursor:
+                        cursor.execute('ANALYZE')
+                        if not options['allow_seqscan']:
+                            cursor.execute('SET LOCAL enable_seqscan = off')
+                for name, origin, queryset in hot_queries(ds):
+                    plan = queryset.explain()
+                    report.append({
+                        'name': name,
+                        'origin': origin,
+                        'seq_scans': seq_scans(plan),
+                        'plan': plan,
+                    })
+                raise Rollback
+        except Rollback:
+            pass
+
+        flagged = [entry for entry in report if entry['seq_scans']]
+        if options['json']:
+            self.stdout.write(json.dumps({'vendor': connection.vendor, 'queries': report}, indent=2))
+        else:
+            for entry in report:
+                status = (self.style.ERROR(f"SEQ SCAN on {', '.join(entry['seq_scans'])}")
+                          if entry['seq_scans'] else self.style.SUCCESS('ok'))
+                self.stdout.write(f"{entry['name']} ({entry['origin']}): {status}")
+                for line in entry['plan'].splitlines():
+                    self.stdout.write(f"    {line}")
+            self.stdout.write(f"{len(flagged)} of {len(report)} queries plan a sequential scan.")
+
+        if flagged and options['fail_on_seqscan']:
+            raise CommandError(f"Sequential scans in: {', '.join(entry['name'] for entry in flagged)}")
+
+    def seed(self, options):
+        dataset = seed_dataset(
+            users=options['users'],
+            teams=options['teams'],
+            channels=options['channels'],
+            history=options['history'],
+        )
+        team = dataset.teams[0]
+        members = sorted(uid for uid, tid in dataset.user_teams.items() if tid == team.id)
+        user_id = members[0]
+        channel = next(c for c in dataset.channels if c.team_id == team.id)
+
+        # DM channels between the first member and everyone else in the team
+        dms = []
+        for other in members[1:]:
+            dm_channel = Channel.objects.create(name=f"DM {user_id}-{other}", team=team,
+                                                is_direct_message=True, channel_type='direct')
+            dm_channel.members.add(user_id, other)
+            dms.append(DirectMessageChannel.objects.create(channel=dm_channel, user1_id=user_id, user2_id=other))
+
+        UserPresence.objects.bulk_create([
+            UserPresence(user_id=uid, team_id=tid) for uid, tid in dataset.user_teams.items()
+        ])
+
+        now = timezone.now()
+        invitations = TeamInvitation.objects.bulk_create([
+            TeamInvitation(team=t, created_by_id=members[0], invite_code=get_random_string(12),
+                           expires_at=now + timedelta(days=7 if i % 3 else -1), is_active=bool(i % 4))
+            for t in dataset.teams
+            for i in range(20)
+        ])
+
+        for channel_id, message_ids in dataset.history.items():
+            Message.objects.filter(id__in=message_ids[::50]).update(is_pinned=True, pinned_at=now)
+
+        return {
+            'team': team,
+            'channel': channel,
+            'user': dataset.users[[u.id for u in dataset.users].index(user_id)],
+            'dm': dms[0] if dms else None,
+            'invite_code': invitations[0].invite_code,
+        }
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat import revocation
+
+
+class Command(BaseCommand):
+    help = "Delete expired outstanding and blacklisted JWTs in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Tokens deleted per query.')
+
+    def handle(self, *args, **options):
+        deleted = revocation.purge_expired(options['batch_size'])
+        self.stdout.write(f"Deleted {deleted} expired token(s).")
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from chat import uploads
+
+
+class Command(BaseCommand):
+    help = "Delete chunked uploads idle for longer than CHAT_UPLOADS['SESSION_TTL'], with their partial files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int,
+                            help='Idle seconds after which a session is stale (default: SESSION_TTL).')
+        parser.add_argument('--batch-size', type=int, default=500, help='Sessions deleted per query.')
+
+    def handle(self, *args, **options):
+        purged = uploads.purge_stale(batch_size=options['batch_size'], ttl=options['older_than'])
+        self.stdout.write(f"Purged {purged} stale upload session(s).")
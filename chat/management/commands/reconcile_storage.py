@@ -0,0 +1,27 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from chat import storage
+from chat.models import Team
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-user and per-team storage counters and correct any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Users or teams recomputed per transaction.')
+
+    def handle(self, *args, **options):
+        for label, model, reconcile in (('user', User, storage.reconcile_users),
+                                        ('team', Team, storage.reconcile_teams)):
+            checked = drifted = 0
+            last_id = 0
+            while True:
+                ids = list(model.objects.filter(id__gt=last_id).order_by('id')
+                           .values_list('id', flat=True)[:options['batch_size']])
+                if not ids:
+                    break
+                drifted += reconcile(ids)
+                checked += len(ids)
+                last_id = ids[-1]
+            self.stdout.write(f"Checked {checked} {label} counter(s), corrected {drifted}.")
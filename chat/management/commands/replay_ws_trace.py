@@ -0,0 +1,61 @@
+import json
+import os
+from contextlib import redirect_stdout
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.replay import parse_speed, replay_trace
+
+
+class Command(BaseCommand):
+    help = "Replay a recorded WebSocket trace (see CHAT_WS_TRACE_PATH) against the local ASGI app."
+
+    def add_arguments(self, parser):
+        parser.add_argument('trace', help='JSONL trace written by chat.recorder.')
+        parser.add_argument('--speed', default='max', help='Playback speed: 1, 10 (or 10x), or max.')
+        parser.add_argument('--timeout', type=float, default=10.0, help='Seconds to wait for each reply.')
+        parser.add_argument('--history', type=int, default=20, help='Seeded messages per channel.')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+        parser.add_argument('--no-migrate', action='store_true',
+                            help='Skip applying migrations to an SQLite database.')
+        parser.add_argument('--verbose-app', action='store_true',
+                            help='Keep application prints instead of discarding them during the run.')
+
+    def handle(self, *args, **options):
+        try:
+            speed = parse_speed(options['speed'])
+        except ValueError:
+            raise CommandError(f"Invalid speed: {options['speed']}")
+        if not os.path.exists(options['trace']):
+            raise CommandError(f"Trace not found: {options['trace']}")
+
+        engine = settings.DATABASES['default']['ENGINE']
+        if engine.endswith('sqlite3') and not options['no_migrate']:
+            call_command('migrate', verbosity=0, interactive=False)
+
+        run = lambda: replay_trace(options['trace'], speed=speed, timeout=options['timeout'],
+                                   history=options['history'])
+        try:
+            if options['verbose_app']:
+                result = run()
+            else:
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    result = run()
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        report = {
+            'trace': options['trace'],
+            'speed': options['speed'],
+            'database': engine,
+            'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+            'result': result,
+        }
+        output = json.dumps(report, indent=2, default=str)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
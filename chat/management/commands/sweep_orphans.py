@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from chat import sweeper
+
+
+class Command(BaseCommand):
+    help = ("Delete attachments linked to no message, and files under MEDIA_ROOT that no row accounts for, "
+            "once they are older than the grace period.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help='Leave attachments and files younger than this alone.')
+        parser.add_argument('--batch-size', type=int, default=200, help='Rows deleted / files looked up per query.')
+        parser.add_argument('--rate', type=float, default=200,
+                            help='Maximum deletions per second; 0 for no limit.')
+        parser.add_argument('--skip-disk', action='store_true', help='Only sweep attachment rows.')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted.')
+
+    def handle(self, *args, **options):
+        grace = timedelta(hours=options['grace_hours'])
+        limiter = sweeper.RateLimiter(options['rate'])
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+
+        rows = sweeper.sweep_attachments(grace, options['batch_size'], limiter, options['dry_run'])
+        self.stdout.write(f"{verb} {rows} orphaned attachment(s).")
+        if options['skip_disk']:
+            return
+        for label, (count, size) in sweeper.sweep_files(grace, options['batch_size'], limiter,
+                                                        options['dry_run']).items():
+            self.stdout.write(f"{verb} {count} unreferenced {label} ({size} bytes).")
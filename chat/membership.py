@@ -0,0 +1,226 @@
+"""
+Membership changes in bulk, and live updates for connected WebSockets.
+
+A ``ChatConsumer`` joins its team and channel groups when it connects. A
+user added to a channel or team afterwards used to see nothing from it
+until the client reconnected, and on a large team everyone reconnected at
+once. Now every membership change sends a ``membership.changed`` control
+event to each affected user's ``user_{id}`` group::
+
+    {"type": "membership.changed",
+     "channels_added": [...], "channels_removed": [...],
+     "teams_added": [...], "teams_removed": [...]}
+
+The user's consumers call ``group_add`` / ``group_discard`` for those
+groups in place, and pass the event on to the client as
+``membership_changed`` so it can refresh its lists. With user routing
+(``chat.fanout``) there are no groups to change; the client is still told.
+
+Changes made with the ORM (``members.add``, ``remove``, ``set``,
+``clear`` on either side) are picked up by the ``m2m_changed`` receiver
+below. Code that writes the through tables directly calls ``notify``. The
+events go out when the transaction commits, never for a rollback. One
+change covering many users, such as creating a channel for a whole team,
+sends a single message per user, ``fanout.send_to_users`` batching the
+sends.
+
+The functions at the bottom change membership for many users at once, as
+provisioning and large teams need. ``members.add`` and ``members.set``
+load the existing rows and go through the ORM per relation. These
+functions write the through tables directly instead:
+
+- ``add_team_members`` / ``remove_team_members`` insert with
+  ``ignore_conflicts`` and delete by ``user_id__in``, ``batch_size`` users
+  per statement, for the team and its public channels together.
+- ``add_channel_members`` / ``remove_channel_members`` do the same for one
+  channel. Only members of the channel's team are added.
+- ``fill_from_team`` adds a whole team to a channel in a single
+  ``INSERT ... SELECT`` and tells the team with one group message, without
+  loading the members at all.
+
+Each runs in one transaction, and drops the affected ``chat.fanout`` index
+entries and sends its events when that commits.
+"""
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from . import fanout
+from .models import Channel, Team
+
+logger = logging.getLogger('chat.membership')
+
+EVENT = 'membership.changed'
+
+KINDS = ('channels_added', 'channels_removed', 'teams_added', 'teams_removed')
+
+
+BATCH_SIZE = 1000
+
+
+def _message(changes):
+    return {'type': EVENT, **{kind: sorted(changes.get(kind, ())) for kind in KINDS}}
+
+
+def _send(user_ids, changes):
+    try:
+        async_to_sync(fanout.send_to_users)(get_channel_layer(), user_ids, _message(changes))
+    except Exception:
+        # The change itself is committed; affected clients catch up when they reconnect
+        logger.exception("Sending membership changes to %d user(s) failed", len(user_ids))
+
+
+def _send_team(team_id, changes):
+    try:
+        async_to_sync(fanout.send_to_team)(get_channel_layer(), team_id, _message(changes))
+    except Exception:
+        logger.exception("Sending membership changes to team %s failed", team_id)
+
+
+def notify(user_ids, **changes):
+    """Tell ``user_ids`` about ``changes`` (lists of ids keyed by ``KINDS``) once the transaction commits."""
+    user_ids = list(user_ids)
+    if user_ids and any(changes.values()):
+        transaction.on_commit(lambda: _send(user_ids, changes))
+
+
+def notify_team(team_id, **changes):
+    """Tell every member of team ``team_id`` about ``changes``, with one group message per process."""
+    transaction.on_commit(lambda: _send_team(team_id, changes))
+
+
+@receiver(m2m_changed, sender=Channel.members.through)
+@receiver(m2m_changed, sender=Team.members.through)
+def members_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    kind = 'channels' if sender is Channel.members.through else 'teams'
+    if action == 'pre_clear':
+        # Who is about to lose membership is only known before the clear
+        lookup = 'members' if reverse else kind
+        pk_set = set(model.objects.filter(**{lookup: instance}).values_list('pk', flat=True))
+        action = 'post_remove'
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    change = f"{kind}_{'added' if action == 'post_add' else 'removed'}"
+    if reverse:
+        # user.channels.add(...): one user, the pk_set changed
+        notify([instance.pk], **{change: pk_set})
+    else:
+        # channel.members.add(...): these users, the one instance changed
+        notify(pk_set, **{change: [instance.pk]})
+
+
+def _chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _ids(values):
+    return sorted({int(value) for value in values})
+
+
+def _existing_users(user_ids, batch_size, team_id=None):
+    """The ids among ``user_ids`` of existing users (members of ``team_id`` if given)."""
+    if team_id is None:
+        queryset = get_user_model().objects.values_list('id', flat=True)
+        field = 'id__in'
+    else:
+        queryset = Team.members.through.objects.filter(team_id=team_id).values_list('user_id', flat=True)
+        field = 'user_id__in'
+    found = []
+    for chunk in _chunks(user_ids, batch_size):
+        found.extend(queryset.filter(**{field: chunk}))
+    return sorted(found)
+
+
+def _insert_channel_rows(channel_ids, user_ids, batch_size):
+    through = Channel.members.through
+    # About batch_size rows per statement, whatever the channel count
+    per_chunk = max(1, batch_size // max(1, len(channel_ids)))
+    for chunk in _chunks(user_ids, per_chunk):
+        through.objects.bulk_create([through(channel_id=channel_id, user_id=user_id)
+                                     for user_id in chunk for channel_id in channel_ids],
+                                    ignore_conflicts=True)
+
+
+def add_team_members(team, user_ids, batch_size=BATCH_SIZE):
+    """Add existing users among ``user_ids`` to ``team`` and its public channels; returns their ids."""
+    user_ids = _existing_users(_ids(user_ids), batch_size)
+    if not user_ids:
+        return []
+    channel_ids = list(team.channels.filter(is_direct_message=False).values_list('id', flat=True))
+    through = Team.members.through
+    with transaction.atomic():
+        for chunk in _chunks(user_ids, batch_size):
+            through.objects.bulk_create([through(team_id=team.id, user_id=user_id) for user_id in chunk],
+                                        ignore_conflicts=True)
+        _insert_channel_rows(channel_ids, user_ids, batch_size)
+        # Also drops every channel: their recipients depend on team membership
+        fanout.forget_teams([team.id])
+        notify(user_ids, teams_added=[team.id], channels_added=channel_ids)
+    return user_ids
+
+
+def remove_team_members(team, user_ids, batch_size=BATCH_SIZE):
+    """Remove ``user_ids`` from ``team`` and its public channels; returns how many left the team."""
+    user_ids = _ids(user_ids)
+    channel_ids = list(team.channels.filter(is_direct_message=False).values_list('id', flat=True))
+    removed = 0
+    with transaction.atomic():
+        for chunk in _chunks(user_ids, batch_size):
+            removed += Team.members.through.objects.filter(team_id=team.id, user_id__in=chunk).delete()[0]
+            Channel.members.through.objects.filter(channel_id__in=channel_ids, user_id__in=chunk).delete()
+        fanout.forget_teams([team.id])
+        notify(user_ids, teams_removed=[team.id], channels_removed=channel_ids)
+    return removed
+
+
+def add_channel_members(channel, user_ids, batch_size=BATCH_SIZE):
+    """Add the members of ``channel``'s team among ``user_ids`` to it; returns their ids."""
+    user_ids = _existing_users(_ids(user_ids), batch_size, team_id=channel.team_id)
+    if not user_ids:
+        return []
+    with transaction.atomic():
+        _insert_channel_rows([channel.id], user_ids, batch_size)
+        fanout.forget_channels([channel.id])
+        notify(user_ids, channels_added=[channel.id])
+    return user_ids
+
+
+def remove_channel_members(channel, user_ids, batch_size=BATCH_SIZE):
+    """Remove ``user_ids`` from ``channel``; returns how many were members."""
+    user_ids = _ids(user_ids)
+    removed = 0
+    with transaction.atomic():
+        for chunk in _chunks(user_ids, batch_size):
+            removed += Channel.members.through.objects.filter(channel_id=channel.id, user_id__in=chunk).delete()[0]
+        fanout.forget_channels([channel.id])
+        notify(user_ids, channels_removed=[channel.id])
+    return removed
+
+
+def fill_from_team(channel):
+    """Make every member of ``channel``'s team a member of it, in one statement; returns the rows added."""
+    channel_members, team_members = Channel.members.through._meta, Team.members.through._meta
+    qn = connection.ops.quote_name
+    channel_column = qn(channel_members.get_field('channel').column)
+    user_column = qn(channel_members.get_field('user').column)
+    team_user_column = qn(team_members.get_field('user').column)
+    sql = (
+        f"INSERT INTO {qn(channel_members.db_table)} ({channel_column}, {user_column}) "
+        f"SELECT %s, t.{team_user_column} FROM {qn(team_members.db_table)} t "
+        f"WHERE t.{qn(team_members.get_field('team').column)} = %s AND NOT EXISTS ("
+        f"SELECT 1 FROM {qn(channel_members.db_table)} c "
+        f"WHERE c.{channel_column} = %s AND c.{user_column} = t.{team_user_column})"
+    )
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [channel.id, channel.team_id, channel.id])
+            added = cursor.rowcount
+        fanout.forget_channels([channel.id])
+        notify_team(channel.team_id, channels_added=[channel.id])
+    return added
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_edit_history_message_edited_at_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['channel', 'created_at', 'id'], name='message_channel_created_idx'),
+        ),
+        # The composite index above leads with channel, so the single-column
+        # FK index is dropped only once it exists.
+        migrations.AlterField(
+            model_name='message',
+            name='channel',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.channel'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_pinned', True)), fields=['channel', 'created_at'], name='message_pinned_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='teaminvitation',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['team', 'expires_at'], name='invitation_active_idx'),
+        ),
+    ]
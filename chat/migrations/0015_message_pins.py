@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_pinned_at(apps, schema_editor):
+    # Pins made before pinned_at existed keep their message order
+    Message = apps.get_model('chat', 'Message')
+    Message.objects.filter(is_pinned=True, pinned_at__isnull=True).update(pinned_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_message_and_invitation_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_pinned_idx',
+        ),
+        migrations.RemoveField(
+            model_name='channel',
+            name='pinned_message_id',
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='pinned_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='pinned_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='pinned_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_pinned_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_pinned', True)), fields=['channel', 'pinned_at', 'id'], name='message_pinned_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_message_pins'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkPreview',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url_hash', models.CharField(max_length=64, unique=True)),
+                ('url', models.TextField()),
+                ('title', models.TextField(blank=True, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('image', models.TextField(blank=True, null=True)),
+                ('site_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('ok', models.BooleanField(default=True)),
+                ('etag', models.CharField(blank=True, max_length=255)),
+                ('last_modified', models.CharField(blank=True, max_length=64)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='preview',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='messages', to='chat.linkpreview'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0018_stored_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedblob',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='storedblob',
+            name='placeholder',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='storedblob',
+            name='thumbnails',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='storedblob',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
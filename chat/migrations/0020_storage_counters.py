@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0019_blob_image_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamStorage',
+            fields=[
+                ('team', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage', serialize=False, to='chat.team')),
+                ('bytes', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserStorage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('bytes', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
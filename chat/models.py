@@ -1,6 +1,7 @@
 from datetime import timezone
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
 from django.utils import timezone
 import os
 import uuid
@@ -23,17 +24,97 @@ def get_file_path(instance, filename):
     filename = f"{uuid.uuid4()}.{ext}"
     return os.path.join('uploads', filename)
 
+def thumb_name(digest, size):
+    """Storage name of a blob's thumbnail that fits ``size`` x ``size``."""
+    return os.path.join('thumbs', digest[:2], digest[2:4], digest, f"{size}.webp")
+
+class StoredBlob(models.Model):
+    """File content stored once under its SHA-256; see chat.blobs"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    # Number of FileAttachment rows that point at this blob
+    refs = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Filled in by chat.thumbnails for images; thumbnails stays None until processed
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    placeholder = models.CharField(max_length=64, blank=True)
+    thumbnails = models.JSONField(null=True, blank=True)
+
+    def __str__(self):
+        return self.sha256
+
+    def image_dict(self):
+        """Dimensions, placeholder and thumbnail URLs; empty until processed or if not an image."""
+        if self.width is None:
+            return {}
+        return {
+            'width': self.width,
+            'height': self.height,
+            'placeholder': self.placeholder,
+            'thumbnails': {str(size): default_storage.url(thumb_name(self.sha256, size)) for size in self.thumbnails},
+        }
+
 class FileAttachment(models.Model):
     file = models.FileField(upload_to=get_file_path)
+    # Null only for files uploaded before content-addressed storage
+    blob = models.ForeignKey(StoredBlob, null=True, blank=True, on_delete=models.PROTECT, related_name='attachments')
     original_filename = models.CharField(max_length=255)
     content_type = models.CharField(max_length=100)
-    size = models.IntegerField()  # Size in bytes
+    size = models.BigIntegerField()  # Size in bytes
     uploaded_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploaded_files')
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.original_filename
 
+    def to_dict(self):
+        """Attachment payload used in WebSocket message events; expects ``blob`` to be selected."""
+        return {
+            'id': self.id,
+            'filename': self.original_filename,
+            'url': self.file.url,
+            'content_type': self.content_type,
+            'size': self.size,
+            **(self.blob.image_dict() if self.blob_id else {}),
+        }
+
+class UserStorage(models.Model):
+    """Bytes of attachments a user has uploaded; maintained by chat.storage"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='storage')
+    bytes = models.BigIntegerField(default=0)
+
+class UploadSession(models.Model):
+    """A chunked upload in progress; see chat.uploads"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uploaded_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    # Storage name the chunks are written to; it becomes the attachment's file
+    file = models.CharField(max_length=255)
+    original_filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    # Bytes received and verified so far, i.e. the offset of the next chunk
+    received = models.BigIntegerField(default=0)
+    # Expected SHA-256 of the whole file, if the client gave one
+    checksum = models.CharField(max_length=64, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Stale sessions for purge_upload_sessions
+            models.Index(fields=['updated_at'], name='upload_session_updated_idx'),
+        ]
+
+    def to_dict(self):
+        return {
+            'upload_id': str(self.id),
+            'filename': self.original_filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'offset': self.received,
+        }
+
 class Channel(models.Model):
     CHANNEL_TYPES = (
         ('group', 'Group Channel'),
@@ -46,7 +127,6 @@ class Channel(models.Model):
     members = models.ManyToManyField(User, related_name='channels')
     created_at = models.DateTimeField(auto_now_add=True)
     channel_type = models.CharField(max_length=10, choices=CHANNEL_TYPES, default='group')
-    pinned_message_id = models.CharField(max_length=100, blank=True, null=True)
     # For DM channels, we'll use this to store the participants
     is_direct_message = models.BooleanField(default=False)
     
@@ -56,15 +136,52 @@ class Channel(models.Model):
     def __str__(self):
         return self.name
 
+class TeamStorage(models.Model):
+    """Bytes of attachments linked to messages in a team's channels; maintained by chat.storage"""
+    # Kept off Team so that saving a team never overwrites a concurrent update
+    team = models.OneToOneField(Team, on_delete=models.CASCADE, primary_key=True, related_name='storage')
+    bytes = models.BigIntegerField(default=0)
+
+class LinkPreview(models.Model):
+    """Server-fetched preview of a URL, shared by every message that links it"""
+    # sha256 of the normalized URL (see chat.previews.normalize_url)
+    url_hash = models.CharField(max_length=64, unique=True)
+    url = models.TextField()
+    title = models.TextField(null=True, blank=True)
+    description = models.TextField(null=True, blank=True)
+    image = models.TextField(null=True, blank=True)
+    site_name = models.CharField(max_length=255, null=True, blank=True)
+    # False when the last fetch failed and there was nothing to keep
+    ok = models.BooleanField(default=True)
+    # Validators for conditional revalidation
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    fetched_at = models.DateTimeField()
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'title': self.title,
+            'description': self.description,
+            'image': self.image,
+            'site_name': self.site_name
+        }
+
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField()
-    channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='messages')
+    # Indexed through message_channel_created_idx below, which leads with channel
+    channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name='messages', db_index=False)
     reply_to = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='replies')
     reactions = models.JSONField(null=True, blank=True)
+    # Legacy client-supplied preview; new messages reference a shared LinkPreview instead
     link_preview = models.JSONField(null=True, blank=True)
+    preview = models.ForeignKey(LinkPreview, null=True, blank=True, on_delete=models.SET_NULL, related_name='messages')
     is_forwarded = models.BooleanField(default=False, null=True)
     is_pinned = models.BooleanField(default=False, null=True)
+    # Pins are listed in the order they were made
+    pinned_at = models.DateTimeField(null=True, blank=True)
+    pinned_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='pinned_messages')
     created_at = models.DateTimeField(auto_now_add=True)
     is_edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
@@ -73,6 +190,37 @@ class Message(models.Model):
 
     class Meta:
         ordering = ('created_at',)
+        indexes = [
+            # Channel history: filter(channel_id=...).order_by('created_at')
+            models.Index(fields=['channel', 'created_at', 'id'], name='message_channel_created_idx'),
+            # Pinned messages of a channel in pin order; only the few pinned rows are indexed
+            models.Index(fields=['channel', 'pinned_at', 'id'], condition=models.Q(is_pinned=True),
+                         name='message_pinned_idx'),
+        ]
+
+    @classmethod
+    def pinned_in(cls, channel_id):
+        return (
+            cls.objects.filter(channel_id=channel_id, is_pinned=True)
+            .select_related('sender', 'pinned_by')
+            .order_by('pinned_at', 'id')
+        )
+
+    def preview_dict(self):
+        """Preview to send to clients; expects ``preview`` to be selected"""
+        return self.preview.to_dict() if self.preview_id else self.link_preview
+
+    def to_pin_dict(self):
+        return {
+            'id': self.id,
+            'content': self.content,
+            'sender': self.sender.username,
+            'sender_id': self.sender_id,
+            'timestamp': str(self.created_at),
+            'pinned_at': self.pinned_at.isoformat() if self.pinned_at else None,
+            'pinned_by': self.pinned_by.username if self.pinned_by else None,
+            'pinned_by_id': self.pinned_by_id,
+        }
 
     def __str__(self):
         try:
@@ -90,6 +238,11 @@ class TeamInvitation(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Active invitations of a team; revoked ones are left out of the index
+            models.Index(fields=['team', 'expires_at'], condition=models.Q(is_active=True),
+                         name='invitation_active_idx'),
+        ]
 
 class DirectMessageChannel(models.Model):
     channel = models.OneToOneField(Channel, on_delete=models.CASCADE, related_name='dm_metadata')
@@ -115,3 +268,25 @@ class UserPresence(models.Model):
 
     class Meta:
         unique_together = ('user', 'team')
+
+
+class ClaimsUser(User):
+    """A ``User`` built from verified token claims, without a query (see ``chat.auth``).
+
+    Only ``id`` and ``username`` are loaded. The first access to any other
+    field loads the rest of the row in one query. Being a ``User``, it can be
+    assigned to foreign keys and used in filters like the full model.
+    """
+
+    class Meta:
+        proxy = True
+
+    @classmethod
+    def from_claims(cls, user_id, username):
+        return cls.from_db(None, ['id', 'username'], [cls._meta.pk.to_python(user_id), username])
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        deferred = self.get_deferred_fields()
+        if fields is not None and deferred.issuperset(fields):
+            fields = deferred
+        super().refresh_from_db(using, fields, from_queryset)
@@ -0,0 +1,344 @@
+"""
+Asynchronous link previews.
+
+``PreviewService.fetch(url)`` normalizes the URL and looks it up in three
+places, cheapest first:
+
+1. A process-local TTL+LRU cache of fresh previews.
+2. The ``LinkPreview`` table, keyed by the SHA-256 of the normalized URL and
+   shared by every worker. A row younger than ``CACHE_TTL`` is served as is.
+   A row that is stale but within ``STALE_WHILE_REVALIDATE`` more seconds is
+   served immediately while a background conditional GET (``If-None-Match``
+   / ``If-Modified-Since``) refreshes it. Older rows are revalidated before
+   answering.
+3. The site itself, on a pooled ``httpx.AsyncClient`` with at most
+   ``PER_HOST_LIMIT`` concurrent requests per host. Only ``<head>`` is read:
+   the body is streamed into ``HeadPreviewParser`` until ``</head>`` or
+   ``MAX_HEAD_BYTES``, and non-HTML responses are skipped from their headers.
+
+Only public addresses are fetched. The host is resolved first and the
+request goes to the checked address, with the ``Host`` header and TLS SNI
+of the original name. That way a rebinding DNS answer cannot swap in
+another address. Loopback, private, link-local (cloud metadata), reserved
+and multicast addresses are refused unless listed in ``ALLOWED_NETWORKS``.
+Redirects are followed one hop at a time, each checked the same way.
+
+Concurrent lookups of the same URL share one in-flight task. Failed fetches
+are remembered for ``NEGATIVE_TTL`` seconds, so a dead link pasted
+repeatedly is not retried on every paste; a row that already had a good
+preview keeps it.
+
+The HTTP client, in-flight tasks and host limits belong to the running event
+loop, because asyncio objects cannot be shared between loops. Background
+revalidation needs a long-lived loop (the ASGI server's); under a short-lived
+``async_to_sync`` loop it is cancelled with the loop.
+"""
+import asyncio
+import hashlib
+import ipaddress
+import logging
+import socket
+import weakref
+from datetime import timedelta
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+import httpx
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import TTLCache
+from .models import LinkPreview
+from .utils import USER_AGENT, HeadPreviewParser, empty_link_preview, is_html_response
+
+logger = logging.getLogger('chat.previews')
+
+DEFAULTS = {
+    'TIMEOUT': 5.0,
+    'CACHE_SIZE': 2048,
+    'CACHE_TTL': 60 * 60,
+    'NEGATIVE_TTL': 5 * 60,
+    'STALE_WHILE_REVALIDATE': 7 * 24 * 60 * 60,
+    'PER_HOST_LIMIT': 4,
+    'MAX_CONNECTIONS': 100,
+    'MAX_REDIRECTS': 5,
+    'MAX_HEAD_BYTES': 256 * 1024,
+    'MAX_CONTENT_LENGTH': 10 * 1024 * 1024,
+    'UNFURL_CONCURRENCY': 8,
+    'UNFURL_QUEUE': 256,
+    # CIDRs fetched even though they are not public, e.g. ['10.1.0.0/16']
+    'ALLOWED_NETWORKS': [],
+}
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Outcome of a conditional GET answered with 304
+NOT_MODIFIED = object()
+
+
+class BlockedAddress(Exception):
+    """A preview URL whose host is, or resolves to, an address that must not be fetched"""
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_LINK_PREVIEW', {})}
+
+
+def normalize_url(url):
+    """Canonical form of ``url``; raises ``ValueError`` for non-HTTP URLs."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        raise ValueError(f"Not an http(s) URL: {url!r}")
+    host = parts.hostname.lower()
+    if ':' in host:
+        host = f"[{host}]"
+    if parts.port and parts.port != DEFAULT_PORTS[scheme]:
+        host = f"{host}:{parts.port}"
+    return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+
+def url_hash(normalized_url):
+    return hashlib.sha256(normalized_url.encode('utf-8')).hexdigest()
+
+
+def stored_preview(url):
+    """The ``LinkPreview`` row for ``url``, if any (sync; never fetches)."""
+    try:
+        key = normalize_url(url)
+    except (ValueError, AttributeError):
+        return None
+    return LinkPreview.objects.filter(url_hash=url_hash(key)).first()
+
+
+def fresh_preview(url):
+    """The stored preview of ``url`` if it succeeded, has content and is younger than ``CACHE_TTL``.
+
+    Failed, empty and stale rows return None, so the message is unfurled
+    and the row refetched or revalidated (sync; never fetches).
+    """
+    try:
+        key = normalize_url(url)
+    except (ValueError, AttributeError):
+        return None
+    fresh_since = timezone.now() - timedelta(seconds=config()['CACHE_TTL'])
+    row = LinkPreview.objects.filter(url_hash=url_hash(key), ok=True, fetched_at__gt=fresh_since).first()
+    if row is None or not (row.title or row.description or row.image):
+        return None
+    return row
+
+
+class _LoopState:
+    """The HTTP client and bookkeeping owned by one event loop."""
+
+    def __init__(self, options, transport):
+        self.client = httpx.AsyncClient(
+            headers={'User-Agent': USER_AGENT},
+            timeout=options['TIMEOUT'],
+            # Followed by PreviewService._request, which checks every hop
+            follow_redirects=False,
+            limits=httpx.Limits(max_connections=options['MAX_CONNECTIONS']),
+            transport=transport,
+        )
+        self.inflight = {}
+        self.revalidating = {}
+        # host -> [semaphore, number of fetches holding or waiting for it]
+        self.hosts = {}
+
+
+class PreviewService:
+    def __init__(self, options=None, transport=None):
+        self.options = {**config(), **(options or {})}
+        self.transport = transport
+        self.cache = TTLCache(self.options['CACHE_SIZE'], self.options['CACHE_TTL'])
+        self.allowed_networks = [ipaddress.ip_network(network) for network in self.options['ALLOWED_NETWORKS']]
+        self._states = weakref.WeakKeyDictionary()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._states.get(loop)
+        if state is None:
+            state = self._states[loop] = _LoopState(self.options, self.transport)
+        return state
+
+    def _ttl(self, ok):
+        return self.options['CACHE_TTL'] if ok else self.options['NEGATIVE_TTL']
+
+    async def fetch(self, url):
+        """Preview dict for ``url``; raises ``ValueError`` if it is not an http(s) URL."""
+        return (await self.fetch_row(url)).to_dict()
+
+    async def fetch_row(self, url):
+        """``LinkPreview`` row for ``url``, fetched or revalidated as needed."""
+        key = normalize_url(url)
+        digest = url_hash(key)
+        row = self.cache.get(digest)
+        if row is not None:
+            return row
+
+        state = self._state()
+        task = state.inflight.get(digest)
+        if task is None:
+            task = state.inflight[digest] = asyncio.ensure_future(self._load(state, key, digest))
+            task.add_done_callback(lambda _: state.inflight.pop(digest, None))
+        # A caller that goes away must not cancel the lookup other callers share.
+        return await asyncio.shield(task)
+
+    async def _load(self, state, key, digest):
+        row = await database_sync_to_async(LinkPreview.objects.filter(url_hash=digest).first)()
+        if row is not None:
+            ttl = self._ttl(row.ok)
+            age = (timezone.now() - row.fetched_at).total_seconds()
+            if age < ttl:
+                self.cache.set(digest, row, ttl - age)
+                return row
+            if age < ttl + self.options['STALE_WHILE_REVALIDATE']:
+                self._revalidate_later(state, key, digest, row)
+                return row
+        return await self._refresh(state, key, digest, row)
+
+    def _revalidate_later(self, state, key, digest, row):
+        if digest in state.revalidating:
+            return
+        task = state.revalidating[digest] = asyncio.ensure_future(self._refresh(state, key, digest, row))
+
+        def done(task):
+            state.revalidating.pop(digest, None)
+            if not task.cancelled() and task.exception():
+                logger.warning("Link preview revalidation failed for %s: %s", key, task.exception())
+
+        task.add_done_callback(done)
+
+    async def _refresh(self, state, key, digest, previous):
+        host = urlsplit(key).netloc
+        slot = state.hosts.get(host)
+        if slot is None:
+            slot = state.hosts[host] = [asyncio.Semaphore(self.options['PER_HOST_LIMIT']), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                outcome, validators = await self._request(state.client, key, previous)
+        except Exception as e:
+            logger.info("Link preview failed for %s: %s", key, e)
+            outcome, validators = None, {}
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                state.hosts.pop(host, None)
+
+        if outcome is None and previous is not None and previous.ok:
+            # Keep serving the last good preview, but retry after NEGATIVE_TTL.
+            self.cache.set(digest, previous, self.options['NEGATIVE_TTL'])
+            return previous
+        row = await database_sync_to_async(self._save)(key, digest, previous, outcome, validators)
+        self.cache.set(digest, row, self._ttl(row.ok))
+        return row
+
+    def _check_address(self, address):
+        ip = ipaddress.ip_address(address)
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if any(ip in network for network in self.allowed_networks):
+            return
+        if not ip.is_global or ip.is_multicast:
+            raise BlockedAddress(f"{ip} is not a public address")
+
+    async def _resolve(self, url):
+        """A checked address to connect to for ``url``; raises ``BlockedAddress``."""
+        port = url.port or DEFAULT_PORTS[url.scheme]
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(url.host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise BlockedAddress(f"{url.host} does not resolve: {e}")
+        addresses = [info[4][0] for info in infos]
+        # Every answer, not just the one used: a mixed answer is suspect
+        for address in addresses:
+            self._check_address(address)
+        return addresses[0]
+
+    async def _open(self, client, url, headers):
+        """Send a streamed GET for ``url`` to its checked address."""
+        url = httpx.URL(url)
+        if url.scheme not in DEFAULT_PORTS:
+            raise BlockedAddress(f"Not an http(s) URL: {url}")
+        address = await self._resolve(url)
+        request = client.build_request(
+            'GET', url.copy_with(host=address),
+            headers={**headers, 'Host': url.netloc.decode('ascii')},
+            extensions={'sni_hostname': url.host},
+        )
+        return await client.send(request, stream=True)
+
+    async def _request(self, client, key, previous):
+        """``(outcome, validators)``, the outcome being a preview dict or ``NOT_MODIFIED``."""
+        headers = {}
+        if previous is not None and previous.ok:
+            if previous.etag:
+                headers['If-None-Match'] = previous.etag
+            if previous.last_modified:
+                headers['If-Modified-Since'] = previous.last_modified
+
+        url = key
+        for _ in range(self.options['MAX_REDIRECTS'] + 1):
+            response = await self._open(client, url, headers)
+            try:
+                if response.has_redirect_location:
+                    url = urljoin(url, response.headers['location'])
+                    continue
+                return await self._read(response, key)
+            finally:
+                # Also stops reading the rest of the page after </head>
+                await response.aclose()
+        raise httpx.TooManyRedirects(f"More than {self.options['MAX_REDIRECTS']} redirects")
+
+    async def _read(self, response, key):
+        if response.status_code == 304:
+            return NOT_MODIFIED, {}
+        response.raise_for_status()
+        validators = {
+            'etag': response.headers.get('etag', '')[:255],
+            'last_modified': response.headers.get('last-modified', '')[:64],
+        }
+        if not is_html_response(response.headers.get('content-type'), response.headers.get('content-length'),
+                                self.options['MAX_CONTENT_LENGTH']):
+            return empty_link_preview(key), validators
+        # Stream the body and stop at </head>
+        parser = HeadPreviewParser(response.charset_encoding or 'utf-8', self.options['MAX_HEAD_BYTES'])
+        async for chunk in response.aiter_bytes():
+            if parser.feed_bytes(chunk):
+                break
+        return parser.preview(key), validators
+
+    def _save(self, key, digest, previous, outcome, validators):
+        now = timezone.now()
+        if outcome is NOT_MODIFIED:
+            LinkPreview.objects.filter(url_hash=digest).update(fetched_at=now)
+            previous.fetched_at = now
+            return previous
+        preview = outcome or empty_link_preview(key)
+        row, _ = LinkPreview.objects.update_or_create(url_hash=digest, defaults={
+            'url': key,
+            'title': preview['title'],
+            'description': preview['description'],
+            'image': preview['image'],
+            'site_name': (preview['site_name'] or '')[:255] or None,
+            'ok': outcome is not None,
+            'etag': validators.get('etag', ''),
+            'last_modified': validators.get('last_modified', ''),
+            'fetched_at': now,
+        })
+        return row
+
+    async def close(self):
+        """Finish background revalidations and close the client of the running loop."""
+        state = self._states.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await asyncio.gather(*state.revalidating.values(), return_exceptions=True)
+            await state.client.aclose()
+
+
+service = PreviewService()
+
+
+async def fetch(url):
+    return await service.fetch(url)
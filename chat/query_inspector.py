@@ -0,0 +1,225 @@
+"""
+Runtime detection of N+1 patterns and slow queries.
+
+Opt in with ``CHAT_QUERY_INSPECTOR['ENABLED']``. SQL executed while an
+``inspect()`` block is active is grouped under that block's label (one HTTP
+request or one WebSocket action). When the block ends, statement shapes
+repeated at least ``N_PLUS_ONE_THRESHOLD`` times and statements slower than
+``SLOW_QUERY_MS`` are logged with the application frames that issued them
+and aggregated in memory for the ``debug/query-stats/`` endpoint.
+
+When the inspector is disabled nothing is installed: no execute wrapper,
+no middleware (it raises ``MiddlewareNotUsed``) and the consumer skips the
+``inspect()`` block entirely.
+"""
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+logger = logging.getLogger('chat.queries')
+
+DEFAULTS = {
+    'ENABLED': False,
+    'N_PLUS_ONE_THRESHOLD': 5,
+    'SLOW_QUERY_MS': 100,
+    'STACK_DEPTH': 4,
+    'MAX_STATS_ENTRIES': 500,
+}
+
+_current = ContextVar('chat_query_collector', default=None)
+
+_IN_LIST_RE = re.compile(r"\((?:\s*%s\s*,)+\s*%s\s*\)")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+\b")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_QUERY_INSPECTOR', {})}
+
+
+def enabled():
+    return bool(getattr(settings, 'CHAT_QUERY_INSPECTOR', {}).get('ENABLED'))
+
+
+def query_shape(sql):
+    """Collapse literals and IN-lists so the same statement shape compares equal."""
+    shape = _IN_LIST_RE.sub('(...)', sql)
+    shape = _STRING_RE.sub('?', shape)
+    shape = _NUMBER_RE.sub('N', shape)
+    return _SPACE_RE.sub(' ', shape).strip()
+
+
+def _origin(depth):
+    """The innermost application frames (outside Django and this module)."""
+    base = str(settings.BASE_DIR)
+    here = os.path.abspath(__file__)
+    frames = []
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if filename == here or not filename.startswith(base) or 'site-packages' in filename:
+            continue
+        frames.append(f"{os.path.relpath(filename, base)}:{frame.lineno} in {frame.name}")
+        if len(frames) >= depth:
+            break
+    return frames
+
+
+class QueryStats:
+    """Process-local aggregate of findings, keyed by (label, kind, shape)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def add(self, label, finding, max_entries):
+        key = (label, finding['kind'], finding['shape'])
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                if len(self.entries) >= max_entries:
+                    # Drop the least recently seen entry (dicts keep insertion order).
+                    self.entries.pop(next(iter(self.entries)))
+                entry = {
+                    'label': label,
+                    'kind': finding['kind'],
+                    'shape': finding['shape'],
+                    'occurrences': 0,
+                    'max_count': 0,
+                    'max_ms': 0.0,
+                    'origin': finding['origin'],
+                }
+            entry['occurrences'] += 1
+            entry['max_count'] = max(entry['max_count'], finding.get('count', 1))
+            entry['max_ms'] = max(entry['max_ms'], finding['ms'])
+            entry['origin'] = finding['origin'] or entry['origin']
+            entry['last_seen'] = timezone.now().isoformat()
+            self.entries[key] = entry
+
+    def snapshot(self):
+        with self.lock:
+            return sorted(self.entries.values(), key=lambda e: (-e['occurrences'], e['label']))
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+
+
+stats = QueryStats()
+
+
+class QueryCollector:
+    def __init__(self, label, options):
+        self.label = label
+        self.options = options
+        self.queries = 0
+        self.total_ms = 0.0
+        # shape -> [count, total ms, origin of first occurrence]
+        self.shapes = {}
+        self.slow = []
+
+    def add(self, sql, ms):
+        shape = query_shape(sql)
+        self.queries += 1
+        self.total_ms += ms
+        entry = self.shapes.get(shape)
+        if entry is None:
+            entry = self.shapes[shape] = [0, 0.0, None]
+        entry[0] += 1
+        entry[1] += ms
+        threshold = self.options['N_PLUS_ONE_THRESHOLD']
+        slow = ms >= self.options['SLOW_QUERY_MS']
+        # Only pay for a stack walk when the query may end up in a finding.
+        if slow or (entry[0] == threshold and entry[2] is None):
+            origin = _origin(self.options['STACK_DEPTH'])
+            if entry[2] is None:
+                entry[2] = origin
+            if slow:
+                self.slow.append({'kind': 'slow', 'shape': shape, 'ms': round(ms, 3), 'origin': origin})
+
+    def findings(self):
+        threshold = self.options['N_PLUS_ONE_THRESHOLD']
+        found = [
+            {'kind': 'n_plus_one', 'shape': shape, 'count': count, 'ms': round(ms, 3), 'origin': origin}
+            for shape, (count, ms, origin) in self.shapes.items()
+            if count >= threshold
+        ]
+        return found + self.slow
+
+    def report(self):
+        for finding in self.findings():
+            stats.add(self.label, finding, self.options['MAX_STATS_ENTRIES'])
+            if finding['kind'] == 'n_plus_one':
+                logger.warning(
+                    "N+1 in %s: %d x %s (%.1f ms) from %s",
+                    self.label, finding['count'], finding['shape'], finding['ms'], finding['origin'],
+                )
+            else:
+                logger.warning(
+                    "Slow query in %s: %.1f ms %s from %s",
+                    self.label, finding['ms'], finding['shape'], finding['origin'],
+                )
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    collector = _current.get()
+    if collector is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        collector.add(sql, (time.perf_counter() - started) * 1000)
+
+
+def _attach(connection):
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    _attach(connection)
+
+
+def install():
+    """Attach the execute wrapper to this thread's connections and all future ones."""
+    connection_created.connect(_on_connection_created, dispatch_uid='chat.query_inspector')
+    for connection in connections.all():
+        _attach(connection)
+
+
+@contextmanager
+def inspect(label):
+    """Group the SQL executed inside the block under ``label`` and report findings."""
+    collector = QueryCollector(label, config())
+    token = _current.set(collector)
+    try:
+        yield collector
+    finally:
+        _current.reset(token)
+        collector.report()
+
+
+class QueryInspectorMiddleware:
+    """Runs each HTTP request inside ``inspect()`` when the inspector is enabled."""
+
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed()
+        install()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with inspect(f"{request.method} {_NUMBER_RE.sub('<id>', request.path)}"):
+            return self.get_response(request)
@@ -0,0 +1,122 @@
+"""
+Opt-in recorder for inbound WebSocket frames.
+
+When ``CHAT_WS_TRACE_PATH`` is set, every frame ``ChatConsumer`` receives is
+appended to that file as one JSON line together with its wall-clock time
+and an opaque connection id. Ids are replaced by keyed hashes and free text
+by same-length placeholders, so a trace keeps the shape of real traffic
+without its content. ``replay_ws_trace`` plays a trace back.
+"""
+import hashlib
+import hmac
+import json
+import queue
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+# Frame keys holding ids, mapped to the kind of object they refer to.
+ID_FIELDS = {
+    'channel': 'channel',
+    'channel_id': 'channel',
+    'channels': 'channel',
+    'team_id': 'team',
+    'recipient_id': 'user',
+    'user_id': 'user',
+    'message_id': 'message',
+    'reply_to': 'message',
+    'fileIds': 'file',
+}
+
+# Frame keys whose values are protocol vocabulary rather than user data.
+KEEP_FIELDS = {'message_type', 'type', 'notification_type', 'reaction'}
+
+
+class TraceRecorder:
+    def __init__(self, path, secret):
+        self.path = path
+        self.key = hashlib.sha256(f"ws-trace:{secret}".encode()).digest()
+        self.file = open(path, 'a', encoding='utf-8')
+        # Lines are written by a thread, so a frame never waits on the disk
+        self.lines = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._drain, name='ws-trace-writer', daemon=True)
+        self.writer.start()
+
+    def anonymize_id(self, kind, value):
+        if value is None or value == '':
+            return value
+        digest = hmac.new(self.key, f"{kind}:{value}".encode(), hashlib.sha256).hexdigest()
+        return f"{kind}:{digest[:12]}"
+
+    def anonymize(self, value, key=None):
+        if key in ID_FIELDS:
+            kind = ID_FIELDS[key]
+            if isinstance(value, list):
+                return [self.anonymize_id(kind, item) for item in value]
+            return self.anonymize_id(kind, value)
+        if isinstance(value, dict):
+            return {k: self.anonymize(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.anonymize(item) for item in value]
+        if isinstance(value, str) and key not in KEEP_FIELDS:
+            return 'x' * len(value)
+        return value
+
+    def new_connection_id(self):
+        return self.anonymize_id('conn', uuid.uuid4().hex)
+
+    def write(self, connection_id, user_id, event, frame=None):
+        record = {
+            't': round(time.time(), 6),
+            'conn': connection_id,
+            'user': self.anonymize_id('user', user_id),
+            'event': event,
+        }
+        if frame is not None:
+            record['frame'] = self.anonymize(frame)
+        self.lines.put(json.dumps(record, separators=(',', ':')))
+
+    def _drain(self):
+        closing = False
+        while not closing:
+            # Everything queued so far goes out in one write and flush
+            lines = [self.lines.get()]
+            while True:
+                try:
+                    lines.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lines:
+                closing = True
+                lines = lines[:lines.index(None)]
+            self.file.write(''.join(f"{line}\n" for line in lines))
+            self.file.flush()
+        self.file.close()
+
+    def close(self, wait=True):
+        """Write what is queued and close the file; lines written later are dropped."""
+        self.lines.put(None)
+        if wait:
+            self.writer.join()
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    """Return the process-wide recorder, or ``None`` when recording is off."""
+    global _recorder
+    path = getattr(settings, 'CHAT_WS_TRACE_PATH', None)
+    if not path:
+        return None
+    if _recorder is None or _recorder.path != path:
+        with _recorder_lock:
+            if _recorder is None or _recorder.path != path:
+                if _recorder is not None:
+                    # Its thread finishes the old file; callers may be on the event loop
+                    _recorder.close(wait=False)
+                _recorder = TraceRecorder(path, settings.SECRET_KEY)
+    return _recorder
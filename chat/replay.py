@@ -0,0 +1,369 @@
+"""
+Replay of WebSocket traces written by ``chat.recorder``.
+
+Each recorded connection becomes one in-process client that sends its
+frames in their original order, optionally at the original pace scaled by
+``speed``. Anonymized ids are mapped onto a freshly seeded dataset of the
+same shape, and every frame that has a reply is timed until that reply
+arrives on the sending connection.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict, deque
+
+from channels.testing import WebsocketCommunicator
+from django.db import connections
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .benchmarks import build_application, seed_dataset, summarize
+from .recorder import ID_FIELDS, KEEP_FIELDS
+
+# message_type -> type of the reply the sender gets back
+REPLY_TYPES = {
+    'channel_message': 'channels',
+    'forward_message': 'channels',
+    'direct_message': 'direct',
+    'reaction': 'reaction_update',
+    'edit_message': 'message_edited',
+    'delete_message': 'message_deleted',
+    'pin_message': 'message_pinned',
+    'unpin_message': 'message_unpinned',
+    'get_channel_messages': 'channel_messages',
+    'get_pinned_messages': 'pinned_messages',
+    'get_direct_messages': 'direct_messages',
+    'get_team_channels': 'team_channels',
+    'get_team_members': 'team_members',
+    'get_interacted_users': 'interacted_users',
+    'get_user_presences': 'user_presences',
+    'create_channel': 'channel_created',
+}
+
+# Frames that may only touch messages the sender wrote.
+AUTHOR_ONLY = {'edit_message', 'delete_message'}
+
+
+def parse_speed(value):
+    """``"1"``, ``"10x"`` or ``"max"`` -> speed factor, ``None`` meaning as fast as possible."""
+    value = str(value).strip().lower()
+    if value == 'max':
+        return None
+    speed = float(value[:-1] if value.endswith('x') else value)
+    if speed <= 0:
+        raise ValueError("Speed must be positive")
+    return speed
+
+
+def load_trace(path):
+    """Read a trace into ``{connection id: (user token, [records])}`` ordered by time."""
+    trace = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            _, records = trace.setdefault(record['conn'], (record['user'], []))
+            records.append(record)
+    for _, records in trace.values():
+        records.sort(key=lambda record: record['t'])
+    return trace
+
+
+def _collect_tokens(value, kind_tokens, key=None):
+    if key in ID_FIELDS:
+        for item in value if isinstance(value, list) else [value]:
+            if item:
+                kind_tokens[ID_FIELDS[key]].add(item)
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            _collect_tokens(v, kind_tokens, k)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_tokens(item, kind_tokens)
+
+
+class TraceMapper:
+    """Maps anonymized trace ids onto objects of a seeded dataset.
+
+    Mappings are global and stable, so the same token always resolves to
+    the same local object; the first connection that uses a channel or
+    message token decides where it lands, within that user's access.
+    """
+
+    def __init__(self, dataset, user_tokens):
+        self.dataset = dataset
+        self.users = dict(zip(user_tokens, dataset.users))
+        self.spare_users = itertools.cycle(dataset.users)
+        self.channels = {}
+        self.messages = {}
+        self.sequence = itertools.count()
+
+    def user(self, token):
+        if token not in self.users:
+            self.users[token] = next(self.spare_users)
+        return self.users[token]
+
+    def channel(self, token, user):
+        if token not in self.channels:
+            own = self.dataset.channels_for(user.id) or [channel.id for channel in self.dataset.channels]
+            self.channels[token] = own[len(self.channels) % len(own)]
+        return self.channels[token]
+
+    def message(self, token, user, author_only):
+        if token not in self.messages:
+            candidates = []
+            for channel_id in self.dataset.channels_for(user.id):
+                if author_only:
+                    candidates.extend(self.dataset.authored.get((channel_id, user.id), []))
+                else:
+                    candidates.extend(self.dataset.history.get(channel_id, []))
+            if not candidates:
+                return None
+            self.messages[token] = candidates[len(self.messages) % len(candidates)]
+        return self.messages[token]
+
+    def placeholder(self, length):
+        prefix = f"replay-{next(self.sequence)} "
+        return prefix + 'x' * max(0, length - len(prefix))
+
+    def rewrite(self, value, user, message_type, key=None):
+        if key in ID_FIELDS:
+            kind = ID_FIELDS[key]
+            if isinstance(value, list):
+                return [self._map(kind, item, user, message_type) for item in value if kind != 'file']
+            return self._map(kind, value, user, message_type)
+        if isinstance(value, dict):
+            return {k: self.rewrite(v, user, message_type, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.rewrite(item, user, message_type) for item in value]
+        if isinstance(value, str) and key not in KEEP_FIELDS:
+            return self.placeholder(len(value))
+        return value
+
+    def _map(self, kind, token, user, message_type):
+        if not token:
+            return token
+        if kind == 'channel':
+            return self.channel(token, user)
+        if kind == 'team':
+            return self.dataset.user_teams.get(user.id)
+        if kind == 'user':
+            return self.user(token).id
+        if kind == 'message':
+            return self.message(token, user, message_type in AUTHOR_ONLY)
+        return None
+
+
+def request_key(frame, username):
+    """Key of the reply expected for ``frame``, matching ``reply_key``."""
+    reply_type = REPLY_TYPES.get(frame.get('message_type'))
+    if reply_type in ('channels', 'direct'):
+        return ('message', frame.get('content'))
+    if reply_type == 'reaction_update':
+        return (reply_type, frame.get('message_id'), username)
+    if reply_type == 'message_edited':
+        return (reply_type, frame.get('message_id'), frame.get('content'))
+    if reply_type in ('message_deleted', 'message_pinned', 'message_unpinned'):
+        return (reply_type, frame.get('message_id'))
+    if reply_type in ('channel_messages', 'direct_messages', 'pinned_messages'):
+        return (reply_type, frame.get('channel_id'))
+    if reply_type in ('team_channels', 'team_members', 'interacted_users'):
+        return (reply_type, frame.get('team_id'))
+    if reply_type == 'user_presences':
+        return (reply_type,)
+    if reply_type == 'channel_created':
+        return (reply_type, frame.get('name'))
+    return None
+
+
+def reply_key(payload, username):
+    kind = payload.get('type')
+    if kind in ('channels', 'direct'):
+        return ('message', payload.get('content'))
+    if kind == 'reaction_update':
+        return (kind, payload.get('message_id'), payload.get('username'))
+    if kind == 'message_edited':
+        return (kind, payload.get('message_id'), payload.get('content'))
+    if kind in ('message_deleted', 'message_pinned', 'message_unpinned'):
+        return (kind, payload.get('message_id'))
+    if kind in ('channel_messages', 'direct_messages', 'pinned_messages'):
+        return (kind, payload.get('channel_id'))
+    if kind in ('team_channels', 'team_members', 'interacted_users'):
+        return (kind, payload.get('team_id'))
+    if kind == 'user_presences':
+        return (kind,)
+    if kind == 'channel_created':
+        return (kind, payload.get('channel', {}).get('name'))
+    return None
+
+
+class ReplayStats:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.sent = defaultdict(int)
+        self.timeouts = defaultdict(int)
+        self.exceptions = defaultdict(int)
+        self.unmapped = defaultdict(int)
+
+
+class ReplayClient:
+    def __init__(self, application, user, stats):
+        self.user = user
+        self.stats = stats
+        self.application = application
+        self.communicator = None
+        self.reader = None
+        self.ready = None
+        # reply key -> FIFO of (sent_at, message_type)
+        self.pending = defaultdict(deque)
+
+    @property
+    def connected(self):
+        return self.communicator is not None
+
+    async def connect(self, timeout):
+        token = str(AccessToken.for_user(self.user))
+        self.communicator = WebsocketCommunicator(self.application, f"/ws/chat/?token={token}")
+        self.ready = asyncio.Event()
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        if not connected:
+            raise RuntimeError(f"Connection refused for {self.user.username}")
+        self.reader = asyncio.ensure_future(self._read())
+        await asyncio.wait_for(self.ready.wait(), timeout)
+
+    async def _read(self):
+        while True:
+            payload = await self.communicator.receive_json_from(timeout=3600)
+            received_at = time.perf_counter()
+            if payload.get('type') == 'user_presence':
+                if payload.get('user_id') == self.user.id and payload.get('status') == 'online':
+                    self.ready.set()
+                continue
+            queue = self.pending.get(reply_key(payload, self.user.username))
+            if queue:
+                sent_at, message_type = queue.popleft()
+                self.stats.latency[message_type].append(received_at - sent_at)
+
+    async def send(self, frame):
+        message_type = frame.get('message_type')
+        key = request_key(frame, self.user.username)
+        if key is not None:
+            self.pending[key].append((time.perf_counter(), message_type))
+        self.stats.sent[message_type] += 1
+        await self.communicator.send_json_to(frame)
+
+    async def drain(self, timeout):
+        deadline = time.perf_counter() + timeout
+        while any(self.pending.values()) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        for queue in self.pending.values():
+            for _, message_type in queue:
+                self.stats.timeouts[message_type] += 1
+        self.pending.clear()
+
+    async def close(self, timeout):
+        if not self.connected:
+            return
+        await self.drain(timeout)
+        self.reader.cancel()
+        try:
+            await self.reader
+        except asyncio.CancelledError:
+            pass
+        await self.communicator.disconnect()
+        self.communicator = None
+
+
+async def _replay_connection(application, mapper, user, records, stats, clock, speed, timeout):
+    client = ReplayClient(application, user, stats)
+    start, t0 = clock
+    loop = asyncio.get_running_loop()
+    try:
+        for record in records:
+            if speed is not None:
+                delay = start + (record['t'] - t0) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            event = record['event']
+            if event == 'disconnect':
+                await client.close(timeout)
+                continue
+            if not client.connected:
+                await client.connect(timeout)
+            if event == 'frame':
+                frame = record['frame']
+                message_type = frame.get('message_type')
+                rewritten = mapper.rewrite(frame, user, message_type)
+                if any(rewritten.get(key) is None for key in ID_FIELDS if frame.get(key)):
+                    stats.unmapped[message_type] += 1
+                    continue
+                await client.send(rewritten)
+    except Exception as e:
+        stats.exceptions[type(e).__name__] += 1
+    finally:
+        try:
+            await client.close(timeout)
+        except Exception as e:
+            stats.exceptions[type(e).__name__] += 1
+
+
+async def replay(trace, dataset, user_tokens, speed=None, timeout=10):
+    application = build_application()
+    mapper = TraceMapper(dataset, user_tokens)
+    stats = ReplayStats()
+    t0 = min(records[0]['t'] for _, records in trace.values() if records)
+    clock = (asyncio.get_running_loop().time(), t0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        _replay_connection(application, mapper, mapper.user(user), records, stats, clock, speed, timeout)
+        for user, records in trace.values()
+        if records
+    ])
+    elapsed = time.perf_counter() - started
+
+    sent = sum(stats.sent.values())
+    return {
+        'connections': len(trace),
+        'frames_sent': sent,
+        'elapsed_s': round(elapsed, 3),
+        'frames_per_sec': round(sent / elapsed, 2) if elapsed else None,
+        'sent_by_type': dict(stats.sent),
+        'latency': {message_type: summarize(samples) for message_type, samples in stats.latency.items()},
+        'errors': {
+            'timeouts': dict(stats.timeouts),
+            'exceptions': dict(stats.exceptions),
+            'unmapped': dict(stats.unmapped),
+        },
+    }
+
+
+def replay_trace(path, speed=None, timeout=10, history=20):
+    """Seed a dataset shaped like the trace at ``path`` and replay it against it."""
+    trace = load_trace(path)
+    if not trace:
+        raise ValueError(f"No records in {path}")
+
+    kind_tokens = defaultdict(set)
+    user_tokens = []
+    for user, records in trace.values():
+        if user not in user_tokens:
+            user_tokens.append(user)
+        for record in records:
+            _collect_tokens(record.get('frame', {}), kind_tokens)
+    extra_users = kind_tokens['user'] - set(user_tokens)
+    teams = max(1, len(kind_tokens['team']))
+
+    dataset = seed_dataset(
+        users=len(user_tokens) + len(extra_users),
+        teams=min(teams, len(user_tokens)) or 1,
+        channels=max(len(kind_tokens['channel']), teams),
+        history=history,
+    )
+    try:
+        connections.close_all()
+        return asyncio.run(replay(trace, dataset, user_tokens, speed=speed, timeout=timeout))
+    finally:
+        dataset.teardown()
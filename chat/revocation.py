@@ -0,0 +1,206 @@
+"""
+Revoked-token checks for the WebSocket middleware and the REST API.
+
+Logging out blacklists the refresh token in simplejwt's tables. Access
+tokens issued by ``chat.auth.token_for`` carry their refresh token's jti
+as a ``sid`` (session) claim, so one lookup covers the whole session.
+
+Checking the table on every request would cost a query. Instead each
+process keeps the revoked sids in memory:
+
+- ``set`` (the default) is an exact ``{sid: expiry}`` map. A hit is final.
+- ``bloom`` is a ``BloomFilter`` of ``BLOOM_CAPACITY`` entries. It takes a
+  few bytes per entry whatever the sid length. A hit is confirmed against
+  ``BlacklistedToken``, so the rare false positive costs a query, not a
+  rejection. The filter is rebuilt once it has taken more entries than its
+  capacity, because expired entries cannot be removed from it.
+
+Either way, a miss, which is almost every request, costs no query. Other
+workers learn of a revocation within ``SYNC_INTERVAL`` seconds. At most
+once per interval each process reads the blacklist rows added since it
+last looked, by ``blacklisted_at``. Each read reaches back ``SYNC_OVERLAP``
+seconds further. Ids and timestamps are assigned before commit, so a row can
+become visible after rows that are newer than it. Reading only past the
+highest id seen would miss it for good. Rows already taken are skipped by id.
+Expired rows are removed in batches by
+``python manage.py purge_expired_tokens``.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+DEFAULTS = {
+    # 'set' or 'bloom'
+    'MODE': 'set',
+    'SYNC_INTERVAL': 5,
+    # Seconds each sync re-reads before the previous one, for rows committed late
+    'SYNC_OVERLAP': 60,
+    'BLOOM_CAPACITY': 100000,
+    'BLOOM_ERROR_RATE': 0.001,
+}
+
+SESSION_CLAIM = 'sid'
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_REVOCATION', {})}
+
+
+def session_id(token):
+    """The sid a token is revoked under: its ``sid`` claim, or its own jti."""
+    return token.get(SESSION_CLAIM) or token.get(api_settings.JTI_CLAIM)
+
+
+class BloomFilter:
+    """A fixed-size set membership test with false positives but no false negatives."""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList:
+    """The revoked sids known to this process, refreshed from the blacklist table."""
+
+    def __init__(self, options=None, clock=time.monotonic):
+        self.options = {**config(), **(options or {})}
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.synced_at = None
+        self._reset()
+
+    def _reset(self):
+        # Rows blacklisted at or after `since` are read; `recent` holds the ids among them already taken
+        self.since = None
+        self.recent = set()
+        self.added = 0
+        self.expiry = {}
+        self.bloom = None
+        if self.options['MODE'] == 'bloom':
+            self.bloom = BloomFilter(self.options['BLOOM_CAPACITY'], self.options['BLOOM_ERROR_RATE'])
+
+    def add(self, sid, expires_at):
+        """Record ``sid`` as revoked until ``expires_at`` (epoch seconds)."""
+        with self.lock:
+            self.added += 1
+            if self.bloom is not None:
+                self.bloom.add(sid)
+            else:
+                self.expiry[sid] = expires_at
+
+    def due(self):
+        return self.synced_at is None or self.clock() - self.synced_at >= self.options['SYNC_INTERVAL']
+
+    def sync(self):
+        """Read blacklist rows added since shortly before the last sync (all of them the first time)."""
+        if self.bloom is not None and self.added > self.options['BLOOM_CAPACITY']:
+            with self.lock:
+                self._reset()
+        now = time.time()
+        since = aware_utcnow() - timedelta(seconds=self.options['SYNC_OVERLAP'])
+        rows = BlacklistedToken.objects.filter(token__expires_at__gt=aware_utcnow())
+        if self.since is not None:
+            rows = rows.filter(blacklisted_at__gte=self.since)
+        recent = set()
+        for row_id, jti, expires_at, blacklisted_at in (
+                rows.order_by('id').values_list('id', 'token__jti', 'token__expires_at', 'blacklisted_at')
+                .iterator(chunk_size=1000)):
+            if row_id not in self.recent:
+                self.add(jti, expires_at.timestamp())
+            if blacklisted_at >= since:
+                recent.add(row_id)
+        self.since, self.recent = since, recent
+        with self.lock:
+            for sid in [sid for sid, expires_at in self.expiry.items() if expires_at <= now]:
+                del self.expiry[sid]
+        self.synced_at = self.clock()
+
+    def maybe_revoked(self, sid):
+        """True if ``sid`` is revoked, or, in bloom mode, might be."""
+        if self.bloom is not None:
+            return sid in self.bloom
+        return self.expiry.get(sid, 0) > time.time()
+
+    def is_revoked(self, sid):
+        if self.due():
+            self.sync()
+        if not self.maybe_revoked(sid):
+            return False
+        if self.bloom is None:
+            return True
+        return BlacklistedToken.objects.filter(token__jti=sid).exists()
+
+    async def ais_revoked(self, sid):
+        """``is_revoked`` without a thread hop unless a sync or a bloom confirmation is needed."""
+        if self.due() or (self.bloom is not None and self.maybe_revoked(sid)):
+            return await database_sync_to_async(self.is_revoked)(sid)
+        return self.maybe_revoked(sid)
+
+
+_revocations = None
+
+
+def revocations():
+    global _revocations
+    if _revocations is None:
+        _revocations = RevocationList()
+    return _revocations
+
+
+@receiver(setting_changed)
+def settings_changed(sender, setting, **kwargs):
+    global _revocations
+    if setting == 'CHAT_REVOCATION':
+        _revocations = None
+
+
+def is_revoked(token):
+    sid = session_id(token)
+    return sid is not None and revocations().is_revoked(sid)
+
+
+async def ais_revoked(token):
+    sid = session_id(token)
+    return sid is not None and await revocations().ais_revoked(sid)
+
+
+def revoke(refresh):
+    """Blacklist the refresh token ``refresh`` and every access token of its session."""
+    refresh.blacklist()
+    revocations().add(refresh[api_settings.JTI_CLAIM], refresh['exp'])
+
+
+def purge_expired(batch_size=1000):
+    """Delete expired outstanding tokens and their blacklist rows in batches; returns the count."""
+    deleted = 0
+    while True:
+        ids = list(OutstandingToken.objects.filter(expires_at__lte=aware_utcnow())
+                   .order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        BlacklistedToken.objects.filter(token_id__in=ids).delete()
+        OutstandingToken.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
@@ -30,12 +30,24 @@ class DirectMessageChannelSerializer(serializers.ModelSerializer):
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
+    link_preview = serializers.SerializerMethodField()
+
+    def get_link_preview(self, obj):
+        return obj.preview_dict()
     
     class Meta:
         model = Message
         fields = ['id', 'sender', 'content', 'channel', 'reply_to', 'reactions', 'link_preview','created_at']
         read_only_fields = ['sender', 'created_at']
 
+class PinnedMessageSerializer(serializers.ModelSerializer):
+    sender = UserSerializer(read_only=True)
+    pinned_by = UserSerializer(read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ['id', 'sender', 'content', 'channel', 'created_at', 'pinned_at', 'pinned_by']
+
 class TeamInvitationSerializer(serializers.ModelSerializer):
     class Meta:
         model = TeamInvitation
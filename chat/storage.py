@@ -0,0 +1,160 @@
+"""
+Per-user and per-team storage accounting.
+
+``UserStorage.bytes`` is the size of the attachments a user has uploaded.
+``TeamStorage.bytes`` is the size of the attachments linked to messages in
+the team's channels, counted once per message they are attached to. Each
+counter is updated in the same transaction as the change it reflects:
+
+- upload: ``chat.blobs.adopt`` calls ``add_user_bytes``
+- attach: ``attach()`` links files to a new message, enforcing ``TEAM_QUOTA``
+- message delete: ``delete_message()``
+- attachment or channel delete: the ``pre_delete`` receivers below
+
+Messages are deliberately handled without a signal receiver. One would run
+a query for every message when a channel is deleted, where the channel
+receiver needs a single aggregate.
+
+The quota check in the upload views is therefore two primary-key lookups.
+The team quota is enforced when files are attached, where the team is
+known; the upload views check it early only for a ``team_id`` the
+uploader belongs to.
+``reconcile_storage`` recomputes every counter in batches, to correct drift
+from changes made outside these paths (raw SQL, ``bulk_create``).
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from .models import Channel, FileAttachment, Message, Team, TeamStorage, UserStorage
+
+DEFAULTS = {
+    # Bytes; None means unlimited
+    'USER_QUOTA': None,
+    'TEAM_QUOTA': None,
+}
+
+Link = Message.files.through
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_STORAGE', {})}
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _bump(model, key, delta):
+    if not delta or key is None:
+        return
+    if not model.objects.filter(pk=key).update(bytes=F('bytes') + delta):
+        model.objects.bulk_create([model(pk=key)], ignore_conflicts=True)
+        model.objects.filter(pk=key).update(bytes=F('bytes') + delta)
+
+
+def add_user_bytes(user_id, delta):
+    _bump(UserStorage, user_id, delta)
+
+
+def add_team_bytes(team_id, delta):
+    _bump(TeamStorage, team_id, delta)
+
+
+def usage(model, key):
+    return model.objects.filter(pk=key).values_list('bytes', flat=True).first() or 0
+
+
+def check_quota(user_id, size, team_id=None):
+    """Raise ``QuotaExceeded`` if ``size`` more bytes would put the user or team over quota."""
+    options = config()
+    if options['USER_QUOTA'] is not None and usage(UserStorage, user_id) + size > options['USER_QUOTA']:
+        raise QuotaExceeded('User storage quota exceeded')
+    if (team_id is not None and options['TEAM_QUOTA'] is not None
+            and usage(TeamStorage, team_id) + size > options['TEAM_QUOTA']):
+        raise QuotaExceeded('Team storage quota exceeded')
+
+
+def member_team_id(user, value):
+    """``value`` as the id of a team ``user`` belongs to, or None if empty; raises ``ValueError`` otherwise."""
+    if value in (None, ''):
+        return None
+    try:
+        team_id = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid team_id')
+    if not Team.members.through.objects.filter(team_id=team_id, user_id=user.id).exists():
+        raise ValueError('Invalid team_id')
+    return team_id
+
+
+def attach(message, file_ids, team_id):
+    """Link the attachments ``file_ids`` to a new ``message`` in team ``team_id``.
+
+    Raises ``QuotaExceeded``, linking nothing, if they would put the team over
+    ``TEAM_QUOTA``. The team's counter is locked while it is checked, so
+    concurrent attaches cannot both slip under the quota.
+    """
+    quota = config()['TEAM_QUOTA']
+    with transaction.atomic():
+        attachments = list(FileAttachment.objects.filter(id__in=file_ids).only('id', 'size'))
+        size = sum(attachment.size for attachment in attachments)
+        if quota is not None and team_id is not None and size:
+            TeamStorage.objects.bulk_create([TeamStorage(pk=team_id)], ignore_conflicts=True)
+            used = TeamStorage.objects.select_for_update().values_list('bytes', flat=True).get(pk=team_id)
+            if used + size > quota:
+                raise QuotaExceeded('Team storage quota exceeded')
+        message.files.add(*attachments)
+        add_team_bytes(team_id, size)
+
+
+def delete_message(message):
+    with transaction.atomic():
+        linked = Link.objects.filter(message_id=message.id).aggregate(total=Sum('fileattachment__size'))['total']
+        team_id = Channel.objects.filter(id=message.channel_id).values_list('team_id', flat=True).first()
+        message.delete()
+        add_team_bytes(team_id, -(linked or 0))
+
+
+def _release_links(links):
+    per_team = links.values('message__channel__team_id').order_by().annotate(total=Sum('fileattachment__size'))
+    for row in per_team:
+        add_team_bytes(row['message__channel__team_id'], -row['total'])
+
+
+@receiver(pre_delete, sender=FileAttachment)
+def attachment_deleted(sender, instance, **kwargs):
+    add_user_bytes(instance.uploaded_by_id, -instance.size)
+    _release_links(Link.objects.filter(fileattachment_id=instance.id))
+
+
+@receiver(pre_delete, sender=Channel)
+def channel_deleted(sender, instance, **kwargs):
+    _release_links(Link.objects.filter(message__channel_id=instance.id))
+
+
+def reconcile_users(user_ids):
+    """Recompute the counters of ``user_ids``; returns how many had drifted."""
+    return _reconcile(UserStorage, user_ids, FileAttachment.objects.filter(uploaded_by_id__in=user_ids)
+                      .values_list('uploaded_by_id').order_by().annotate(total=Sum('size')))
+
+
+def reconcile_teams(team_ids):
+    """Recompute the counters of ``team_ids``; returns how many had drifted."""
+    return _reconcile(TeamStorage, team_ids, Link.objects.filter(message__channel__team_id__in=team_ids)
+                      .values_list('message__channel__team_id').order_by().annotate(total=Sum('fileattachment__size')))
+
+
+def _reconcile(model, keys, totals):
+    with transaction.atomic():
+        model.objects.bulk_create([model(pk=key) for key in keys], ignore_conflicts=True)
+        # Locked before summing: a concurrent bump either committed before the
+        # lock (and is in the sum) or waits and applies on top of the result.
+        current = dict(model.objects.select_for_update().filter(pk__in=keys).values_list('pk', 'bytes'))
+        actual = dict(totals)
+        drifted = [key for key in keys if current.get(key) != actual.get(key, 0)]
+        for key in drifted:
+            model.objects.filter(pk=key).update(bytes=actual.get(key, 0))
+    return len(drifted)
@@ -0,0 +1,102 @@
+"""
+Which channels a WebSocket connection is viewing.
+
+A connection gets the full events of every channel its user belongs to,
+so an idle tab still encodes and sends every message of every channel.
+Clients can send ``subscribe`` and ``unsubscribe`` instead::
+
+    {"message_type": "subscribe", "channel_ids": [3, 7]}
+
+After the first of these the connection is lazy. Messages, edits,
+deletions, reactions, pins and link previews are only sent for subscribed
+channels. For the other channels, new messages are counted, and every
+``SUMMARY_INTERVAL`` seconds at most one compact frame lists the channels
+that had activity since the previous one::
+
+    {"type": "channel_activity",
+     "channels": [{"channel_id": 5, "team_id": 1, "unread": 3,
+                   "last_message_id": 912, "last_sender": "ana",
+                   "last_at": "..."}]}
+
+``unread`` counts other users' messages since the previous summary, so
+the client adds it up until it subscribes and loads the history.
+Connections that never subscribe keep receiving everything, as before.
+
+The events reach the consumer as before, through its channel groups or,
+with user routing (``chat.fanout``), its personal group. Only what is
+encoded and written to the socket changes.
+"""
+from django.conf import settings
+
+DEFAULTS = {
+    'SUMMARY_INTERVAL': 2.0,
+}
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_SUBSCRIPTIONS', {})}
+
+
+def channel_ids(content):
+    """The integer channel ids in a frame's ``channel_ids`` list or ``channel_id``; others are skipped."""
+    values = content.get('channel_ids')
+    if values is None:
+        values = [content.get('channel_id')]
+    if not isinstance(values, list):
+        return []
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(value))
+        except (TypeError, ValueError):
+            continue
+    return ids
+
+
+class Subscriptions:
+    """One connection's viewed channels and the activity elsewhere not yet summarized."""
+
+    def __init__(self):
+        self.lazy = False
+        self.viewed = set()
+        # channel id -> summary entry
+        self.activity = {}
+
+    def subscribe(self, ids):
+        self.lazy = True
+        self.viewed.update(ids)
+        for channel_id in ids:
+            # The client loads the history of a channel it starts viewing
+            self.activity.pop(channel_id, None)
+
+    def unsubscribe(self, ids):
+        self.lazy = True
+        self.viewed.difference_update(ids)
+
+    def wants(self, channel_id):
+        """True if full events of ``channel_id`` should be sent."""
+        if not self.lazy:
+            return True
+        try:
+            return int(channel_id) in self.viewed
+        except (TypeError, ValueError):
+            return False
+
+    def record(self, message, own=False):
+        """Count the ``chat.message`` payload ``message`` towards the next summary."""
+        channel_id = int(message['channel_id'])
+        entry = self.activity.get(channel_id)
+        if entry is None:
+            entry = self.activity[channel_id] = {'channel_id': channel_id, 'team_id': message.get('team_id'),
+                                                 'unread': 0}
+        if not own:
+            entry['unread'] += 1
+        entry['last_message_id'] = message.get('id')
+        entry['last_sender'] = message.get('sender')
+        entry['last_at'] = message.get('timestamp')
+
+    def drain(self):
+        """The pending summary entries, by channel id; clears them."""
+        entries = [self.activity[channel_id] for channel_id in sorted(self.activity)]
+        self.activity = {}
+        return entries
@@ -0,0 +1,156 @@
+"""
+Garbage collection of attachments nobody uses.
+
+Two sweeps, both run by the ``sweep_orphans`` command:
+
+- Rows: ``FileAttachment`` rows linked to no message and older than the
+  grace period, such as uploads never sent, or files whose message was
+  deleted. They are deleted in batches. Each delete releases its blob
+  (``chat.blobs``) and storage counters (``chat.storage``), so the last
+  reference also removes the file.
+- Disk: files under ``MEDIA_ROOT`` that no row accounts for. These are blobs
+  without a ``StoredBlob``, thumbnails of deleted blobs, leftovers of
+  crashed writes in ``blobs/tmp`` and ``blobs/incoming``, and legacy
+  ``uploads/`` files without an attachment. The tree is walked lazily with
+  ``os.scandir`` and looked up in batches, so memory does not grow with the
+  number of files. Anything modified within the grace period is left alone.
+
+All deletions go through a ``RateLimiter``, so a large backlog is worked off
+without saturating the disk that serves foreground requests.
+"""
+import os
+import shutil
+import time
+
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .blobs import BLOB_DIR, TEMP_DIR
+from .models import FileAttachment, StoredBlob, UploadSession
+from .uploads import INCOMING_DIR
+
+
+class RateLimiter:
+    """Spaces out operations so that at most ``rate`` happen per second (None: unlimited)."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1 / rate if rate else 0
+        self.clock = clock
+        self.sleep = sleep
+        self.next_at = None
+
+    def wait(self, count=1):
+        if not self.interval:
+            return
+        now = self.clock()
+        if self.next_at is not None and self.next_at > now:
+            self.sleep(self.next_at - now)
+            now = self.next_at
+        self.next_at = now + self.interval * count
+
+
+def orphan_attachment_batches(grace, batch_size):
+    """Lists of ids of attachments linked to no message and created more than ``grace`` ago."""
+    cutoff = timezone.now() - grace
+    last_id = 0
+    while True:
+        ids = list(FileAttachment.objects.filter(messages__isnull=True, created_at__lt=cutoff, id__gt=last_id)
+                   .order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        last_id = ids[-1]
+        yield ids
+
+
+def sweep_attachments(grace, batch_size=200, limiter=None, dry_run=False):
+    """Delete orphaned attachment rows (and, through their blobs, files); returns the count."""
+    deleted = 0
+    for ids in orphan_attachment_batches(grace, batch_size):
+        if limiter:
+            limiter.wait(len(ids))
+        if not dry_run:
+            # Re-checked at delete time: a file may have been attached since the batch was read
+            FileAttachment.objects.filter(id__in=ids, messages__isnull=True).delete()
+        deleted += len(ids)
+    return deleted
+
+
+def scan(prefix, depth, skip=()):
+    """Yield ``(name, DirEntry)`` for entries ``depth`` levels below ``MEDIA_ROOT/prefix``, lazily."""
+    root = default_storage.path(prefix)
+
+    def walk(path, name, level):
+        try:
+            entries = os.scandir(path)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                child = os.path.join(name, entry.name)
+                if level == 1:
+                    yield child, entry
+                elif entry.is_dir(follow_symlinks=False) and child not in skip:
+                    yield from walk(entry.path, child, level - 1)
+
+    yield from walk(root, prefix, depth)
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def disk_areas():
+    """``(label, prefix, depth, known)``; ``known(names)`` returns the names still in use."""
+    def blobs_in_use(names):
+        digests = {os.path.basename(name): name for name in names}
+        return {digests[digest] for digest in
+                StoredBlob.objects.filter(sha256__in=digests).values_list('sha256', flat=True)}
+
+    return [
+        ('blobs', BLOB_DIR, 3, blobs_in_use),
+        ('thumbnails', 'thumbs', 3, blobs_in_use),
+        ('temporary files', TEMP_DIR, 1, lambda names: set()),
+        ('chunked uploads', INCOMING_DIR, 1,
+         lambda names: set(UploadSession.objects.filter(file__in=names).values_list('file', flat=True))),
+        ('legacy uploads', 'uploads', 1,
+         lambda names: set(FileAttachment.objects.filter(file__in=names).values_list('file', flat=True))),
+    ]
+
+
+def sweep_files(grace, batch_size=200, limiter=None, dry_run=False):
+    """Delete unreferenced files and thumbnail directories; returns ``{area: (count, bytes)}``."""
+    cutoff = time.time() - grace.total_seconds()
+    skip = {TEMP_DIR, INCOMING_DIR}
+    report = {}
+    for label, prefix, depth, known in disk_areas():
+        count = size = 0
+        for batch in _batched(scan(prefix, depth, skip), batch_size):
+            in_use = known([name for name, _ in batch])
+            for name, entry in batch:
+                if name in in_use:
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime > cutoff:
+                    continue
+                if limiter:
+                    limiter.wait()
+                if entry.is_dir(follow_symlinks=False):
+                    if not dry_run:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    size += stat.st_size
+                    if not dry_run:
+                        try:
+                            os.remove(entry.path)
+                        except FileNotFoundError:
+                            pass
+                count += 1
+        report[label] = (count, size)
+    return report
@@ -1,3 +1,1994 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from unittest import mock, skipUnless
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import AsyncClient, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (auth, blobs, downloads, fanout, imaging, membership, previews, query_inspector, recorder, revocation,
+               storage, subscriptions, sweeper, thumbnails, unfurl, uploads)
+from .benchmarks import build_application, fixture_page
+from .cache import TTLCache
+from .layers import HybridChannelLayer
+from .utils import HeadPreviewParser, parse_link_preview
+from .models import (Channel, DirectMessageChannel, FileAttachment, LinkPreview, Message, StoredBlob, Team,
+                     TeamInvitation, TeamStorage, UploadSession, UserPresence, UserStorage, thumb_name)
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+HYBRID_LAYER = {'default': {'BACKEND': 'chat.layers.HybridChannelLayer',
+                            'CONFIG': {'inner': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}}}
+
+SMALL, LARGE = 2, 6
+
+
+class ScaledDataset:
+    """A team whose size grows with ``scale``.
+
+    ``owner`` belongs to one team of ``scale`` other members, with one group
+    channel holding ``scale`` messages (each with a reply, a file and a link
+    preview) and a DM channel, with messages, to every other member.
+    ``roamer`` belongs to ``scale`` teams of ``scale`` members each, for the
+    team listings.
+    """
+
+    def __init__(self, scale, prefix):
+        self.scale = scale
+        self.owner = User.objects.create(username=f"{prefix}-owner")
+        self.others = User.objects.bulk_create([
+            User(username=f"{prefix}-m{i}", email=f"{prefix}-m{i}@example.com") for i in range(scale)
+        ])
+        self.team = Team.objects.create(name=f"{prefix}-team")
+        self.team.members.add(self.owner, *self.others)
+        UserPresence.objects.bulk_create([
+            UserPresence(user=user, team=self.team) for user in self.others
+        ])
+
+        self.channel = Channel.objects.create(name=f"{prefix}-general", team=self.team)
+        self.channel.members.add(self.owner, *self.others)
+        self.files = FileAttachment.objects.bulk_create([
+            FileAttachment(file=f"uploads/{prefix}-{i}.txt", original_filename=f"{i}.txt",
+                           content_type='text/plain', size=i, uploaded_by=self.owner)
+            for i in range(scale)
+        ])
+        self.previews = LinkPreview.objects.bulk_create([
+            LinkPreview(url_hash=f"{prefix}-{i}", url=f"https://example.com/{prefix}/{i}", title=f"page {i}",
+                        fetched_at=timezone.now())
+            for i in range(scale)
+        ])
+        previous = None
+        self.messages = []
+        for i, sender in enumerate(self.others):
+            previous = Message.objects.create(channel=self.channel, sender=sender, content=f"message {i}",
+                                              reply_to=previous, preview=self.previews[i])
+            previous.files.add(self.files[i])
+            self.messages.append(previous)
+        self.own_message = Message.objects.create(channel=self.channel, sender=self.owner, content='mine')
+        # Every message but the first is pinned, so the pin list grows with scale
+        Message.objects.filter(id__in=[m.id for m in self.messages[1:]]).update(
+            is_pinned=True, pinned_at=timezone.now(), pinned_by=self.owner)
+
+        self.dm_channels = []
+        for other in self.others:
+            user1, user2 = sorted([self.owner, other], key=lambda u: u.id)
+            dm = Channel.objects.create(name=f"DM {other.username}", team=self.team,
+                                        is_direct_message=True, channel_type='direct')
+            dm.members.add(self.owner, other)
+            DirectMessageChannel.objects.create(channel=dm, user1=user1, user2=user2)
+            Message.objects.bulk_create([
+                Message(channel=dm, sender=sender, content='hi')
+                for sender in (self.owner, other) * scale
+            ])
+            self.dm_channels.append(dm)
+        self.dm_partner = self.others[0]
+        self.dm_channel = self.dm_channels[0]
+
+        self.roamer = User.objects.create(username=f"{prefix}-roamer")
+        for t in range(scale):
+            team = Team.objects.create(name=f"{prefix}-extra-{t}")
+            team.members.add(self.roamer, *self.others)
+            channel = Channel.objects.create(name=f"{prefix}-extra-{t}", team=team)
+            channel.members.add(self.roamer, *self.others)
+
+
+def describe_queries(captured):
+    """Group captured SQL by shape so repeated (N+1) statements stand out."""
+    shapes = Counter(re.sub(r"\b\d+\b", "N", query['sql']) for query in captured)
+    return "\n".join(f"  {count}x {sql}" for sql, count in shapes.most_common())
+
+
+class QueryCountAssertions:
+    def assertQueriesStable(self, label, measure):
+        """``measure(dataset)`` returns captured queries; counts must not grow with size."""
+        small = measure(ScaledDataset(SMALL, f"{label}-s"))
+        large = measure(ScaledDataset(LARGE, f"{label}-l"))
+        if len(large) > len(small):
+            self.fail(
+                f"{label}: {len(small)} queries at scale {SMALL} but {len(large)} at scale {LARGE}.\n"
+                f"Queries at scale {LARGE}:\n{describe_queries(large)}"
+            )
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class ConsumerQueryCountTests(QueryCountAssertions, TransactionTestCase):
+    """Each ChatConsumer handler issues the same number of queries at any data size."""
+
+    async def _drive(self, user, frame, is_reply):
+        communicator = WebsocketCommunicator(build_application(), f"/ws/chat/?token={AccessToken.for_user(user)}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        # Our own presence broadcast marks the end of connect()'s queries.
+        while True:
+            payload = await communicator.receive_json_from(timeout=5)
+            if payload.get('type') == 'user_presence' and payload.get('user_id') == user.id:
+                break
+
+        context = CaptureQueriesContext(connection)
+        await database_sync_to_async(context.__enter__)()
+        try:
+            await communicator.send_json_to(frame)
+            while True:
+                payload = await communicator.receive_json_from(timeout=5)
+                if is_reply(payload):
+                    break
+        finally:
+            await database_sync_to_async(context.__exit__)(None, None, None)
+            await communicator.disconnect()
+        return context.captured_queries
+
+    def check_handler(self, label, build_frame, is_reply):
+        def measure(ds):
+            return async_to_sync(self._drive)(ds.owner, build_frame(ds), is_reply)
+
+        self.assertQueriesStable(label, measure)
+
+    def test_get_channel_messages(self):
+        self.check_handler(
+            'get_channel_messages',
+            lambda ds: {'message_type': 'get_channel_messages', 'channel_id': ds.channel.id},
+            lambda p: p.get('type') == 'channel_messages',
+        )
+
+    def test_get_direct_messages(self):
+        self.check_handler(
+            'get_direct_messages',
+            lambda ds: {'message_type': 'get_direct_messages', 'channel_id': ds.dm_channel.id},
+            lambda p: p.get('type') == 'direct_messages',
+        )
+
+    def test_get_team_channels(self):
+        self.check_handler(
+            'get_team_channels',
+            lambda ds: {'message_type': 'get_team_channels', 'team_id': ds.team.id},
+            lambda p: p.get('type') == 'team_channels',
+        )
+
+    def test_get_team_members(self):
+        self.check_handler(
+            'get_team_members',
+            lambda ds: {'message_type': 'get_team_members', 'team_id': ds.team.id},
+            lambda p: p.get('type') == 'team_members',
+        )
+
+    def test_get_interacted_users(self):
+        self.check_handler(
+            'get_interacted_users',
+            lambda ds: {'message_type': 'get_interacted_users', 'team_id': ds.team.id},
+            lambda p: p.get('type') == 'interacted_users',
+        )
+
+    def test_get_user_presences(self):
+        self.check_handler(
+            'get_user_presences',
+            lambda ds: {'message_type': 'get_user_presences', 'team_id': ds.team.id},
+            lambda p: p.get('type') == 'user_presences',
+        )
+
+    def test_channel_message_with_files(self):
+        self.check_handler(
+            'channel_message',
+            lambda ds: {'message_type': 'channel_message', 'channel': ds.channel.id, 'content': 'hello',
+                        'reply_to': ds.messages[-1].id, 'fileIds': [f.id for f in ds.files]},
+            lambda p: p.get('type') == 'channels',
+        )
+
+    def test_direct_message_with_files(self):
+        self.check_handler(
+            'direct_message',
+            lambda ds: {'message_type': 'direct_message', 'channel_id': ds.dm_channel.id, 'content': 'hello',
+                        'recipient_id': ds.dm_partner.id, 'team_id': ds.team.id,
+                        'fileIds': [f.id for f in ds.files]},
+            lambda p: p.get('type') == 'direct',
+        )
+
+    def test_forward_message(self):
+        self.check_handler(
+            'forward_message',
+            lambda ds: {'message_type': 'forward_message', 'channels': [ds.channel.id], 'content': 'fwd'},
+            lambda p: p.get('is_forwarded'),
+        )
+
+    def test_reaction(self):
+        self.check_handler(
+            'reaction',
+            lambda ds: {'message_type': 'reaction', 'message_id': ds.messages[0].id, 'reaction': '+1'},
+            lambda p: p.get('type') == 'reaction_update',
+        )
+
+    def test_edit_message(self):
+        self.check_handler(
+            'edit_message',
+            lambda ds: {'message_type': 'edit_message', 'message_id': ds.own_message.id, 'content': 'edited'},
+            lambda p: p.get('type') == 'message_edited',
+        )
+
+    def test_delete_message(self):
+        self.check_handler(
+            'delete_message',
+            lambda ds: {'message_type': 'delete_message', 'message_id': ds.own_message.id},
+            lambda p: p.get('type') == 'message_deleted',
+        )
+
+    def test_pin_and_unpin_message(self):
+        self.check_handler(
+            'pin_message',
+            lambda ds: {'message_type': 'pin_message', 'message_id': ds.messages[0].id},
+            lambda p: p.get('type') == 'message_pinned',
+        )
+        self.check_handler(
+            'unpin_message',
+            lambda ds: {'message_type': 'unpin_message', 'message_id': ds.messages[1].id},
+            lambda p: p.get('type') == 'message_unpinned',
+        )
+
+    def test_get_pinned_messages(self):
+        self.check_handler(
+            'get_pinned_messages',
+            lambda ds: {'message_type': 'get_pinned_messages', 'channel_id': ds.channel.id},
+            lambda p: p.get('type') == 'pinned_messages',
+        )
+
+    def test_create_channel(self):
+        self.check_handler(
+            'create_channel',
+            lambda ds: {'message_type': 'create_channel', 'team_id': ds.team.id, 'name': 'new'},
+            lambda p: p.get('type') == 'channel_created',
+        )
+
+    def test_add_team_member(self):
+        def frame(ds):
+            newcomer = User.objects.create(username=f"{ds.owner.username}-newcomer")
+            return {'message_type': 'add_team_member', 'team_id': ds.team.id, 'user_id': newcomer.id}
+
+        self.check_handler('add_team_member', frame, lambda p: 'user_id' in p and 'type' not in p)
+
+    def test_team_notification(self):
+        self.check_handler(
+            'team_notification',
+            lambda ds: {'message_type': 'team_notification', 'team_id': ds.team.id, 'notification_type': 'ping'},
+            lambda p: p.get('type') == 'ping',
+        )
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class PinTests(TransactionTestCase):
+    def setUp(self):
+        self.ds = ScaledDataset(SMALL + 1, 'pins')
+        Message.objects.update(is_pinned=False, pinned_at=None, pinned_by=None)
+
+    async def _send(self, user, frames, reply_type=None):
+        """Send ``frames`` in order and return the ``reply_type`` reply to the last one."""
+        communicator = WebsocketCommunicator(build_application(), f"/ws/chat/?token={AccessToken.for_user(user)}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        try:
+            for frame in frames:
+                await communicator.send_json_to(frame)
+            if reply_type is None:
+                self.assertTrue(await communicator.receive_nothing(timeout=0.5))
+                return None
+            while True:
+                payload = await communicator.receive_json_from(timeout=5)
+                if payload.get('type') == reply_type and payload.get('message_id') == frames[-1].get('message_id'):
+                    return payload
+        finally:
+            await communicator.disconnect()
+
+    def test_pins_accumulate_in_pin_order(self):
+        first, second = self.ds.messages[1], self.ds.messages[0]
+        reply = async_to_sync(self._send)(self.ds.owner, [
+            {'message_type': 'pin_message', 'message_id': first.id},
+            {'message_type': 'pin_message', 'message_id': second.id},
+        ], 'message_pinned')
+
+        pins = reply['pinned_messages']
+        self.assertEqual([pin['id'] for pin in pins], [first.id, second.id])
+        self.assertEqual({pin['pinned_by_id'] for pin in pins}, {self.ds.owner.id})
+
+        client = APIClient()
+        client.force_authenticate(self.ds.others[0])
+        response = client.get(f"/api/chat/channels/{self.ds.channel.id}/pinned_messages/")
+        self.assertEqual([pin['id'] for pin in response.json()], [first.id, second.id])
+        self.assertEqual(response.json()[0]['pinned_by']['id'], self.ds.owner.id)
+
+    def test_unpin_broadcasts_remaining_pins(self):
+        first, second = self.ds.messages[0], self.ds.messages[1]
+        reply = async_to_sync(self._send)(self.ds.owner, [
+            {'message_type': 'pin_message', 'message_id': first.id},
+            {'message_type': 'pin_message', 'message_id': second.id},
+            {'message_type': 'unpin_message', 'message_id': first.id},
+        ], 'message_unpinned')
+        self.assertEqual([pin['id'] for pin in reply['pinned_messages']], [second.id])
+        first.refresh_from_db()
+        self.assertFalse(first.is_pinned)
+        self.assertIsNone(first.pinned_by_id)
+
+    def test_non_members_cannot_pin(self):
+        outsider = User.objects.create(username='pins-outsider')
+        async_to_sync(self._send)(outsider, [
+            {'message_type': 'pin_message', 'message_id': self.ds.messages[0].id},
+            {'message_type': 'get_pinned_messages', 'channel_id': self.ds.channel.id},
+        ])
+        self.assertFalse(Message.objects.filter(is_pinned=True).exists())
+
+
+class ViewQueryCountTests(QueryCountAssertions, TransactionTestCase):
+    """Each chat.views endpoint issues the same number of queries at any data size."""
+
+    def check_endpoint(self, label, user_for, method, path_for, data_for=None):
+        def measure(ds):
+            client = APIClient()
+            client.force_authenticate(user_for(ds))
+            data = data_for(ds) if data_for else None
+            with CaptureQueriesContext(connection) as context:
+                response = getattr(client, method)(path_for(ds), data, format='json')
+            self.assertLess(response.status_code, 400, response.content)
+            return context.captured_queries
+
+        self.assertQueriesStable(label, measure)
+
+    def test_users_in_team(self):
+        self.check_endpoint('users-in-team', lambda ds: ds.owner, 'get',
+                            lambda ds: f"/api/chat/users/in_team/?team_id={ds.team.id}")
+
+    def test_users_in_channel(self):
+        self.check_endpoint('users-in-channel', lambda ds: ds.owner, 'get',
+                            lambda ds: f"/api/chat/users/in_channel/?channel_id={ds.channel.id}")
+
+    def test_users_interacted(self):
+        self.check_endpoint('users-interacted', lambda ds: ds.owner, 'get',
+                            lambda ds: f"/api/chat/users/interacted/?team_id={ds.team.id}")
+
+    def test_team_list(self):
+        self.check_endpoint('team-list', lambda ds: ds.roamer, 'get', lambda ds: "/api/chat/teams/")
+
+    def test_team_detail(self):
+        self.check_endpoint('team-detail', lambda ds: ds.owner, 'get', lambda ds: f"/api/chat/teams/{ds.team.id}/")
+
+    def test_team_invitations(self):
+        self.check_endpoint('team-invitations', lambda ds: ds.owner, 'get',
+                            lambda ds: f"/api/chat/teams/{ds.team.id}/invitations/")
+
+    def test_channel_list(self):
+        self.check_endpoint('channel-list', lambda ds: ds.roamer, 'get', lambda ds: "/api/chat/channels/")
+
+    def test_channels_for_team(self):
+        self.check_endpoint('channels-team-id', lambda ds: ds.owner, 'post', lambda ds: "/api/chat/channels/team_id/",
+                            lambda ds: {'team_id': ds.team.id})
+
+    def test_channel_messages(self):
+        self.check_endpoint('channel-messages', lambda ds: ds.owner, 'get',
+                            lambda ds: f"/api/chat/channels/{ds.channel.id}/messages/")
+
+    def test_channel_pinned_messages(self):
+        self.check_endpoint('channel-pinned-messages', lambda ds: ds.owner, 'get',
+                            lambda ds: f"/api/chat/channels/{ds.channel.id}/pinned_messages/")
+
+    def test_message_list(self):
+        self.check_endpoint('message-list', lambda ds: ds.owner, 'get', lambda ds: "/api/chat/messages/")
+
+    def test_direct_messages(self):
+        self.check_endpoint('direct-messages', lambda ds: ds.owner, 'get',
+                            lambda ds: f"/api/chat/messages/direct_messages/?user_id={ds.dm_partner.id}")
+
+
+@override_settings(CHAT_QUERY_INSPECTOR={'ENABLED': True, 'N_PLUS_ONE_THRESHOLD': 3, 'SLOW_QUERY_MS': 10000})
+class QueryInspectorTests(TransactionTestCase):
+    def setUp(self):
+        query_inspector.install()
+        query_inspector.stats.reset()
+
+    def test_query_shape_collapses_literals_and_in_lists(self):
+        self.assertEqual(
+            query_inspector.query_shape("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x' LIMIT 21"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT N",
+        )
+
+    def test_repeated_shapes_are_reported_with_origin(self):
+        users = User.objects.bulk_create([User(username=f"inspect-{i}") for i in range(4)])
+        with query_inspector.inspect('unit'):
+            for user in users:
+                list(user.teams.all())
+
+        findings = query_inspector.stats.snapshot()
+        self.assertEqual([(f['label'], f['kind'], f['max_count']) for f in findings], [('unit', 'n_plus_one', 4)])
+        self.assertTrue(findings[0]['origin'][0].startswith('chat/tests.py'))
+
+    def test_queries_outside_inspect_are_ignored(self):
+        for i in range(4):
+            User.objects.filter(id=i).exists()
+        self.assertEqual(query_inspector.stats.snapshot(), [])
+
+    @override_settings(CHAT_QUERY_INSPECTOR={'ENABLED': True, 'SLOW_QUERY_MS': 0})
+    def test_http_requests_are_grouped_per_path(self):
+        ds = ScaledDataset(SMALL, 'inspect')
+        admin = User.objects.create(username='inspect-admin', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(ds.owner)
+        client.get(f"/api/chat/channels/{ds.channel.id}/messages/")
+        client.force_authenticate(admin)
+        response = client.get('/api/chat/debug/query-stats/')
+
+        self.assertTrue(response.data['enabled'])
+        labels = {finding['label'] for finding in response.data['findings']}
+        self.assertEqual(labels, {'GET /api/chat/channels/<id>/messages/'})
+
+
+class StandInServer:
+    """Local HTTP server for preview tests, counting hits per path.
+
+    ``/page/<name>`` serves a small HTML page with an ETag (answering a
+    matching ``If-None-Match`` with 304), ``/slow/<name>`` the same after a
+    delay, ``/binary/<name>`` a PDF, ``/redirect?to=<url>`` a 302 to ``url``
+    and anything else a 404.
+    """
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.hits = Counter()
+        self.not_modified = Counter()
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.hits[self.path] += 1
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    if self.path.startswith('/slow/'):
+                        time.sleep(server.delay)
+                    if self.path.startswith('/redirect?to='):
+                        self.send_response(302)
+                        self.send_header('Location', self.path.split('=', 1)[1])
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    if self.path.startswith('/binary/'):
+                        body = b'%PDF-1.4' + b'\0' * 1024
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'application/pdf')
+                    elif self.path.startswith(('/page/', '/slow/')):
+                        name = self.path.rsplit('/', 1)[-1]
+                        etag = f'"{name}-v1"'
+                        if self.headers.get('If-None-Match') == etag:
+                            with server.lock:
+                                server.not_modified[self.path] += 1
+                            self.send_response(304)
+                            self.end_headers()
+                            return
+                        body = (f'<html><head><title>{name}</title>'
+                                f'<meta property="og:image" content="/img/{name}.png"></head>'
+                                f'<body>{name}</body></html>').encode()
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'text/html; charset=utf-8')
+                        self.send_header('ETag', etag)
+                    else:
+                        body = b'not found'
+                        self.send_response(404)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class LinkPreviewServiceTests(TransactionTestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.addCleanup(self.server.close)
+        self.service = previews.PreviewService({'PER_HOST_LIMIT': 2})
+
+    def test_normalize_url(self):
+        self.assertEqual(previews.normalize_url(' HTTP://Example.COM:80#frag'), 'http://example.com/')
+        self.assertEqual(previews.normalize_url('https://example.com:8443/a?b=1'), 'https://example.com:8443/a?b=1')
+        with self.assertRaises(ValueError):
+            previews.normalize_url('javascript:alert(1)')
+
+    async def test_only_public_addresses_are_fetched(self):
+        strict = previews.PreviewService({'ALLOWED_NETWORKS': []})
+        for url in (f"{self.server.base}/page/internal", 'http://169.254.169.254/latest/meta-data/',
+                    'http://[::ffff:127.0.0.1]/page/mapped'):
+            with self.assertLogs('chat.previews', 'INFO') as logs:
+                self.assertIsNone((await strict.fetch(url))['title'])
+            self.assertIn('is not a public address', logs.output[0])
+        await strict.close()
+        self.assertEqual(self.server.hits['/page/internal'], 0)
+
+        # Every redirect hop is checked before it is connected to
+        service = previews.PreviewService({'ALLOWED_NETWORKS': ['127.0.0.1/32']})
+        self.assertEqual((await service.fetch(f"{self.server.base}/redirect?to=/page/hop"))['title'], 'hop')
+        with self.assertLogs('chat.previews', 'INFO') as logs:
+            await service.fetch(f"{self.server.base}/redirect?to=http://169.254.169.254/")
+        self.assertIn('169.254.169.254 is not a public address', logs.output[0])
+        await service.close()
+
+    async def test_concurrent_fetches_share_one_request(self):
+        urls = [f"{self.server.base}/slow/same", f"{self.server.base}/slow/same#a",
+                f"{self.server.base.replace('http', 'HTTP')}/slow/same"] * 3
+        results = await asyncio.gather(*[self.service.fetch(url) for url in urls])
+        await self.service.close()
+
+        self.assertEqual(self.server.hits['/slow/same'], 1)
+        self.assertEqual({result['title'] for result in results}, {'same'})
+        self.assertEqual(results[0]['image'], f"{self.server.base}/img/same.png")
+
+    async def test_results_and_failures_are_cached(self):
+        for _ in range(3):
+            await self.service.fetch(f"{self.server.base}/page/cached")
+            missing = await self.service.fetch(f"{self.server.base}/missing")
+        await self.service.close()
+
+        self.assertEqual(self.server.hits['/page/cached'], 1)
+        self.assertEqual(self.server.hits['/missing'], 1)
+        self.assertIsNone(missing['title'])
+
+    async def test_per_host_limit(self):
+        await asyncio.gather(*[self.service.fetch(f"{self.server.base}/slow/{i}") for i in range(6)])
+        await self.service.close()
+
+        self.assertEqual(sum(self.server.hits.values()), 6)
+        self.assertLessEqual(self.server.max_active, 2)
+
+    async def test_non_html_is_skipped(self):
+        preview = await self.service.fetch(f"{self.server.base}/binary/doc")
+        await self.service.close()
+        self.assertIsNone(preview['title'])
+        self.assertEqual(preview['site_name'], self.server.base.split('//')[1])
+
+    async def test_previews_are_shared_through_the_database(self):
+        url = f"{self.server.base}/page/shared"
+        await self.service.fetch(url)
+        await self.service.close()
+
+        # Another worker: empty memory cache, same table
+        other = previews.PreviewService()
+        preview = await other.fetch(url)
+        await other.close()
+
+        self.assertEqual(preview['title'], 'shared')
+        self.assertEqual(self.server.hits['/page/shared'], 1)
+        row = await database_sync_to_async(previews.stored_preview)(url)
+        self.assertEqual(row.etag, '"shared-v1"')
+
+    def _age(self, url, seconds):
+        row = previews.stored_preview(url)
+        LinkPreview.objects.filter(id=row.id).update(fetched_at=row.fetched_at - timedelta(seconds=seconds))
+
+    async def test_stale_rows_are_served_while_revalidating(self):
+        url = f"{self.server.base}/page/stale"
+        await self.service.fetch(url)
+        await self.service.close()
+        await database_sync_to_async(self._age)(url, previews.config()['CACHE_TTL'] + 10)
+
+        other = previews.PreviewService()
+        preview = await other.fetch(url)
+        self.assertEqual(preview['title'], 'stale')
+        await other.close()  # waits for the background revalidation
+
+        self.assertEqual(self.server.not_modified['/page/stale'], 1)
+        row = await database_sync_to_async(previews.stored_preview)(url)
+        self.assertLess((timezone.now() - row.fetched_at).total_seconds(), 60)
+
+    async def test_expired_rows_are_revalidated_before_answering(self):
+        url = f"{self.server.base}/page/expired"
+        await self.service.fetch(url)
+        await self.service.close()
+        await database_sync_to_async(self._age)(url, previews.config()['CACHE_TTL'] + 10)
+
+        other = previews.PreviewService({'STALE_WHILE_REVALIDATE': 0})
+        await other.fetch(url)
+        self.assertEqual(self.server.not_modified['/page/expired'], 1)
+        await other.close()
+
+    def test_head_parser_matches_beautifulsoup(self):
+        body = fixture_page(256)
+        chunks = [body[i:i + 1000] for i in range(0, len(body), 1000)]
+        parser = HeadPreviewParser()
+        fed = 0
+        for chunk in chunks:
+            fed += 1
+            if parser.feed_bytes(chunk):
+                break
+
+        url = 'https://bench.example/page'
+        self.assertLess(fed, 5)
+        self.assertEqual(parser.preview(url), parse_link_preview(url, body.decode()))
+        self.assertEqual(parser.preview(url)['image'], 'https://bench.example/static/cover.png')
+
+    def test_head_parser_stops_at_byte_limit(self):
+        parser = HeadPreviewParser(max_bytes=100)
+        self.assertFalse(parser.feed_bytes(b'<html><head><title>Cut</title>'))
+        self.assertTrue(parser.feed_bytes(b'<meta name="description" content="x">' * 10))
+        self.assertEqual(parser.bytes_read, 100)
+        self.assertEqual(parser.preview('http://example.com/')['title'], 'Cut')
+
+    def test_ttl_cache_expiry_and_lru(self):
+        now = [0]
+        cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=1)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)  # evicts 'b', the least recently used
+        self.assertNotIn('b', cache)
+        now[0] = 11
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 1)
+
+
+class TraceRecorderTests(TransactionTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_lines_are_written_off_the_caller_and_old_files_closed(self):
+        first_path, second_path = (os.path.join(self.root, name) for name in ('first.jsonl', 'second.jsonl'))
+        with override_settings(CHAT_WS_TRACE_PATH=first_path):
+            first = recorder.get_recorder()
+            self.assertIs(recorder.get_recorder(), first)
+            for n in range(3):
+                first.write('conn', 1, 'receive', {'message_type': 'ping', 'content': f"hi {n}"})
+        with override_settings(CHAT_WS_TRACE_PATH=second_path):
+            second = recorder.get_recorder()
+            second.write('conn', 1, 'connect')
+            second.close()
+        self.addCleanup(setattr, recorder, '_recorder', None)
+
+        # The swapped-out recorder writes what it had queued, then closes its file
+        first.writer.join(2)
+        self.assertTrue(first.file.closed)
+        with open(first_path, encoding='utf-8') as f:
+            frames = [json.loads(line)['frame'] for line in f]
+        self.assertEqual(frames, [{'message_type': 'ping', 'content': 'xxxx'}] * 3)
+        with open(second_path, encoding='utf-8') as f:
+            self.assertEqual(json.loads(f.read())['event'], 'connect')
+
+
+class LinkPreviewViewTests(TransactionTestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.addCleanup(self.server.close)
+        self.user = User.objects.create(username='preview-user')
+        self.auth = f"Bearer {AccessToken.for_user(self.user)}"
+        previews.service.cache.clear()
+
+    async def test_fetch_preview(self):
+        client = AsyncClient()
+        url = f"{self.server.base}/page/view"
+        response = await client.post('/api/chat/fetch-link-preview/', {'url': url},
+                                     content_type='application/json', headers={'Authorization': self.auth})
+        await previews.service.close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['title'], 'view')
+
+    def test_messages_reference_the_stored_preview(self):
+        url = f"{self.server.base}/page/linked"
+        async_to_sync(previews.fetch)(url)
+        team = Team.objects.create(name='preview-team')
+        channel = Channel.objects.create(name='preview-channel', team=team)
+        team.members.add(self.user)
+        channel.members.add(self.user)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/api/chat/messages/', {
+            'channel': channel.id, 'content': url, 'link_preview': {'url': url, 'title': 'spoofed'},
+        }, format='json')
+
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()['link_preview']['title'], 'linked')
+        message = Message.objects.get(id=response.json()['id'])
+        self.assertIsNone(message.link_preview)
+        self.assertEqual(message.preview, previews.stored_preview(url))
+
+    def test_viewset_action_redirects_to_the_async_view(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/api/chat/messages/fetch_preview/', {'url': f"{self.server.base}/page/action"},
+                               format='json')
+
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(response['Location'], '/api/chat/fetch-link-preview/')
+        self.assertEqual(self.server.hits['/page/action'], 0)
+
+    async def test_requires_authentication_and_valid_url(self):
+        client = AsyncClient()
+        response = await client.post('/api/chat/fetch-link-preview/', {'url': 'http://example.com/'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+        response = await client.post('/api/chat/fetch-link-preview/', {'url': 'ftp://example.com/'},
+                                     content_type='application/json', headers={'Authorization': self.auth})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class UnfurlTests(TransactionTestCase):
+    def setUp(self):
+        self.server = StandInServer(delay=0.5)
+        self.addCleanup(self.server.close)
+        previews.service.cache.clear()
+        self.ds = ScaledDataset(SMALL, 'unfurl')
+
+    def test_first_url(self):
+        self.assertEqual(unfurl.first_url("see (https://example.com/a?b=1)."), 'https://example.com/a?b=1')
+        self.assertIsNone(unfurl.first_url("no links, just ftp://example.com"))
+
+    async def _send(self, frame):
+        """Send ``frame``; return the chat message and, unless it already had a
+        preview, the ``link_preview_ready`` event, each with its arrival delay."""
+        communicator = WebsocketCommunicator(build_application(),
+                                             f"/ws/chat/?token={AccessToken.for_user(self.ds.owner)}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        message = ready = None
+        try:
+            started = time.perf_counter()
+            await communicator.send_json_to(frame)
+            while message is None or (message[0]['link_preview'] is None and ready is None):
+                payload = await communicator.receive_json_from(timeout=5)
+                if payload.get('type') == 'channels':
+                    message = (payload, time.perf_counter() - started)
+                elif payload.get('type') == 'link_preview_ready':
+                    ready = (payload, time.perf_counter() - started)
+        finally:
+            await communicator.disconnect()
+            await previews.service.close()
+        return message, ready
+
+    def test_message_is_delivered_before_its_preview(self):
+        url = f"{self.server.base}/slow/unfurled"
+        frame = {'message_type': 'channel_message', 'channel': self.ds.channel.id, 'content': f"look {url}"}
+        (message, delivered_after), (ready, ready_after) = async_to_sync(self._send)(frame)
+
+        self.assertIsNone(message['link_preview'])
+        self.assertLess(delivered_after, self.server.delay)
+        self.assertGreaterEqual(ready_after, self.server.delay)
+        self.assertEqual(ready['message_id'], message['id'])
+        self.assertEqual(ready['link_preview']['title'], 'unfurled')
+        self.assertEqual(Message.objects.get(id=message['id']).preview.title, 'unfurled')
+
+        # The next message with the same link gets the stored preview inline.
+        (again, _), ready = async_to_sync(self._send)(frame)
+        self.assertEqual(again['link_preview']['title'], 'unfurled')
+        self.assertIsNone(ready)
+        self.assertEqual(self.server.hits['/slow/unfurled'], 1)
+
+    def test_failed_and_expired_rows_are_not_linked(self):
+        now = timezone.now()
+        rows = {
+            'failed': {'ok': False, 'title': None, 'fetched_at': now - timedelta(days=30)},
+            'expired': {'ok': True, 'title': 'old', 'fetched_at': now - timedelta(
+                seconds=previews.config()['CACHE_TTL'] + 10)},
+        }
+        for name, fields in rows.items():
+            url = f"{self.server.base}/page/{name}"
+            key = previews.normalize_url(url)
+            LinkPreview.objects.create(url_hash=previews.url_hash(key), url=key, **fields)
+            self.assertIsNone(unfurl.stored_preview_for(f"see {url}"))
+
+            frame = {'message_type': 'channel_message', 'channel': self.ds.channel.id, 'content': f"see {url}"}
+            (message, _), ready = async_to_sync(self._send)(frame)
+            self.assertIsNone(message['link_preview'])
+            # Unfurled again: refetched, or served stale while it revalidates
+            self.assertIsNotNone(ready)
+            self.assertIsNotNone(Message.objects.get(id=message['id']).preview.title)
+        self.assertEqual(self.server.hits['/page/failed'], 1)
+
+
+class MediaTestCase(TransactionTestCase):
+    """Runs each test against an empty, temporary MEDIA_ROOT."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = override_settings(MEDIA_ROOT=self.media_root,
+                                     CHAT_UPLOADS={'BLOCK_SIZE': 7, 'MAX_CHUNK_SIZE': 64})
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+
+class UploadTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='uploader')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.data = bytes(range(256)) * 2
+
+    def open(self, data, **extra):
+        response = self.client.post('/api/chat/uploads/', {
+            'filename': 'report.bin', 'content_type': 'application/octet-stream', 'size': len(data), **extra,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['upload_id']
+
+    def put(self, upload_id, offset, chunk, checksum=None):
+        return self.client.put(f"/api/chat/uploads/{upload_id}/chunk/?offset={offset}", chunk,
+                               content_type='application/octet-stream',
+                               headers={'X-Chunk-SHA256': checksum or hashlib.sha256(chunk).hexdigest()})
+
+    def test_upload_resumes_from_the_stored_offset(self):
+        upload_id = self.open(self.data, sha256=hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(self.put(upload_id, 0, self.data[:64]).json()['offset'], 64)
+
+        # A chunk at the wrong offset, or with a bad checksum, does not move the offset
+        response = self.put(upload_id, 0, self.data[:64])
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 64))
+        response = self.put(upload_id, 64, self.data[64:128], checksum='0' * 64)
+        self.assertEqual((response.status_code, response.json()['offset']), (400, 64))
+        session = UploadSession.objects.get(id=upload_id)
+        self.assertEqual(os.path.getsize(uploads.default_storage.path(session.file)), 64)
+
+        # After a disconnect the client asks where to carry on
+        offset = self.client.get(f"/api/chat/uploads/{upload_id}/").json()['offset']
+        self.assertEqual(self.client.post(f"/api/chat/uploads/{upload_id}/complete/").status_code, 409)
+        while offset < len(self.data):
+            offset = self.put(upload_id, offset, self.data[offset:offset + 64]).json()['offset']
+
+        response = self.client.post(f"/api/chat/uploads/{upload_id}/complete/")
+        self.assertEqual(response.status_code, 201, response.content)
+        attachment = FileAttachment.objects.get(id=response.json()['id'])
+        self.assertEqual(attachment.file.name, blobs.blob_name(hashlib.sha256(self.data).hexdigest()))
+        self.assertFalse(os.path.exists(uploads.default_storage.path(session.file)))
+        self.assertEqual(attachment.size, len(self.data))
+        with attachment.file.open('rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_duplicate_chunks_never_cut_committed_bytes(self):
+        upload_id = self.open(self.data)
+        # Two requests for the same offset, both loaded before either wrote
+        first, late, corrupt = (UploadSession.objects.get(id=upload_id) for _ in range(3))
+        chunk = self.data[:64]
+        self.assertEqual(uploads.write_chunk(first, 0, io.BytesIO(chunk), 64, hashlib.sha256(chunk).hexdigest()), 64)
+
+        with self.assertRaises(uploads.UploadError) as caught:
+            uploads.write_chunk(late, 0, io.BytesIO(chunk), 64, hashlib.sha256(chunk).hexdigest())
+        self.assertEqual((caught.exception.status, caught.exception.offset), (409, 64))
+        with self.assertRaises(uploads.UploadError) as caught:
+            uploads.write_chunk(corrupt, 0, io.BytesIO(b'x' * 64), 64, hashlib.sha256(chunk).hexdigest())
+        # Turned away by the offset checked under the lock, before a byte is written
+        self.assertEqual((caught.exception.status, caught.exception.offset), (409, 64))
+
+        with open(uploads.default_storage.path(first.file), 'rb') as f:
+            self.assertEqual(f.read(), chunk)
+        self.assertEqual(UploadSession.objects.get(id=upload_id).received, 64)
+
+    def test_finalize_uses_the_running_digest(self):
+        digest = hashlib.sha256(self.data).hexdigest()
+        for forget in (False, True):
+            upload_id = self.open(self.data, sha256=digest)
+            for offset in range(0, len(self.data), 64):
+                self.put(upload_id, offset, self.data[offset:offset + 64])
+            if forget:
+                # As if the chunks had gone through another worker
+                uploads.digests().clear()
+            with mock.patch('chat.uploads.blobs.file_sha256', wraps=blobs.file_sha256) as rehash:
+                response = self.client.post(f"/api/chat/uploads/{upload_id}/complete/")
+            self.assertEqual(response.status_code, 201, response.content)
+            self.assertEqual(rehash.call_count, int(forget))
+        self.assertEqual(FileAttachment.objects.get(id=response.json()['id']).file.name, blobs.blob_name(digest))
+
+    def test_chunk_limits_and_ownership(self):
+        upload_id = self.open(self.data)
+        self.assertEqual(self.put(upload_id, 0, self.data[:65]).status_code, 413)
+        other = APIClient()
+        other.force_authenticate(User.objects.create(username='someone-else'))
+        self.assertEqual(other.get(f"/api/chat/uploads/{upload_id}/").status_code, 404)
+
+    def test_whole_file_checksum_mismatch_discards_the_upload(self):
+        upload_id = self.open(self.data[:64], sha256='0' * 64)
+        self.put(upload_id, 0, self.data[:64])
+        path = uploads.default_storage.path(UploadSession.objects.get(id=upload_id).file)
+
+        response = self.client.post(f"/api/chat/uploads/{upload_id}/complete/")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(FileAttachment.objects.exists())
+
+    def test_stale_sessions_are_purged(self):
+        stale, fresh = self.open(self.data), self.open(self.data)
+        UploadSession.objects.filter(id=stale).update(updated_at=timezone.now() - timedelta(days=2))
+        stale_path = uploads.default_storage.path(UploadSession.objects.get(id=stale).file)
+
+        call_command('purge_upload_sessions', batch_size=1, stdout=io.StringIO())
+
+        self.assertEqual([str(pk) for pk in UploadSession.objects.values_list('id', flat=True)], [fresh])
+        self.assertFalse(os.path.exists(stale_path))
+
+
+class BlobStorageTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='blob-owner')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, name, data):
+        response = self.client.post('/api/chat/upload-file/', {'file': SimpleUploadedFile(name, data)},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return FileAttachment.objects.get(id=response.json()['id'])
+
+    def test_identical_uploads_share_one_blob(self):
+        data = b'quarterly report' * 1000
+        digest = hashlib.sha256(data).hexdigest()
+        first, second = self.upload('report.pdf', data), self.upload('copy.pdf', data)
+
+        self.assertEqual(first.file.name, f"blobs/{digest[:2]}/{digest[2:4]}/{digest}")
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual((second.original_filename, second.size), ('copy.pdf', len(data)))
+        self.assertEqual(StoredBlob.objects.get().refs, 2)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'blobs', 'tmp')), [])
+
+        path = first.file.path
+        first.delete()
+        self.assertEqual(StoredBlob.objects.get().refs, 1)
+        self.assertTrue(os.path.exists(path))
+        second.delete()
+        self.assertFalse(StoredBlob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_uploads_racing_a_release_keep_their_file(self):
+        data = b'weekly report' * 1000
+        first = self.upload('report.pdf', data)
+        path = first.file.path
+        pending = []
+        with mock.patch('chat.blobs.transaction.on_commit', pending.append):
+            first.delete()
+        second = self.upload('copy.pdf', data)
+        for callback in pending:
+            callback()
+        self.assertEqual(StoredBlob.objects.get().refs, 1)
+        self.assertTrue(os.path.exists(path))
+
+        # The removal commits between the lookup and the new reference
+        with mock.patch('chat.blobs.transaction.on_commit'):
+            second.delete()
+        get_or_create = StoredBlob.objects.get_or_create
+
+        def removed_meanwhile(**kwargs):
+            blob, created = get_or_create(**kwargs)
+            if not created and StoredBlob.objects.filter(pk=blob.pk, refs=0).exists():
+                blobs.remove(blob.pk, blob.sha256)
+            return blob, created
+
+        with mock.patch.object(StoredBlob.objects, 'get_or_create', side_effect=removed_meanwhile):
+            third = self.upload('again.pdf', data)
+        self.assertEqual(StoredBlob.objects.get(pk=third.blob_id).refs, 1)
+        self.assertTrue(os.path.exists(third.file.path))
+
+    def test_dedup_attachments_moves_legacy_files(self):
+        os.makedirs(os.path.join(self.media_root, 'uploads'))
+        legacy = []
+        for name, data in [('a.txt', b'same'), ('b.txt', b'same'), ('c.txt', b'other'), ('gone.txt', None)]:
+            if data is not None:
+                with open(os.path.join(self.media_root, 'uploads', name), 'wb') as f:
+                    f.write(data)
+            legacy.append(FileAttachment.objects.create(file=f"uploads/{name}", original_filename=name,
+                                                        content_type='text/plain', size=4, uploaded_by=self.user))
+        out = io.StringIO()
+
+        call_command('dedup_attachments', batch_size=2, stdout=out)
+
+        self.assertIn('Hashed 3 attachment(s): 1 duplicate(s) merged', out.getvalue())
+        a, b, c, gone = (FileAttachment.objects.get(id=attachment.id) for attachment in legacy)
+        self.assertEqual(a.file.name, blobs.blob_name(hashlib.sha256(b'same').hexdigest()))
+        self.assertEqual((b.file.name, b.blob_id), (a.file.name, a.blob_id))
+        self.assertEqual(a.blob.refs, 2)
+        self.assertEqual(c.blob.refs, 1)
+        self.assertIsNone(gone.blob_id)
+        with a.file.open('rb') as f:
+            self.assertEqual(f.read(), b'same')
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'uploads')), [])
+
+
+class DownloadTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='downloader')
+        self.auth = {'Authorization': f"Bearer {AccessToken.for_user(self.user)}"}
+        self.data = os.urandom(1000)
+        self.attachment = blobs.store([self.data], original_filename='clip.mp4', content_type='video/mp4',
+                                      uploaded_by=self.user)
+        self.url = f"/api/chat/{self.attachment.id}/download/"
+        self.etag = f'"{hashlib.sha256(self.data).hexdigest()}"'
+
+    async def get(self, **headers):
+        response = await AsyncClient().get(self.url, headers={**self.auth, **headers})
+        body = b''.join([chunk async for chunk in response.streaming_content]) if response.streaming else b''
+        return response, body
+
+    async def test_full_download_with_validators(self):
+        response, body = await self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Length'], '1000')
+        self.assertIn('clip.mp4', response['Content-Disposition'])
+
+        response, body = await self.get(**{'If-None-Match': self.etag})
+        self.assertEqual((response.status_code, body), (304, b''))
+        self.assertEqual(response['ETag'], self.etag)
+
+    async def test_single_ranges(self):
+        response, body = await self.get(Range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.data[100:200])
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1000')
+
+        response, body = await self.get(Range='bytes=-10')
+        self.assertEqual((response.status_code, body), (206, self.data[-10:]))
+        response, body = await self.get(Range='bytes=990-5000')
+        self.assertEqual((response['Content-Range'], body), ('bytes 990-999/1000', self.data[990:]))
+
+        # A changed file (different If-Range validator) is sent whole
+        response, body = await self.get(Range='bytes=100-199', **{'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, body), (200, self.data))
+
+        response, _ = await self.get(Range='bytes=1000-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */1000'))
+
+    def test_parse_range(self):
+        self.assertIsNone(downloads.parse_range('bytes=0-1,5-6', 10))
+        self.assertIsNone(downloads.parse_range('items=0-1', 10))
+        self.assertEqual(downloads.parse_range('bytes=5-', 10), (5, 9))
+        self.assertEqual(downloads.parse_range('bytes=-20', 10), (0, 9))
+        with self.assertRaises(ValueError):
+            downloads.parse_range('bytes=6-5', 10)
+
+    async def test_offload_to_front_proxy(self):
+        with override_settings(CHAT_DOWNLOADS={'OFFLOAD': 'x-accel-redirect', 'OFFLOAD_PREFIX': '/protected/'}):
+            response = await AsyncClient().get(self.url, headers=self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f"/protected/{self.attachment.file.name}")
+        self.assertEqual(response.content, b'')
+
+    async def test_requires_authentication(self):
+        response = await AsyncClient().get(self.url)
+        self.assertEqual(response.status_code, 401)
+        response = await AsyncClient().get('/api/chat/999999/download/', headers=self.auth)
+        self.assertEqual(response.status_code, 404)
+
+
+@skipUnless(imaging.AVAILABLE, 'Pillow is not installed')
+class ThumbnailTests(MediaTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        thumbnails.shutdown()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='photographer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, name, data, content_type):
+        response = self.client.post('/api/chat/upload-file/',
+                                    {'file': SimpleUploadedFile(name, data, content_type=content_type)},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        attachment = FileAttachment.objects.select_related('blob').get(id=response.json()['id'])
+        deadline = time.monotonic() + 30
+        while (content_type.startswith('image/') and attachment.blob.thumbnails is None
+               and time.monotonic() < deadline):
+            time.sleep(0.05)
+            attachment.blob.refresh_from_db()
+        return attachment
+
+    def test_blurhash_matches_reference_encoder(self):
+        from PIL import Image
+        image = Image.linear_gradient('L').resize((32, 20)).convert('RGB')
+        self.assertEqual(imaging.blurhash(image), 'LyHV9woffQof00WBfQWBxuj[fQj[')
+
+    def test_image_upload_gets_thumbnails_and_metadata(self):
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.linear_gradient('L').resize((1600, 900)).convert('RGB').save(buffer, 'PNG')
+
+        attachment = self.upload('photo.png', buffer.getvalue(), 'image/png')
+
+        info = attachment.to_dict()
+        self.assertEqual((info['width'], info['height']), (1600, 900))
+        self.assertEqual(len(info['placeholder']), 28)
+        self.assertEqual(set(info['thumbnails']), {'160', '480', '1280'})
+        digest = attachment.blob.sha256
+        with Image.open(os.path.join(self.media_root, 'thumbs', digest[:2], digest[2:4], digest, '480.webp')) as thumb:
+            self.assertEqual(thumb.size, (480, 270))
+
+    def test_undecodable_images_get_no_image_fields(self):
+        attachment = self.upload('broken.png', b'not a png', 'image/png')
+        self.assertEqual(attachment.blob.thumbnails, [])
+        self.assertNotIn('width', attachment.to_dict())
+
+        attachment = self.upload('notes.txt', b'text', 'text/plain')
+        self.assertIsNone(attachment.blob.thumbnails)
+        self.assertNotIn('thumbnails', attachment.to_dict())
+
+
+class StorageAccountingTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='accountant')
+        self.team = Team.objects.create(name='ledger')
+        self.team.members.add(self.user)
+        self.channel = Channel.objects.create(name='ledger-general', team=self.team)
+        self.channel.members.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, data, team_id=None):
+        path = '/api/chat/upload-file/' + (f"?team_id={team_id}" if team_id else '')
+        return self.client.post(path, {'file': SimpleUploadedFile('f.bin', data)}, format='multipart')
+
+    def counters(self):
+        return storage.usage(UserStorage, self.user.id), storage.usage(TeamStorage, self.team.id)
+
+    def test_counters_follow_upload_attach_and_delete(self):
+        first = FileAttachment.objects.get(id=self.upload(b'x' * 100).json()['id'])
+        second = FileAttachment.objects.get(id=self.upload(b'y' * 50).json()['id'])
+        self.assertEqual(self.counters(), (150, 0))
+
+        message = Message.objects.create(channel=self.channel, sender=self.user, content='files')
+        storage.attach(message, [first.id, second.id], self.team.id)
+        other = Message.objects.create(channel=self.channel, sender=self.user, content='again')
+        storage.attach(other, [first.id], self.team.id)
+        self.assertEqual(self.counters(), (150, 250))
+
+        response = self.client.delete(f"/api/chat/messages/{message.id}/")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.counters(), (150, 100))
+
+        first.delete()
+        self.assertEqual(self.counters(), (50, 0))
+        self.assertEqual(self.client.get(f"/api/chat/teams/{self.team.id}/storage/").json(),
+                         {'bytes': 0, 'quota': None})
+
+    def test_quota_is_checked_before_the_upload_is_stored(self):
+        self.upload(b'x' * 100)
+        with override_settings(CHAT_STORAGE={'USER_QUOTA': 1000, 'TEAM_QUOTA': 10}):
+            self.assertEqual(self.upload(b'x' * 2000).status_code, 413)
+            self.assertEqual(self.upload(b'x' * 5, team_id=self.team.id).status_code, 413)
+            self.assertEqual(self.upload(b'x' * 5).status_code, 201)
+            response = self.client.post('/api/chat/uploads/', {'filename': 'big', 'size': 5000}, format='json')
+            self.assertEqual(response.status_code, 413)
+            # Only a team of the uploader's can be named
+            stranger = Team.objects.create(name='not-mine')
+            for team_id in ('abc', stranger.id):
+                self.assertEqual(self.upload(b'x' * 5, team_id=team_id).status_code, 400)
+                response = self.client.post('/api/chat/uploads/', {'filename': 'f', 'size': 5, 'team_id': team_id},
+                                            format='json')
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(FileAttachment.objects.count(), 2)
+
+    def test_team_quota_is_enforced_on_attach(self):
+        attachment = FileAttachment.objects.get(id=self.upload(b'x' * 100).json()['id'])
+        message = Message.objects.create(channel=self.channel, sender=self.user, content='files')
+        with override_settings(CHAT_STORAGE={'TEAM_QUOTA': 150}):
+            storage.attach(message, [attachment.id], self.team.id)
+            other = Message.objects.create(channel=self.channel, sender=self.user, content='again')
+            with self.assertRaises(storage.QuotaExceeded):
+                storage.attach(other, [attachment.id], self.team.id)
+        self.assertEqual(self.counters(), (100, 100))
+        self.assertFalse(other.files.exists())
+
+    def test_reconcile_corrects_drift(self):
+        attachment = FileAttachment.objects.get(id=self.upload(b'x' * 100).json()['id'])
+        message = Message.objects.create(channel=self.channel, sender=self.user, content='raw')
+        message.files.add(attachment)  # bypasses the counters
+        UserStorage.objects.filter(pk=self.user.id).update(bytes=7)
+        out = io.StringIO()
+
+        call_command('reconcile_storage', batch_size=1, stdout=out)
+
+        self.assertEqual(self.counters(), (100, 100))
+        self.assertIn('corrected 1', out.getvalue())
+        call_command('reconcile_storage', stdout=out)
+        self.assertTrue(out.getvalue().rstrip().endswith('corrected 0.'))
+
+
+class SweeperTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='sweeper')
+        self.old = time.time() - 3 * 24 * 3600
+
+    def attachment(self, data, age=timedelta(days=3)):
+        attachment = blobs.store([data], original_filename='a.bin', content_type='application/octet-stream',
+                                 uploaded_by=self.user)
+        FileAttachment.objects.filter(id=attachment.id).update(created_at=timezone.now() - age)
+        return attachment
+
+    def stray(self, name, mtime=None):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'stray')
+        os.utime(path, (mtime or self.old,) * 2)
+        return path
+
+    def test_orphaned_attachments_are_deleted_after_grace_period(self):
+        team = Team.objects.create(name='sweep-team')
+        channel = Channel.objects.create(name='general', team=team)
+        sent, orphan, fresh = self.attachment(b'sent'), self.attachment(b'orphan'), self.attachment(b'new', timedelta())
+        Message.objects.create(sender=self.user, channel=channel, content='hi').files.add(sent)
+        orphan_path = orphan.file.path
+        thumbs_dir = os.path.dirname(os.path.join(self.media_root, thumb_name(orphan.blob.sha256, 0)))
+        os.makedirs(thumbs_dir)
+
+        self.assertEqual(sweeper.sweep_attachments(timedelta(days=1), dry_run=True), 1)
+        self.assertTrue(FileAttachment.objects.filter(id=orphan.id).exists())
+
+        self.assertEqual(sweeper.sweep_attachments(timedelta(days=1), batch_size=1), 1)
+        self.assertEqual(set(FileAttachment.objects.values_list('id', flat=True)), {sent.id, fresh.id})
+        self.assertFalse(os.path.exists(orphan_path))
+        self.assertFalse(os.path.exists(thumbs_dir))
+        self.assertEqual(storage.usage(UserStorage, self.user.id), len(b'sent') + len(b'new'))
+
+    def test_unreferenced_files_are_deleted_after_grace_period(self):
+        kept = self.attachment(b'kept', timedelta())
+        os.utime(kept.file.path, (self.old, self.old))
+        digest = 'ab' * 32
+        strays = [
+            self.stray(blobs.blob_name(digest)),
+            self.stray(os.path.join(blobs.TEMP_DIR, 'crashed')),
+            self.stray(os.path.join(uploads.INCOMING_DIR, 'abandoned')),
+            self.stray('uploads/legacy.txt'),
+        ]
+        fresh = self.stray('uploads/fresh.txt', mtime=time.time())
+
+        out = io.StringIO()
+        call_command('sweep_orphans', '--batch-size', '2', '--rate', '0', stdout=out)
+        self.assertIn("Deleted 0 orphaned attachment(s).", out.getvalue())
+        self.assertIn("Deleted 1 unreferenced blobs (5 bytes).", out.getvalue())
+        self.assertIn("Deleted 1 unreferenced legacy uploads (5 bytes).", out.getvalue())
+        for path in strays:
+            self.assertFalse(os.path.exists(path), path)
+        self.assertTrue(os.path.exists(fresh))
+        self.assertTrue(os.path.exists(kept.file.path))
+
+    def test_rate_limiter_spaces_out_deletions(self):
+        now, slept = [0.0], []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+
+        limiter = sweeper.RateLimiter(10, clock=lambda: now[0], sleep=sleep)
+        limiter.wait(5)
+        limiter.wait()
+        now[0] += 0.3
+        limiter.wait()
+        self.assertEqual(slept, [0.5])  # the second wait, behind the batch of five
+        self.assertAlmostEqual(limiter.next_at, 0.9)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class AuthCacheTests(TransactionTestCase):
+    def setUp(self):
+        auth.clear()
+        self.user = User.objects.create(username='cached')
+        self.token = AccessToken.for_user(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+
+    def user_queries(self, path='/api/chat/teams/'):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        return response, [q['sql'] for q in queries if 'FROM "auth_user"' in q['sql']]
+
+    def test_rest_requests_reuse_the_cached_user(self):
+        response, first = self.user_queries()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(first), 1)
+        response, second = self.user_queries()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(second, [])
+
+    def test_saving_a_user_invalidates_it(self):
+        self.user_queries()
+        self.user.is_active = False
+        self.user.save()
+        response, queries = self.user_queries()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(len(queries), 1)
+
+        auth.get_user(self.user.id)
+        user_id = self.user.id
+        self.user.delete()
+        self.assertIsNone(auth.get_user(user_id))
+
+    def test_tampered_token_is_not_served_from_cache(self):
+        auth.validate_token(str(self.token))
+        header, payload, signature = str(self.token).split('.')
+        forged = f"{header}.{payload}.{signature[:-4]}AAAA"
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {forged}")
+        self.assertEqual(self.client.get('/api/chat/teams/').status_code, 401)
+
+    def test_cached_token_expires_with_the_token(self):
+        token = AccessToken.for_user(self.user)
+        token.set_exp(lifetime=timedelta(seconds=30))
+        auth.validate_token(str(token))
+        users, tokens = auth.caches()
+        expires_at, _ = tokens.entries[str(token)]
+        self.assertLessEqual(expires_at - tokens.clock(), 30)
+
+    async def test_reconnects_skip_the_user_query(self):
+        async def handshake(token):
+            communicator = WebsocketCommunicator(build_application(), f"/ws/chat/?token={token}")
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+
+        self.assertTrue(await handshake(self.token))
+        context = CaptureQueriesContext(connection)
+        await database_sync_to_async(context.__enter__)()
+        try:
+            user = await auth.authenticate_token(str(self.token))
+        finally:
+            await database_sync_to_async(context.__exit__)(None, None, None)
+        self.assertEqual((user.id, len(context.captured_queries)), (self.user.id, 0))
+        self.assertFalse(await handshake('not-a-token'))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CHAT_AUTH={'STATELESS': True})
+class StatelessAuthTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='claims', email='claims@example.com', password='pw')
+
+    def test_login_tokens_carry_the_username(self):
+        response = APIClient().post('/api/auth/login', {'username': 'claims', 'password': 'pw'}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(AccessToken(response.json()['access'])['username'], 'claims')
+
+    def test_requests_need_no_user_query(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {auth.token_for(self.user).access_token}")
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/chat/teams/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([q['sql'] for q in queries if 'FROM "auth_user"' in q['sql']], [])
+
+    def test_claims_user_loads_the_row_on_first_use(self):
+        user = auth.user_for_token(auth.token_for(self.user).access_token)
+        with self.assertNumQueries(0):
+            self.assertEqual((user.id, user.username, str(user)), (self.user.id, 'claims', 'claims'))
+            self.assertTrue(user.is_authenticated)
+            self.assertEqual(user, self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual((user.email, user.is_active, user.date_joined), (self.user.email, True,
+                                                                             self.user.date_joined))
+        team = Team.objects.create(name='claims-team')
+        channel = Channel.objects.create(name='general', team=team)
+        self.assertEqual(Message.objects.create(sender=user, channel=channel, content='hi').sender_id, user.id)
+
+    def test_tokens_without_claims_load_the_user(self):
+        user = auth.user_for_token(AccessToken.for_user(self.user))
+        self.assertEqual(type(user), User)
+        with override_settings(CHAT_AUTH={'STATELESS': False}):
+            user = auth.user_for_token(auth.token_for(self.user).access_token)
+        self.assertEqual(type(user), User)
+
+    async def test_websocket_handshake(self):
+        token = await database_sync_to_async(auth.token_for)(self.user)
+        communicator = WebsocketCommunicator(build_application(), f"/ws/chat/?token={token.access_token}")
+        connected, _ = await communicator.connect()
+        await communicator.disconnect()
+        self.assertTrue(connected)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CHAT_REVOCATION={'SYNC_INTERVAL': 60})
+class RevocationTests(TransactionTestCase):
+    def setUp(self):
+        auth.clear()
+        self.user = User.objects.create_user(username='leaver', password='pw')
+        self.refresh = auth.token_for(self.user)
+        self.access = str(self.refresh.access_token)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.access}")
+
+    async def handshake(self):
+        communicator = WebsocketCommunicator(build_application(), f"/ws/chat/?token={self.access}")
+        connected, _ = await communicator.connect()
+        await communicator.disconnect()
+        return connected
+
+    def test_logout_revokes_the_session_everywhere(self):
+        self.assertEqual(self.client.get('/api/chat/teams/').status_code, 200)
+        response = self.client.post('/api/auth/logout', {'refresh': str(self.refresh)}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+
+        response = self.client.get('/api/chat/teams/')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['code'], 'token_revoked')
+        self.assertFalse(async_to_sync(self.handshake)())
+
+        other_session = auth.token_for(self.user).access_token
+        with self.assertNumQueries(0):
+            self.assertFalse(revocation.is_revoked(other_session))
+
+    def test_other_workers_catch_up_on_sync(self):
+        now = [0.0]
+        worker = revocation.RevocationList(clock=lambda: now[0])
+        sid = self.refresh['jti']
+        self.assertFalse(worker.is_revoked(sid))
+        revocation.revoke(self.refresh)
+        with self.assertNumQueries(0):
+            self.assertFalse(worker.is_revoked(sid))
+        now[0] = 60
+        self.assertTrue(worker.is_revoked(sid))
+
+    def test_rows_committed_out_of_id_order_are_not_missed(self):
+        now = [0.0]
+        worker = revocation.RevocationList(clock=lambda: now[0])
+        late = auth.token_for(self.user)
+        BlacklistedToken.objects.create(id=1000, token=OutstandingToken.objects.get(jti=self.refresh['jti']))
+        self.assertTrue(worker.is_revoked(self.refresh['jti']))
+        # A logout whose transaction took the lower id but committed after that sync
+        BlacklistedToken.objects.create(id=5, token=OutstandingToken.objects.get(jti=late['jti']))
+        now[0] = 60
+        self.assertTrue(worker.is_revoked(late['jti']))
+        self.assertEqual(worker.added, 2)
+
+    def test_bloom_mode_confirms_hits(self):
+        worker = revocation.RevocationList({'MODE': 'bloom', 'BLOOM_CAPACITY': 10, 'BLOOM_ERROR_RATE': 0.01})
+        revocation.revoke(self.refresh)
+        self.assertTrue(worker.is_revoked(self.refresh['jti']))
+        with self.assertNumQueries(0):
+            self.assertFalse(worker.is_revoked('never-revoked'))
+        worker.bloom.add('false-positive')
+        with self.assertNumQueries(1):
+            self.assertFalse(worker.is_revoked('false-positive'))
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = revocation.BloomFilter(1000, 0.01)
+        keys = [f"jti-{i}" for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_purge_expired_tokens(self):
+        revocation.revoke(self.refresh)
+        expired = auth.token_for(self.user)
+        expired.blacklist()
+        OutstandingToken.objects.filter(jti=expired['jti']).update(expires_at=timezone.now() - timedelta(minutes=1))
+        out = io.StringIO()
+        call_command('purge_expired_tokens', '--batch-size', '1', stdout=out)
+        self.assertIn("Deleted 1 expired token(s).", out.getvalue())
+        self.assertEqual(list(BlacklistedToken.objects.values_list('token__jti', flat=True)), [self.refresh['jti']])
+
+
+class CountingLayer(InMemoryChannelLayer):
+    """The shared layer stand-in, counting publishes."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.published = 0
+        self.fail = False
+
+    async def group_send(self, group, message):
+        if self.fail:
+            raise ConnectionError('shared layer down')
+        self.published += 1
+        await super().group_send(group, message)
+
+
+class HybridLayerTests(TransactionTestCase):
+    """Two HybridChannelLayers over one shared layer act as two worker processes."""
+
+    def setUp(self):
+        self.shared = CountingLayer(capacity=1000)
+        self.first = HybridChannelLayer(inner=self.shared)
+        self.second = HybridChannelLayer(inner=self.shared)
+
+    async def receive_all(self, layer, channel, count):
+        return [await asyncio.wait_for(layer.receive(channel), 2) for _ in range(count)]
+
+    async def test_group_messages_reach_local_and_remote_members_in_order(self):
+        here = [await self.first.new_channel() for _ in range(3)]
+        there = await self.second.new_channel()
+        for channel in here:
+            await self.first.group_add('channel_1', channel)
+        await self.second.group_add('channel_1', there)
+        # One shared-layer entry per process, not per socket
+        self.assertEqual(len(self.shared.groups['channel_1']), 2)
+
+        for i in range(20):
+            await self.first.group_send('channel_1', {'type': 'chat.message', 'n': i})
+        self.assertEqual(self.shared.published, 20)
+        for channel in here:
+            self.assertEqual([m['n'] for m in await self.receive_all(self.first, channel, 20)], list(range(20)))
+        self.assertEqual([m['n'] for m in await self.receive_all(self.second, there, 20)], list(range(20)))
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.first.receive(here[0]), 0.1)
+
+    async def test_direct_sends_cross_processes(self):
+        here, there = await self.first.new_channel(), await self.second.new_channel()
+        await self.second.send(here, {'type': 'ping', 'from': 'second'})
+        await self.first.send(here, {'type': 'ping', 'from': 'first'})
+        received = await self.receive_all(self.first, here, 2)
+        self.assertEqual(sorted(m['from'] for m in received), ['first', 'second'])
+        await self.first.send(there, {'type': 'pong'})
+        self.assertEqual((await self.receive_all(self.second, there, 1))[0]['type'], 'pong')
+
+    async def test_channels_added_from_another_loop_get_plain_messages(self):
+        here = await self.first.new_channel()
+        # As async_to_sync(layer.group_add) from a sync view does: not local to that loop
+        await self.second.group_add('team_9', here)
+        for layer in (self.second, self.first):
+            await layer.group_send('team_9', {'type': 'team.notice', 'from': 'sender'})
+            message = await asyncio.wait_for(self.first.receive(here), 2)
+            self.assertEqual(message, {'type': 'team.notice', 'from': 'sender'})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.first.receive(here), 0.1)
+
+    async def test_local_delivery_survives_a_shared_layer_failure(self):
+        channel = await self.first.new_channel()
+        await self.first.group_add('team_1', channel)
+        self.shared.fail = True
+        with self.assertLogs('chat.layers', 'ERROR'):
+            await self.first.group_send('team_1', {'type': 'notice'})
+        self.assertEqual((await self.receive_all(self.first, channel, 1))[0]['type'], 'notice')
+
+    async def test_groups_are_refreshed_while_the_inbox_is_busy(self):
+        clock = [1000.0]
+        with mock.patch('chat.layers.time') as fake_time:
+            fake_time.time.side_effect = lambda: clock[0]
+            first = HybridChannelLayer(inner=self.shared, group_expiry=100)
+            channel = await first.new_channel()
+            await first.group_add('channel_1', channel)
+            # Never idle for group_expiry / 4, while the clock passes group_expiry / 2
+            for i in range(10):
+                clock[0] += 10
+                await self.second.group_send('channel_1', {'type': 'chat.message', 'n': i})
+                self.assertEqual((await asyncio.wait_for(first.receive(channel), 2))['n'], i)
+            await asyncio.sleep(0.01)
+        registered = first._states[asyncio.get_running_loop()].registered['channel_1']
+        self.assertGreater(registered, 1050)
+
+    async def test_a_finished_consumer_leaves_its_groups(self):
+        channel = await self.first.new_channel()
+        await self.first.group_add('user_1', channel)
+        pending = asyncio.ensure_future(self.first.receive(channel))
+        await asyncio.sleep(0)
+        pending.cancel()
+        await asyncio.sleep(0.01)
+        self.assertNotIn('user_1', self.shared.groups)
+
+    @override_settings(CHANNEL_LAYERS=HYBRID_LAYER)
+    async def test_chat_messages_through_the_consumer(self):
+        team, channel, users = await database_sync_to_async(self.make_channel)()
+        communicators = []
+        for user in users:
+            communicator = WebsocketCommunicator(build_application(), f"/ws/chat/?token={AccessToken.for_user(user)}")
+            self.assertTrue((await communicator.connect())[0])
+            communicators.append(communicator)
+        await communicators[0].send_json_to({'message_type': 'channel_message', 'channel': channel.id,
+                                             'content': 'hybrid hello'})
+        for communicator in communicators:
+            while True:
+                payload = await communicator.receive_json_from(timeout=5)
+                if payload.get('type') == 'channels':
+                    break
+            self.assertEqual(payload['content'], 'hybrid hello')
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    def make_channel(self):
+        team = Team.objects.create(name='hybrid-team')
+        users = [User.objects.create(username=f"hybrid-{i}") for i in range(2)]
+        team.members.add(*users)
+        UserPresence.objects.bulk_create([UserPresence(user=user, team=team) for user in users])
+        channel = Channel.objects.create(name='hybrid', team=team)
+        channel.members.add(*users)
+        return team, channel, users
+
+
+class ChatClientMixin:
+    """Connected test clients that skip frames other than the ones a test waits for."""
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(build_application(), f"/ws/chat/?token={AccessToken.for_user(user)}")
+        self.assertTrue((await communicator.connect())[0])
+        # Our own presence broadcast comes once the consumer has joined its groups
+        while True:
+            payload = await communicator.receive_json_from(timeout=2)
+            if payload.get('type') == 'user_presence' and payload.get('user_id') == user.id:
+                return communicator
+
+    async def next_frame(self, communicator, kind):
+        while True:
+            payload = await communicator.receive_json_from(timeout=2)
+            if payload.get('type') == kind:
+                return payload
+
+    async def next_message(self, communicator):
+        return (await self.next_frame(communicator, 'channels'))['content']
+
+    async def assertNoMessage(self, communicator, kind='channels'):
+        while not await communicator.receive_nothing(timeout=0.2):
+            self.assertNotEqual((await communicator.receive_json_from()).get('type'), kind)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CHAT_FANOUT={'MODE': 'user', 'BATCH_SIZE': 2})
+class UserRoutingTests(ChatClientMixin, TransactionTestCase):
+    def setUp(self):
+        self.team = Team.objects.create(name='routed')
+        self.users = [User.objects.create(username=f"routed-{i}") for i in range(3)]
+        self.team.members.add(*self.users)
+        UserPresence.objects.bulk_create([UserPresence(user=user, team=self.team) for user in self.users])
+        self.channels = [Channel.objects.create(name=f"routed-{i}", team=self.team) for i in range(5)]
+        for channel in self.channels:
+            channel.members.add(*self.users[:2])
+
+    async def test_sockets_join_only_their_user_group(self):
+        await get_channel_layer().flush()
+        communicators = [await self.connect(user) for user in self.users]
+        groups = get_channel_layer().groups
+        self.assertEqual({group for group in groups if not group.startswith('user_')}, set())
+        self.assertEqual(len(groups), 3)
+        channel = self.channels[0]
+        await communicators[0].send_json_to({'message_type': 'channel_message', 'channel': channel.id,
+                                             'content': 'routed hello'})
+        for communicator in communicators[:2]:
+            self.assertEqual(await self.next_message(communicator), 'routed hello')
+        await self.assertNoMessage(communicators[2])
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def test_membership_changes_apply_without_reconnecting(self):
+        channel = self.channels[0]
+        sender, removed = [await self.connect(user) for user in self.users[:2]]
+        joined = await self.connect(self.users[2])
+        await database_sync_to_async(channel.members.remove)(self.users[1])
+        await database_sync_to_async(self.users[2].channels.add)(channel)
+        await sender.send_json_to({'message_type': 'channel_message', 'channel': channel.id, 'content': 'after'})
+        self.assertEqual(await self.next_message(sender), 'after')
+        self.assertEqual(await self.next_message(joined), 'after')
+        await self.assertNoMessage(removed)
+        for communicator in (sender, removed, joined):
+            await communicator.disconnect()
+
+    async def test_removed_users_get_nothing_from_a_stale_index(self):
+        channel = self.channels[0]
+        sender, removed = [await self.connect(user) for user in self.users[:2]]
+        await fanout.index().achannel_members(channel.id)
+
+        # Removed by another worker: this process's index keeps listing the user
+        await database_sync_to_async(Channel.members.through.objects.filter(
+            channel=channel, user=self.users[1]).delete)()
+        with mock.patch.object(fanout, 'forget_members'):
+            await get_channel_layer().group_send(fanout.user_group(self.users[1].id), membership._message(
+                {'channels_removed': [channel.id]}))
+            await self.next_frame(removed, 'membership_changed')
+            self.assertIn(self.users[1].id, await fanout.index().achannel_members(channel.id))
+            await sender.send_json_to({'message_type': 'channel_message', 'channel': channel.id,
+                                       'content': 'stale'})
+            self.assertEqual(await self.next_message(sender), 'stale')
+            await self.assertNoMessage(removed)
+        for communicator in (sender, removed):
+            await communicator.disconnect()
+
+    async def test_membership_events_drop_the_index_in_other_processes(self):
+        channel = self.channels[0]
+        communicator = await self.connect(self.users[2])
+        index = fanout.index()
+        await index.achannel_members(channel.id)
+        await index.ateam_members(self.team.id)
+        # As if changed by another worker: no signal reaches this process's index
+        await get_channel_layer().group_send(fanout.user_group(self.users[2].id), membership._message(
+            {'channels_added': [channel.id]}))
+        self.assertEqual((await self.next_frame(communicator, 'membership_changed'))['channels_added'],
+                         [channel.id])
+        self.assertNotIn(channel.id, index.channels)
+        self.assertIn(self.team.id, index.teams)
+        await communicator.disconnect()
+
+    def test_index_is_cached_and_dropped_on_membership_changes(self):
+        index = fanout.index()
+        channel = self.channels[1]
+        self.assertEqual(index.channel_members(channel.id), {user.id for user in self.users[:2]})
+        with self.assertNumQueries(0):
+            index.channel_members(channel.id)
+            index.channel_members(str(channel.id))
+        # Channel recipients must also belong to the channel's team
+        self.team.members.remove(self.users[0])
+        self.assertEqual(index.channel_members(channel.id), {self.users[1].id})
+        self.assertEqual(index.team_members(self.team.id), {user.id for user in self.users[1:]})
+        channel.members.clear()
+        self.assertEqual(index.channel_members(channel.id), set())
+
+    @override_settings(CHAT_FANOUT={'MODE': 'channel'})
+    async def test_channel_mode_joins_team_and_channel_groups(self):
+        await get_channel_layer().flush()
+        communicator = await self.connect(self.users[0])
+        groups = get_channel_layer().groups
+        self.assertEqual(len(groups), 1 + 1 + len(self.channels))
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CHAT_SUBSCRIPTIONS={'SUMMARY_INTERVAL': 0.1})
+class SubscriptionTests(ChatClientMixin, TransactionTestCase):
+    def setUp(self):
+        self.team = Team.objects.create(name='lazy')
+        self.users = [User.objects.create(username=f"lazy-{i}") for i in range(2)]
+        self.team.members.add(*self.users)
+        UserPresence.objects.bulk_create([UserPresence(user=user, team=self.team) for user in self.users])
+        self.viewed, self.idle = [Channel.objects.create(name=f"lazy-{i}", team=self.team) for i in range(2)]
+        self.viewed.members.add(*self.users)
+        self.idle.members.add(*self.users)
+        self.private = Channel.objects.create(name='lazy-private', team=self.team)
+        self.private.members.add(self.users[0])
+
+    async def post(self, communicator, channel, content):
+        await communicator.send_json_to({'message_type': 'channel_message', 'channel': channel.id,
+                                         'content': content})
+
+    async def test_only_subscribed_channels_get_full_events(self):
+        sender, viewer = await self.connect(self.users[0]), await self.connect(self.users[1])
+        await viewer.send_json_to({'message_type': 'subscribe',
+                                   'channel_ids': [self.viewed.id, self.private.id, 'nope']})
+        # Channels the user is not a member of are left out
+        self.assertEqual((await self.next_frame(viewer, 'subscriptions'))['channel_ids'], [self.viewed.id])
+
+        for content in ('idle 1', 'idle 2'):
+            await self.post(sender, self.idle, content)
+        await self.post(sender, self.viewed, 'viewed 1')
+        self.assertEqual(await self.next_message(viewer), 'viewed 1')
+        activity = await self.next_frame(viewer, 'channel_activity')
+        self.assertEqual(len(activity['channels']), 1)
+        summary = activity['channels'][0]
+        self.assertEqual((summary['channel_id'], summary['unread'], summary['last_sender']),
+                         (self.idle.id, 2, 'lazy-0'))
+        await self.assertNoMessage(viewer, 'channel_activity')
+
+        await viewer.send_json_to({'message_type': 'unsubscribe', 'channel_id': self.viewed.id})
+        self.assertEqual((await self.next_frame(viewer, 'subscriptions'))['channel_ids'], [])
+        await self.post(sender, self.viewed, 'viewed 2')
+        self.assertEqual((await self.next_frame(viewer, 'channel_activity'))['channels'][0]['channel_id'],
+                         self.viewed.id)
+        # The sender never subscribed and still gets everything
+        self.assertEqual([await self.next_message(sender) for _ in range(4)],
+                         ['idle 1', 'idle 2', 'viewed 1', 'viewed 2'])
+        for communicator in (sender, viewer):
+            await communicator.disconnect()
+
+    def test_subscribing_drops_pending_activity(self):
+        subs = subscriptions.Subscriptions()
+        self.assertTrue(subs.wants(1))
+        subs.unsubscribe([])
+        self.assertFalse(subs.wants(1))
+        subs.record({'channel_id': '1', 'id': 10, 'sender': 'a'})
+        subs.record({'channel_id': 2, 'id': 11, 'sender': 'me'}, own=True)
+        subs.subscribe([1])
+        self.assertTrue(subs.wants('1'))
+        self.assertEqual([(entry['channel_id'], entry['unread']) for entry in subs.drain()], [(2, 0)])
+        self.assertEqual(subs.drain(), [])
+        self.assertEqual(subscriptions.channel_ids({'channel_ids': [1, '2', None, 'x']}), [1, 2])
+        self.assertEqual(subscriptions.channel_ids({'channel_ids': 'bad'}), [])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class MembershipEventTests(ChatClientMixin, TransactionTestCase):
+    """Connected sockets follow membership changes without reconnecting."""
+
+    def setUp(self):
+        self.team = Team.objects.create(name='live')
+        self.users = [User.objects.create(username=f"live-{i}") for i in range(2)]
+        self.team.members.add(*self.users)
+        UserPresence.objects.bulk_create([UserPresence(user=user, team=self.team) for user in self.users])
+        self.channel = Channel.objects.create(name='live', team=self.team)
+        self.channel.members.add(*self.users)
+
+    async def post(self, communicator, channel_id, content):
+        await communicator.send_json_to({'message_type': 'channel_message', 'channel': channel_id,
+                                         'content': content})
+
+    async def test_created_channels_reach_connected_members(self):
+        owner, member = await self.connect(self.users[0]), await self.connect(self.users[1])
+        await owner.send_json_to({'message_type': 'create_channel', 'team_id': self.team.id, 'name': 'fresh'})
+        changed = await self.next_frame(member, 'membership_changed')
+        self.assertEqual(len(changed['channels_added']), 1)
+        await self.post(owner, changed['channels_added'][0], 'in fresh')
+        self.assertEqual(await self.next_message(member), 'in fresh')
+
+        await database_sync_to_async(self.channel.members.remove)(self.users[1])
+        self.assertEqual((await self.next_frame(member, 'membership_changed'))['channels_removed'],
+                         [self.channel.id])
+        await self.post(owner, self.channel.id, 'members only')
+        self.assertEqual(await self.next_message(owner), 'in fresh')
+        self.assertEqual(await self.next_message(owner), 'members only')
+        await self.assertNoMessage(member)
+        for communicator in (owner, member):
+            await communicator.disconnect()
+
+    async def test_joining_by_invitation_needs_no_reconnect(self):
+        other_team = await database_sync_to_async(Team.objects.create)(name='elsewhere')
+        newcomer = await database_sync_to_async(User.objects.create)(username='live-newcomer')
+        await database_sync_to_async(other_team.members.add)(newcomer)
+        owner, joining = await self.connect(self.users[0]), await self.connect(newcomer)
+
+        def join():
+            invitation = TeamInvitation.objects.create(team=self.team, created_by=self.users[0], invite_code='live-code',
+                                                       expires_at=timezone.now() + timedelta(days=1))
+            client = APIClient()
+            client.force_authenticate(newcomer)
+            return client.post('/api/chat/teams/join_via_invitation/', {'invite_code': invitation.invite_code})
+
+        self.assertEqual((await database_sync_to_async(join)()).status_code, 200)
+        changed = await self.next_frame(joining, 'membership_changed')
+        self.assertEqual((changed['teams_added'], changed['channels_added']), ([self.team.id], [self.channel.id]))
+        await self.post(owner, self.channel.id, 'welcome')
+        self.assertEqual(await self.next_message(joining), 'welcome')
+        # Presence now reaches the team joined after connecting
+        presence = await self.next_frame(owner, 'user_presence')
+        self.assertEqual((presence['user_id'], presence['status']), (newcomer.id, 'online'))
+        await joining.disconnect()
+        presence = await self.next_frame(owner, 'user_presence')
+        self.assertEqual((presence['user_id'], presence['status']), (newcomer.id, 'offline'))
+        await owner.disconnect()
+
+    def test_one_message_per_user_and_none_on_rollback(self):
+        newcomers = User.objects.bulk_create([User(username=f"live-bulk-{i}") for i in range(5)])
+        with mock.patch.object(membership, '_send') as send:
+            self.channel.members.add(*newcomers)
+            send.assert_called_once()
+            user_ids, changes = send.call_args.args
+            self.assertEqual((sorted(user_ids), changes),
+                             (sorted(user.id for user in newcomers), {'channels_added': [self.channel.id]}))
+            send.reset_mock()
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.channel.members.clear()
+                raise RuntimeError('rolled back')
+            send.assert_not_called()
+            self.users[0].teams.clear()
+            send.assert_called_once_with([self.users[0].id], {'teams_removed': {self.team.id}})
+
+
+class BulkMembershipTests(TransactionTestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='bulk-owner')
+        self.team = Team.objects.create(name='bulk')
+        self.team.members.add(self.owner)
+        self.channels = [Channel.objects.create(name=f"bulk-{i}", team=self.team) for i in range(3)]
+        self.dm = Channel.objects.create(name='bulk-dm', team=self.team, is_direct_message=True)
+        for channel in self.channels + [self.dm]:
+            channel.members.add(self.owner)
+        self.users = User.objects.bulk_create([User(username=f"bulk-{i}") for i in range(250)])
+        self.user_ids = [user.id for user in self.users]
+
+    def member_ids(self, channel):
+        return set(channel.members.values_list('id', flat=True))
+
+    def test_team_members_are_added_and_removed_in_batches(self):
+        with mock.patch.object(membership, '_send') as send, CaptureQueriesContext(connection) as captured:
+            added = membership.add_team_members(self.team, self.user_ids + [0], batch_size=100)
+        self.assertEqual(added, sorted(self.user_ids))
+        # 3 user lookups, 1 channel list, 3 team inserts, 8 channel inserts (33 users x 3 channels each)
+        inserts = [q for q in captured.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 3 + 8)
+        self.assertLessEqual(len(captured.captured_queries), 20)
+        send.assert_called_once()
+        self.assertEqual(send.call_args.args[1], {'teams_added': [self.team.id],
+                                                  'channels_added': [c.id for c in self.channels]})
+        self.assertEqual(self.team.members.count(), 251)
+        for channel in self.channels:
+            self.assertEqual(len(self.member_ids(channel)), 251)
+        self.assertEqual(self.member_ids(self.dm), {self.owner.id})
+
+        # Already members: nothing to insert, no error
+        self.assertEqual(membership.add_team_members(self.team, self.user_ids[:10]), sorted(self.user_ids[:10]))
+        self.assertEqual(membership.remove_team_members(self.team, self.user_ids, batch_size=100), 250)
+        self.assertEqual(list(self.team.members.all()), [self.owner])
+        self.assertEqual(self.member_ids(self.channels[0]), {self.owner.id})
+
+    def test_fill_from_team_is_one_statement(self):
+        self.team.members.add(*self.users)
+        channel = Channel.objects.create(name='bulk-new', team=self.team)
+        channel.members.add(self.users[0])
+        with mock.patch.object(membership, '_send_team') as send, CaptureQueriesContext(connection) as captured:
+            self.assertEqual(membership.fill_from_team(channel), 250)
+        statements = [q['sql'].split()[0] for q in captured.captured_queries]
+        self.assertEqual([sql for sql in statements if sql not in ('BEGIN', 'COMMIT')], ['INSERT'])
+        send.assert_called_once_with(self.team.id, {'channels_added': [channel.id]})
+        self.assertEqual(self.member_ids(channel), {self.owner.id, *self.user_ids})
+        self.assertEqual(membership.fill_from_team(channel), 0)
+
+    def test_channel_members_must_belong_to_the_team(self):
+        self.team.members.add(*self.users[:5])
+        channel = self.channels[0]
+        self.assertEqual(membership.add_channel_members(channel, self.user_ids[:10]), sorted(self.user_ids[:5]))
+        self.assertEqual(self.member_ids(channel), {self.owner.id, *self.user_ids[:5]})
+        self.assertEqual(membership.remove_channel_members(channel, self.user_ids), 5)
+
+    def test_bulk_endpoints(self):
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        response = client.post(f"/api/chat/teams/{self.team.id}/add_members/", {'user_ids': self.user_ids[:20]},
+                               format='json')
+        self.assertEqual(response.json(), {'team_id': self.team.id, 'user_ids': sorted(self.user_ids[:20])})
+        channel = self.channels[1]
+        response = client.post(f"/api/chat/channels/{channel.id}/remove_members/", {'user_ids': self.user_ids[:5]},
+                               format='json')
+        self.assertEqual(response.json(), {'channel_id': channel.id, 'removed': 5})
+        response = client.post(f"/api/chat/channels/{channel.id}/add_members/", {'user_ids': self.user_ids[:2]},
+                               format='json')
+        self.assertEqual(response.json()['user_ids'], sorted(self.user_ids[:2]))
+        response = client.post(f"/api/chat/teams/{self.team.id}/remove_members/", {'user_ids': self.user_ids[:20]},
+                               format='json')
+        self.assertEqual(response.json()['removed'], 20)
+
+        for url, data in ((f"/api/chat/teams/{self.team.id}/add_members/", {'user_ids': 'all'}),
+                          (f"/api/chat/channels/{channel.id}/add_members/", {'user_ids': ['1']}),
+                          (f"/api/chat/channels/{self.dm.id}/add_members/", {'user_ids': [1]})):
+            self.assertEqual(client.post(url, data, format='json').status_code, 400)
+        outsider = APIClient()
+        outsider.force_authenticate(self.users[-1])
+        response = outsider.post(f"/api/chat/teams/{self.team.id}/add_members/", {'user_ids': [self.users[-1].id]},
+                                 format='json')
+        self.assertEqual(response.status_code, 404)
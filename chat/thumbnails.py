@@ -0,0 +1,96 @@
+"""
+Thumbnails and image metadata for attachments.
+
+When an image is uploaded, ``schedule()`` hands its blob to a
+``ProcessPoolExecutor`` of ``WORKERS`` spawned processes. Decoding and
+resizing are CPU-bound and hold the GIL, so they must stay off the
+ASGI/WSGI workers. The worker (``chat.imaging.render``) writes WebP
+thumbnails that fit each of ``SIZES`` next to the blob layout, at
+``thumbs/ab/cd/<sha256>/<size>.webp``. It returns the image's dimensions
+and a BlurHash placeholder, which are stored on the ``StoredBlob``.
+Thumbnails are per blob, so a re-uploaded image is never processed twice.
+
+Until processing finishes, attachment dicts (``StoredBlob.image_dict``)
+carry no image fields. Images that cannot be decoded are marked done with
+no thumbnails.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+
+from . import imaging
+from .models import StoredBlob, thumb_name
+
+logger = logging.getLogger('chat.thumbnails')
+
+DEFAULTS = {
+    'SIZES': (160, 480, 1280),
+    'QUALITY': 80,
+    'WORKERS': 2,
+    'TYPES': ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'),
+}
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_THUMBNAILS', {})}
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, not fork: the server process has threads and open DB connections
+            _executor = ProcessPoolExecutor(max_workers=config()['WORKERS'],
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+def schedule(attachment):
+    """Queue thumbnails for a new image attachment; returns the future, or None if there is nothing to do."""
+    options = config()
+    blob = attachment.blob
+    if (not imaging.AVAILABLE or blob is None or blob.thumbnails is not None
+            or attachment.content_type not in options['TYPES']):
+        return None
+    future = executor().submit(
+        imaging.render,
+        default_storage.path(attachment.file.name),
+        os.path.dirname(default_storage.path(thumb_name(blob.sha256, 0))),
+        options['SIZES'],
+        options['QUALITY'],
+    )
+    future.add_done_callback(lambda done: _save(blob.pk, done))
+    return future
+
+
+def _save(blob_id, future):
+    # Runs on the executor's management thread, which has its own DB connection
+    try:
+        try:
+            fields = future.result()
+        except Exception as e:
+            logger.info("No thumbnails for blob %s: %s", blob_id, e)
+            fields = {'thumbnails': []}
+        StoredBlob.objects.filter(pk=blob_id).update(**fields)
+    except Exception:
+        logger.exception("Saving thumbnails for blob %s failed", blob_id)
+    finally:
+        close_old_connections()
@@ -0,0 +1,96 @@
+"""
+Server-side link unfurling for chat messages.
+
+Consumers save and broadcast a message first, then call ``schedule()`` for
+its first URL. The preview is fetched through ``chat.previews`` by a bounded
+pool of background tasks (``UNFURL_CONCURRENCY`` at a time, at most
+``UNFURL_QUEUE`` waiting), attached to the message, and announced to the
+channel with a small ``link_preview_ready`` event. A slow site therefore
+never delays message delivery. When the pool is full the link is simply
+not unfurled.
+"""
+import asyncio
+import logging
+import re
+import weakref
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from . import fanout, previews
+from .models import Message
+
+logger = logging.getLogger('chat.previews')
+
+URL_RE = re.compile(r"https?://[^\s<>\"'`]+", re.IGNORECASE)
+TRAILING_PUNCTUATION = '.,;:!?)]}\'"'
+
+
+def first_url(text):
+    """The first http(s) URL in ``text``, without trailing punctuation."""
+    match = URL_RE.search(text or '')
+    return match.group(0).rstrip(TRAILING_PUNCTUATION) if match else None
+
+
+def stored_preview_for(text):
+    """Fresh stored ``LinkPreview`` for the first URL in ``text``, if any (sync; never fetches).
+
+    Without one the message is saved with no preview and ``schedule`` unfurls it.
+    """
+    url = first_url(text)
+    return previews.fresh_preview(url) if url else None
+
+
+class _Pool:
+    def __init__(self, concurrency):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def schedule(message_id, channel_id, url):
+    """Unfurl ``url`` for a message in the background; returns the task, or None if the pool is full."""
+    options = previews.config()
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = _Pool(options['UNFURL_CONCURRENCY'])
+    if len(pool.tasks) >= options['UNFURL_QUEUE']:
+        logger.warning("Unfurl queue full, not unfurling %s for message %s", url, message_id)
+        return None
+    task = loop.create_task(_unfurl(pool, message_id, channel_id, url))
+    pool.tasks.add(task)
+    task.add_done_callback(pool.tasks.discard)
+    return task
+
+
+def _attach(message_id, preview):
+    # Only fill in a missing preview; the message may have been deleted meanwhile.
+    return Message.objects.filter(id=message_id, preview__isnull=True).update(preview=preview)
+
+
+async def _unfurl(pool, message_id, channel_id, url):
+    async with pool.slots:
+        try:
+            preview = await previews.service.fetch_row(url)
+        except Exception as e:
+            logger.info("Unfurling %s failed: %s", url, e)
+            return
+    if not preview.ok or not (preview.title or preview.description or preview.image):
+        return
+    if not await database_sync_to_async(_attach)(message_id, preview):
+        return
+    await fanout.send_to_channel(
+        get_channel_layer(), channel_id,
+        {
+            "type": "link_preview_ready",
+            "data": {
+                "type": "link_preview_ready",
+                "message_id": message_id,
+                "channel_id": channel_id,
+                "link_preview": preview.to_dict(),
+            }
+        }
+    )
@@ -0,0 +1,243 @@
+"""
+Chunked, resumable uploads.
+
+A client opens an ``UploadSession`` with the file's name, type, size and,
+optionally, its SHA-256. It then PUTs the bytes in order. Each chunk goes at
+the offset the session reports and carries its own SHA-256. A chunk is
+streamed in ``BLOCK_SIZE`` pieces straight into the session's staging file
+under ``blobs/incoming/``, so memory use does not depend on the file size.
+The session row stays locked while a chunk is written, so one request per
+session writes at a time. A chunk that is short or fails its checksum is
+cut off again and does not advance the offset. After a dropped connection
+the client reads the session's offset and carries on from there.
+
+The process that writes the chunks keeps a running SHA-256 of the whole
+file, so finalizing does not hash it again. If chunks went through another
+worker, it re-reads the file once instead. It checks the whole-file
+checksum, then renames the file into the content-addressed layout of
+``chat.blobs``, with no copy, and turns the session into a
+``FileAttachment``. The ``purge_upload_sessions`` command removes sessions
+untouched for ``SESSION_TTL`` seconds, with their partial files.
+"""
+import hashlib
+import os
+import re
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import blobs, storage
+from .cache import TTLCache
+from .models import UploadSession
+
+DEFAULTS = {
+    'MAX_FILE_SIZE': 4 * 1024 * 1024 * 1024,
+    'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+    'BLOCK_SIZE': 64 * 1024,
+    'SESSION_TTL': 24 * 60 * 60,
+    # Sessions whose running whole-file digest is kept, so finalize need not re-read
+    'DIGEST_CACHE_SIZE': 10000,
+}
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+INCOMING_DIR = os.path.join(blobs.BLOB_DIR, 'incoming')
+
+
+def config():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_UPLOADS', {})}
+
+
+class UploadError(Exception):
+    """An upload request that cannot be applied; ``status`` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+    def to_dict(self):
+        data = {'error': str(self)}
+        if self.offset is not None:
+            data['offset'] = self.offset
+        return data
+
+
+def _checksum(value, required=False):
+    value = (value or '').strip().lower()
+    if not value and not required:
+        return ''
+    if not SHA256_RE.match(value):
+        raise UploadError('Checksum must be a hex SHA-256 digest')
+    return value
+
+
+def _remove(name):
+    try:
+        os.remove(default_storage.path(name))
+    except FileNotFoundError:
+        pass
+
+
+def open_session(user, filename, content_type, size, checksum=None, team_id=None):
+    """Start an upload and create its (empty) staging file; quotas are checked against ``size``."""
+    options = config()
+    if not filename or not isinstance(filename, str):
+        raise UploadError('Filename is required')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('Size is required')
+    if not 0 <= size <= options['MAX_FILE_SIZE']:
+        raise UploadError('File is too large', status=413)
+    checksum = _checksum(checksum)
+    try:
+        storage.check_quota(user.id, size, storage.member_team_id(user, team_id))
+    except ValueError as e:
+        raise UploadError(str(e))
+    except storage.QuotaExceeded as e:
+        raise UploadError(str(e), status=413)
+
+    name = os.path.join(INCOMING_DIR, uuid.uuid4().hex)
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'xb').close()
+    return UploadSession.objects.create(
+        uploaded_by=user,
+        file=name,
+        original_filename=filename[:255],
+        content_type=(content_type or 'application/octet-stream')[:100],
+        size=size,
+        checksum=checksum,
+    )
+
+
+_digests = None
+
+
+def digests():
+    """Whole-file SHA-256 so far of sessions whose chunks this process wrote, by session id."""
+    global _digests
+    if _digests is None:
+        options = config()
+        _digests = TTLCache(options['DIGEST_CACHE_SIZE'], options['SESSION_TTL'])
+    return _digests
+
+
+@receiver(setting_changed)
+def settings_changed(sender, setting, **kwargs):
+    global _digests
+    if setting == 'CHAT_UPLOADS':
+        _digests = None
+
+
+def write_chunk(session, offset, stream, length, checksum):
+    """Write ``length`` bytes from ``stream`` at ``offset``; returns the new offset."""
+    options = config()
+    checksum = _checksum(checksum, required=True)
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise UploadError('Offset is required', offset=session.received)
+    if offset != session.received:
+        raise UploadError('Chunk does not start at the upload offset', status=409, offset=session.received)
+    if length is None:
+        raise UploadError('Content-Length is required', status=411, offset=session.received)
+    if length > options['MAX_CHUNK_SIZE']:
+        raise UploadError('Chunk is too large', status=413, offset=session.received)
+    if offset + length > session.size:
+        raise UploadError('Chunk runs past the declared size', offset=session.received)
+
+    path = default_storage.path(session.file)
+    with transaction.atomic():
+        # Locks the row (on SQLite, the database) until the chunk is in, so
+        # one request per session writes at a time. The offset is re-read
+        # under the lock, and a failing chunk only cuts off its own bytes.
+        UploadSession.objects.filter(id=session.id).update(updated_at=timezone.now())
+        received = UploadSession.objects.select_for_update().values_list('received', flat=True).get(id=session.id)
+        if received != offset:
+            session.received = received
+            raise UploadError('Chunk does not start at the upload offset', status=409, offset=received)
+
+        entry = digests().get(session.id)
+        running = entry[1].copy() if entry and entry[0] == offset else None
+        if offset == 0:
+            running = hashlib.sha256()
+        digest = hashlib.sha256()
+        written = 0
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                block = stream.read(min(options['BLOCK_SIZE'], length - written)) if stream else b''
+                if not block:
+                    break
+                f.write(block)
+                digest.update(block)
+                if running is not None:
+                    running.update(block)
+                written += len(block)
+            if written != length or digest.hexdigest() != checksum:
+                f.truncate(offset)
+                message = 'Chunk checksum mismatch' if written == length else 'Chunk is incomplete'
+                raise UploadError(message, offset=offset)
+            # The stored offset promises these bytes survive a crash
+            f.flush()
+            os.fsync(f.fileno())
+
+        UploadSession.objects.filter(id=session.id).update(received=offset + length)
+        if running is not None:
+            transaction.on_commit(lambda: digests().set(session.id, (offset + length, running)))
+    session.received = offset + length
+    return session.received
+
+
+def finalize(session):
+    """Turn a fully received session into a ``FileAttachment``."""
+    if session.received != session.size:
+        raise UploadError('Upload is incomplete', status=409, offset=session.received)
+    entry = digests().pop(session.id)
+    if entry is not None and entry[0] == session.size:
+        digest = entry[1].hexdigest()
+    else:
+        # Chunks were written by another process, or before a restart
+        digest = blobs.file_sha256(default_storage.path(session.file), config()['BLOCK_SIZE'])
+    if session.checksum and digest != session.checksum:
+        abort(session)
+        raise UploadError('File checksum mismatch; the upload was discarded')
+
+    attachment = blobs.adopt(
+        default_storage.path(session.file), digest, session.size,
+        original_filename=session.original_filename,
+        content_type=session.content_type,
+        uploaded_by_id=session.uploaded_by_id,
+    )
+    session.delete()
+    return attachment
+
+
+def abort(session):
+    digests().pop(session.id)
+    session.delete()
+    _remove(session.file)
+
+
+def purge_stale(batch_size=500, ttl=None, now=None):
+    """Delete sessions idle for longer than ``ttl`` seconds, and their files; returns the count."""
+    ttl = config()['SESSION_TTL'] if ttl is None else ttl
+    cutoff = (now or timezone.now()) - timedelta(seconds=ttl)
+    purged = 0
+    while True:
+        batch = list(UploadSession.objects.filter(updated_at__lt=cutoff)
+                     .order_by('updated_at').values_list('id', 'file')[:batch_size])
+        if not batch:
+            return purged
+        for _, name in batch:
+            _remove(name)
+        UploadSession.objects.filter(id__in=[pk for pk, _ in batch]).delete()
+        purged += len(batch)
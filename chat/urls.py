@@ -12,5 +12,10 @@ urlpatterns = [
     path('', include(router.urls)),
     path('fetch-link-preview/', views.fetch_preview, name='fetch-preview'),
     path('upload-file/', views.upload_file, name='upload-file'),
+    path('uploads/', views.create_upload_session, name='upload-session-create'),
+    path('uploads/<uuid:upload_id>/', views.upload_session, name='upload-session'),
+    path('uploads/<uuid:upload_id>/chunk/', views.upload_chunk, name='upload-chunk'),
+    path('uploads/<uuid:upload_id>/complete/', views.complete_upload, name='upload-complete'),
     path('<int:file_id>/download/', views.download_file, name='download_file'),
+    path('debug/query-stats/', views.query_stats, name='query-stats'),
 ]
\ No newline at end of file
@@ -1,59 +1,153 @@
-import requests
+import codecs
+from html.parser import HTMLParser
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 
-def fetch_link_preview(url):
-    """Fetch metadata for a URL to create a link preview"""
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=5)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Get title
-        title = soup.title.string if soup.title else None
-        
-        # Get meta description
-        description = None
-        meta_desc = soup.find('meta', attrs={'name': 'description'}) or soup.find('meta', attrs={'property': 'og:description'})
-        if meta_desc:
-            description = meta_desc.get('content')
-            
-        # Get image
-        image = None
-        meta_img = soup.find('meta', attrs={'property': 'og:image'})
-        if meta_img:
-            image = meta_img.get('content')
-            # If relative path, make absolute
-            if image and not urlparse(image).netloc:
-                base_url = f"{urlparse(url).scheme}://{urlparse(url).netloc}"
-                image = f"{base_url}{image}" if image.startswith('/') else f"{base_url}/{image}"
-                
-        # Get site name
-        site_name = None
-        meta_site = soup.find('meta', attrs={'property': 'og:site_name'})
-        if meta_site:
-            site_name = meta_site.get('content')
-        else:
-            site_name = urlparse(url).netloc
-            
-        return {
-            'url': url,
-            'title': title,
-            'description': description,
-            'image': image,
-            'site_name': site_name
-        }
-    except Exception as e:
-        # Log error but don't crash
-        print(f"Error fetching link preview: {str(e)}")
-        return {
-            'url': url,
-            'title': None,
-            'description': None,
-            'image': None,
-            'site_name': urlparse(url).netloc
-        }
\ No newline at end of file
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+def empty_link_preview(url):
+    """Preview returned when a URL cannot be fetched or parsed"""
+    return {
+        'url': url,
+        'title': None,
+        'description': None,
+        'image': None,
+        'site_name': urlparse(url).netloc
+    }
+
+def build_link_preview(url, title, description, image, site_name):
+    """Assemble a link preview, making a relative image URL absolute"""
+    if image and not urlparse(image).netloc:
+        base_url = f"{urlparse(url).scheme}://{urlparse(url).netloc}"
+        image = f"{base_url}{image}" if image.startswith('/') else f"{base_url}/{image}"
+
+    return {
+        'url': url,
+        'title': title,
+        'description': description,
+        'image': image,
+        'site_name': site_name or urlparse(url).netloc
+    }
+
+def parse_link_preview(url, html):
+    """Build a link preview from the HTML of the page at ``url``"""
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Get title
+    title = soup.title.string if soup.title else None
+
+    # Get meta description
+    description = None
+    meta_desc = soup.find('meta', attrs={'name': 'description'}) or soup.find('meta', attrs={'property': 'og:description'})
+    if meta_desc:
+        description = meta_desc.get('content')
+
+    # Get image
+    image = None
+    meta_img = soup.find('meta', attrs={'property': 'og:image'})
+    if meta_img:
+        image = meta_img.get('content')
+
+    # Get site name
+    site_name = None
+    meta_site = soup.find('meta', attrs={'property': 'og:site_name'})
+    if meta_site:
+        site_name = meta_site.get('content')
+
+    return build_link_preview(url, title, description, image, site_name)
+
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+def is_html_response(content_type, content_length, max_length):
+    """Whether a response declared with these headers is worth reading for a preview"""
+    if content_type and content_type.split(';')[0].strip().lower() not in HTML_CONTENT_TYPES:
+        return False
+    if content_length:
+        try:
+            return 0 < int(content_length) <= max_length
+        except ValueError:
+            return True
+    return True
+
+class HeadPreviewParser(HTMLParser):
+    """Incremental parser that reads preview fields from ``<head>`` only.
+
+    Feed it the body chunk by chunk with ``feed_bytes``; it reports done at
+    ``</head>``, at ``<body>`` or once ``max_bytes`` have been read, so the
+    rest of the page never has to be downloaded or parsed.
+    """
+
+    def __init__(self, encoding='utf-8', max_bytes=256 * 1024):
+        super().__init__(convert_charrefs=True)
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        except LookupError:
+            self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.done = False
+        self.title = None
+        self.meta = {}
+        self._title_parts = None
+
+    def feed_bytes(self, chunk):
+        """Parse the next chunk of the body; returns True once nothing more is needed"""
+        if self.done:
+            return True
+        chunk = chunk[:self.max_bytes - self.bytes_read]
+        self.bytes_read += len(chunk)
+        text = self.decoder.decode(chunk)
+        # Feed in small slices so parsing stops soon after </head> instead of
+        # running through the rest of a large network chunk.
+        for start in range(0, len(text), 4096):
+            self.feed(text[start:start + 4096])
+            if self.done:
+                break
+        if self.bytes_read >= self.max_bytes:
+            self.done = True
+        return self.done
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'body':
+            self.done = True
+        elif tag == 'title' and self.title is None:
+            self._title_parts = []
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            for key in ('name', 'property'):
+                if attrs.get(key) is not None:
+                    # First tag wins, as with BeautifulSoup's find()
+                    self.meta.setdefault((key, attrs[key]), attrs.get('content'))
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag == 'title' and self._title_parts is not None:
+            self.title = ''.join(self._title_parts) or None
+            self._title_parts = None
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self._title_parts is not None and not self.done:
+            self._title_parts.append(data)
+
+    def preview(self, url):
+        meta = self.meta
+        return build_link_preview(
+            url,
+            self.title,
+            meta.get(('name', 'description')) or meta.get(('property', 'og:description')),
+            meta.get(('property', 'og:image')),
+            meta.get(('property', 'og:site_name')),
+        )
+
+def extract_link_preview(url, chunks, encoding='utf-8', max_bytes=256 * 1024):
+    """Build a link preview from an iterable of body chunks, stopping after ``<head>``"""
+    parser = HeadPreviewParser(encoding, max_bytes)
+    for chunk in chunks:
+        if parser.feed_bytes(chunk):
+            break
+    return parser.preview(url)
@@ -1,9 +1,15 @@
+import json
 import os
-from django.http import FileResponse
+from asgiref.sync import async_to_sync, sync_to_async
+from django.http import HttpResponseRedirect, JsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods, require_POST
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework import viewsets, status, serializers
 from rest_framework.decorators import action, permission_classes, api_view
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
 from django.contrib.auth.models import User
@@ -14,13 +20,14 @@ from django.utils.crypto import get_random_string
 
 from .models import Team, Channel, Message, TeamInvitation, DirectMessageChannel
 from .serializers import (TeamSerializer, ChannelSerializer, MessageSerializer, 
-                         UserSerializer, TeamInvitationSerializer, DirectMessageChannelSerializer)
-from .utils import fetch_link_preview
+                         UserSerializer, TeamInvitationSerializer, DirectMessageChannelSerializer,
+                         PinnedMessageSerializer)
+from . import auth, blobs, downloads, membership, previews, query_inspector, storage, thumbnails, unfurl, uploads
 
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 
-from .models import FileAttachment
+from .models import FileAttachment, TeamStorage, UploadSession
 
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
     """ Viewset to fetch user-related data """
@@ -67,17 +74,37 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         serializer = self.get_serializer(interacted_users, many=True)
         return Response(serializer.data)
 
+def bulk_user_ids(request):
+    """The ``user_ids`` of a bulk membership request, or None unless it is a list of integers."""
+    user_ids = request.data.get('user_ids')
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, int) for user_id in user_ids):
+        return None
+    return user_ids
+
+
+BULK_USER_IDS_ERROR = {'error': 'user_ids must be a list of user ids'}
+
+
 class TeamViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = TeamSerializer
     
     def get_queryset(self):
-        return Team.objects.filter(members=self.request.user)
+        return Team.objects.filter(members=self.request.user).prefetch_related('members')
     
     def perform_create(self, serializer):
         team = serializer.save()
         team.members.add(self.request.user)
     
+    @action(detail=True, methods=['get'])
+    def storage(self, request, pk=None):
+        """Bytes of attachments in the team's messages, and the team quota (None if unlimited)"""
+        team = self.get_object()
+        return Response({
+            'bytes': storage.usage(TeamStorage, team.id),
+            'quota': storage.config()['TEAM_QUOTA'],
+        })
+
     @action(detail=True, methods=['post'])
     def add_member(self, request, pk=None):
         team = self.get_object()
@@ -91,6 +118,26 @@ class TeamViewSet(viewsets.ModelViewSet):
         team.members.add(user)
         
         return Response({'message': f'Added {user.username} to {team.name}'})
+
+    @action(detail=True, methods=['post'])
+    def add_members(self, request, pk=None):
+        """Add many users to the team and its public channels at once"""
+        # Not get_object(): the queryset prefetches every member
+        team = get_object_or_404(Team, id=pk, members=request.user)
+        user_ids = bulk_user_ids(request)
+        if user_ids is None:
+            return Response(BULK_USER_IDS_ERROR, status=status.HTTP_400_BAD_REQUEST)
+        added = membership.add_team_members(team, user_ids)
+        return Response({'team_id': team.id, 'user_ids': added})
+
+    @action(detail=True, methods=['post'])
+    def remove_members(self, request, pk=None):
+        """Remove many users from the team and its public channels at once"""
+        team = get_object_or_404(Team, id=pk, members=request.user)
+        user_ids = bulk_user_ids(request)
+        if user_ids is None:
+            return Response(BULK_USER_IDS_ERROR, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'team_id': team.id, 'removed': membership.remove_team_members(team, user_ids)})
     
     @action(detail=True, methods=['post'])
     def create_invitation(self, request, pk=None):
@@ -158,12 +205,8 @@ class TeamViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Add user to team
-        team.members.add(request.user)
-        
-        # Add user to all public team channels (excluding DM channels)
-        for channel in team.channels.filter(is_direct_message=False):
-            channel.members.add(request.user)
+        # Add user to team and all public team channels (excluding DM channels)
+        membership.add_team_members(team, [request.user.id])
         
         # Optional: Deactivate invitation after use
         # invitation.is_active = False
@@ -232,21 +275,58 @@ class ChannelViewSet(viewsets.ModelViewSet):
     serializer_class = ChannelSerializer
     
     def get_queryset(self):
-        return Channel.objects.filter(team__members=self.request.user, members=self.request.user)
+        return Channel.objects.filter(
+            team__members=self.request.user, members=self.request.user
+        ).prefetch_related('members')
     
     def perform_create(self, serializer):
         channel = serializer.save()
         if not channel.is_direct_message:
             # For regular channels, add all team members
-            channel_members = channel.team.members.all()
-            channel.members.set(channel_members)
+            membership.fill_from_team(channel)
     
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
         channel = self.get_object()
-        messages = Message.objects.filter(channel=channel)
+        messages = Message.objects.filter(channel=channel).select_related('sender', 'preview')
         serializer = MessageSerializer(messages, many=True)
         return Response(serializer.data)
+
+    @action(detail=True, methods=['post'])
+    def add_members(self, request, pk=None):
+        """Add many members of the channel's team to the channel at once"""
+        channel, error = self.bulk_target(request, pk)
+        if error:
+            return error
+        added = membership.add_channel_members(channel, request.data['user_ids'])
+        return Response({'channel_id': channel.id, 'user_ids': added})
+
+    @action(detail=True, methods=['post'])
+    def remove_members(self, request, pk=None):
+        """Remove many members from the channel at once"""
+        channel, error = self.bulk_target(request, pk)
+        if error:
+            return error
+        removed = membership.remove_channel_members(channel, request.data['user_ids'])
+        return Response({'channel_id': channel.id, 'removed': removed})
+
+    def bulk_target(self, request, pk):
+        """``(channel, None)`` for a valid bulk membership request, else ``(None, error response)``"""
+        # Not get_object(): the queryset prefetches every member
+        channel = get_object_or_404(Channel, id=pk, team__members=request.user, members=request.user)
+        if channel.is_direct_message:
+            return None, Response({'error': 'Direct message channels have fixed members'},
+                                  status=status.HTTP_400_BAD_REQUEST)
+        if bulk_user_ids(request) is None:
+            return None, Response(BULK_USER_IDS_ERROR, status=status.HTTP_400_BAD_REQUEST)
+        return channel, None
+
+    @action(detail=True, methods=['get'])
+    def pinned_messages(self, request, pk=None):
+        """Pinned messages of the channel in pin order"""
+        channel = get_object_or_404(Channel, id=pk, members=request.user)
+        serializer = PinnedMessageSerializer(Message.pinned_in(channel.id), many=True)
+        return Response(serializer.data)
     
     @action(detail=False, methods=['post'])
     def team_id(self, request):
@@ -258,7 +338,7 @@ class ChannelViewSet(viewsets.ModelViewSet):
         team = get_object_or_404(Team, id=team_id, members=request.user)
         
         # Return all channels the user is a member of (both group and DM)
-        channels = Channel.objects.filter(team=team, members=request.user)
+        channels = Channel.objects.filter(team=team, members=request.user).prefetch_related('members')
         serializer = self.get_serializer(channels, many=True)
         return Response(serializer.data)
     
@@ -323,13 +403,12 @@ class MessageViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return Message.objects.filter(
             channel__members=self.request.user
-        )
+        ).select_related('sender', 'preview')
 
     def perform_create(self, serializer):
         """Handles posting a message to a channel"""
         channel_id = self.request.data.get('channel')
         reply_to_id = self.request.data.get('reply_to')
-        link_preview = self.request.data.get('link_preview')
 
         if not channel_id:
             raise serializers.ValidationError({"channel": "Channel ID is required for messages."})
@@ -345,7 +424,12 @@ class MessageViewSet(viewsets.ModelViewSet):
         if reply_to_id:
             reply_to = get_object_or_404(Message, id=reply_to_id)
 
-        serializer.save(sender=self.request.user, channel=channel, reply_to=reply_to, link_preview=link_preview)
+        # Previews come from the server-side store, never from the client
+        serializer.save(sender=self.request.user, channel=channel, reply_to=reply_to,
+                        preview=unfurl.stored_preview_for(self.request.data.get('content')))
+
+    def perform_destroy(self, instance):
+        storage.delete_message(instance)
 
     @action(detail=False, methods=['get'])
     def direct_messages(self, request):
@@ -367,8 +451,8 @@ class MessageViewSet(viewsets.ModelViewSet):
             
             # Get messages from all DM channels between these users
             messages = Message.objects.filter(
-                channel__in=[dm.channel for dm in dm_channels]
-            ).order_by('created_at')
+                channel__in=dm_channels.values('channel_id')
+            ).select_related('sender', 'preview').order_by('created_at')
             
             serializer = MessageSerializer(messages, many=True)
             return Response(serializer.data)
@@ -384,20 +468,14 @@ class MessageViewSet(viewsets.ModelViewSet):
         if message.sender != request.user: 
             return Response({"Error": "You can only delete your messages"}, status=status.HTTP_403_FORBIDDEN)
         
-        message.delete()
+        storage.delete_message(message)
         return Response({"Message": "Message deleted Successfully"}, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=['post'])
     def fetch_preview(self, request):
-        """Fetch preview data for a URL"""
-        url = request.data.get('url')
-        
-        if not url:
-            return Response({'error': 'URL is required'}, 
-                        status=status.HTTP_400_BAD_REQUEST)
-        
-        preview_data = fetch_link_preview(url)
-        return Response(preview_data, status=status.HTTP_200_OK)
+        """Moved to the async ``fetch-link-preview`` view, which fetches without holding a worker"""
+        # 307 keeps the method and body
+        return HttpResponseRedirect(reverse('fetch-preview'), status=status.HTTP_307_TEMPORARY_REDIRECT)
     
     @action(detail=True, methods=['post'])
     def react(self, request, pk=None):
@@ -486,40 +564,71 @@ class MessageViewSet(viewsets.ModelViewSet):
         serializer = MessageSerializer(message)
         return Response(serializer.data)
     
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])
-def fetch_preview(request):
-        """Fetch preview data for a URL"""
-        url = request.data.get('url')
-        
-        if not url:
-            return Response({'error': 'URL is required'}, 
-                        status=status.HTTP_400_BAD_REQUEST)
-        
-        preview_data = fetch_link_preview(url)
-        return Response(preview_data, status=status.HTTP_200_OK)
+async def _authenticate(request):
+    """JWT user for a plain Django (async) view, or None"""
+    try:
+        result = await auth.CachedJWTAuthentication().aauthenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+@csrf_exempt
+@require_POST
+async def fetch_preview(request):
+    """Fetch preview data for a URL without holding a worker thread during the fetch"""
+    if await _authenticate(request) is None:
+        return JsonResponse({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        data = json.loads(request.body or b'{}') if request.content_type == 'application/json' else request.POST
+        url = data.get('url')
+    except (ValueError, AttributeError):
+        url = None
+
+    if not url or not isinstance(url, str):
+        return JsonResponse({'error': 'URL is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        preview_data = await previews.fetch(url)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid URL'}, status=status.HTTP_400_BAD_REQUEST)
+    return JsonResponse(preview_data)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def upload_file(request):
     """
-    Upload a file and return the file ID.
+    Upload a file and return the file ID. Pass ?team_id= of one of your teams to check its quota too;
+    the team quota is enforced when the file is attached to a message.
     """
+    # Checked against Content-Length before the body is parsed, so an upload
+    # over quota is never written to disk
+    try:
+        team_id = storage.member_team_id(request.user, request.query_params.get('team_id'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        storage.check_quota(request.user.id, int(request.META.get('CONTENT_LENGTH') or 0), team_id)
+    except storage.QuotaExceeded as e:
+        return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
     if 'file' not in request.FILES:
         return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
     
     file_obj = request.FILES['file']
     
-    # Create a new FileAttachment instance
-    attachment = FileAttachment(
-        file=file_obj,
+    # Hashed while it is written, and stored once however often it is uploaded
+    attachment = blobs.store(
+        file_obj.chunks(),
         original_filename=file_obj.name,
         content_type=file_obj.content_type,
-        size=file_obj.size,
         uploaded_by=request.user
     )
-    attachment.save()
+    thumbnails.schedule(attachment)
     
+    return _attachment_response(request, attachment)
+
+def _attachment_response(request, attachment):
     return Response({
         'id': attachment.id,
         'filename': attachment.original_filename,
@@ -528,30 +637,101 @@ def upload_file(request):
         'size': attachment.size
     }, status=status.HTTP_201_CREATED)
 
-@api_view(['GET'])
+def _upload_error(error):
+    return Response(error.to_dict(), status=error.status)
+
+@api_view(['POST'])
 @permission_classes([IsAuthenticated])
-def download_file(request, file_id):
+def create_upload_session(request):
     """
-    Download a file attachment by its ID.
+    Start a chunked upload: {filename, content_type, size, sha256 (optional), team_id (optional)}.
     """
     try:
-        # Try to get the file attachment
-        attachment = FileAttachment.objects.get(id=file_id)
-        
-        # Check if the file exists
-        if not attachment.file or not os.path.exists(attachment.file.path):
-            return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        # Open the file and create a FileResponse
-        file_handle = open(attachment.file.path, 'rb')
-        response = FileResponse(file_handle, content_type=attachment.content_type)
-        
-        # Set the content-disposition header to force download with the original filename
-        response['Content-Disposition'] = f'attachment; filename="{attachment.original_filename}"'
-        
-        return response
-    
-    except FileAttachment.DoesNotExist:
-        return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
-    except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        session = uploads.open_session(
+            request.user,
+            request.data.get('filename'),
+            request.data.get('content_type'),
+            request.data.get('size'),
+            request.data.get('sha256'),
+            request.data.get('team_id'),
+        )
+    except uploads.UploadError as e:
+        return _upload_error(e)
+    return Response({**session.to_dict(), 'max_chunk_size': uploads.config()['MAX_CHUNK_SIZE']},
+                    status=status.HTTP_201_CREATED)
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def upload_session(request, upload_id):
+    """
+    Offset to resume an upload from, or abort it.
+    """
+    session = get_object_or_404(UploadSession, id=upload_id, uploaded_by=request.user)
+    if request.method == 'DELETE':
+        uploads.abort(session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    return Response(session.to_dict())
+
+@api_view(['PUT'])
+@permission_classes([IsAuthenticated])
+def upload_chunk(request, upload_id):
+    """
+    Write the raw request body at ?offset=; X-Chunk-SHA256 is the chunk's SHA-256.
+    """
+    session = get_object_or_404(UploadSession, id=upload_id, uploaded_by=request.user)
+    try:
+        length = int(request.META['CONTENT_LENGTH'])
+    except (KeyError, ValueError):
+        length = None
+    try:
+        # request.stream is read block by block; the body is never buffered whole
+        offset = uploads.write_chunk(session, request.query_params.get('offset'), request.stream, length,
+                                     request.headers.get('X-Chunk-SHA256'))
+    except uploads.UploadError as e:
+        return _upload_error(e)
+    return Response({'upload_id': str(session.id), 'offset': offset, 'size': session.size})
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def complete_upload(request, upload_id):
+    """
+    Verify a fully received upload and return it as a file attachment.
+    """
+    session = get_object_or_404(UploadSession, id=upload_id, uploaded_by=request.user)
+    try:
+        attachment = uploads.finalize(session)
+    except uploads.UploadError as e:
+        return _upload_error(e)
+    thumbnails.schedule(attachment)
+    return _attachment_response(request, attachment)
+
+@require_http_methods(['GET', 'HEAD'])
+async def download_file(request, file_id):
+    """
+    Download a file attachment by its ID, with conditional GET and single Range support.
+    """
+    if await _authenticate(request) is None:
+        return JsonResponse({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        attachment = await FileAttachment.objects.aget(id=file_id)
+        stat = await sync_to_async(os.stat, thread_sensitive=False)(attachment.file.path)
+    except (FileAttachment.DoesNotExist, FileNotFoundError):
+        return JsonResponse({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    return downloads.attachment_response(request, attachment, stat)
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAdminUser])
+def query_stats(request):
+    """
+    N+1 and slow query findings collected by this process since start or last reset.
+    """
+    if request.method == 'DELETE':
+        query_inspector.stats.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    return Response({
+        'enabled': query_inspector.enabled(),
+        'findings': query_inspector.stats.snapshot(),
+    })